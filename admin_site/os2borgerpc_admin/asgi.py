@@ -0,0 +1,17 @@
+"""
+ASGI config for OS2borgerPC admin project.
+
+The same application as in wsgi.py, for ASGI servers. It's needed to serve
+the long-poll endpoint at /rpc/wait/ efficiently, e.g. with
+
+    gunicorn -k uvicorn.workers.UvicornWorker os2borgerpc_admin.asgi
+
+"""
+
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "os2borgerpc_admin.settings")
+
+from django.core.asgi import get_asgi_application  # noqa
+
+application = get_asgi_application()
@@ -16,7 +16,9 @@ def application(environ, start_response):
 
     job_routes = {
         '/jobs/check_notifications': 'check_notifications',
+        '/jobs/send_notifications': 'send_notifications',
         '/jobs/clean_up_database': 'clean_up_database',
+        '/jobs/publish_batch_waves': 'publish_batch_waves',
     }
     command = job_routes.get(path, None)
         
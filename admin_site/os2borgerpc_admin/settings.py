@@ -240,12 +240,15 @@ XMLRPC_METHODS = (
     ("system.rpc.send_status_info", "send_status_info"),
     ("system.rpc.send_status_info_v2", "send_status_info_v2"),
     ("system.rpc.get_instructions", "get_instructions"),
+    ("system.rpc.get_instructions_v2", "get_instructions_v2"),
+    ("system.rpc.sync", "sync"),
     ("system.rpc.push_config_keys", "push_config_keys"),
     ("system.rpc.push_security_events", "push_security_events"),
     ("system.rpc.citizen_login", "citizen_login"),
     ("system.rpc.citizen_logout", "citizen_logout"),
     ("system.rpc.sms_login", "sms_login"),
     ("system.rpc.sms_login_finalize", "sms_login_finalize"),
+    ("system.rpc.sms_status", "sms_status"),
     ("system.rpc.sms_logout", "sms_logout"),
     ("system.rpc.general_citizen_login", "general_citizen_login"),
     ("system.rpc.general_citizen_logout", "general_citizen_logout"),
@@ -299,6 +302,52 @@ CITIZEN_LOGIN_API_VALIDATOR = os.environ.get(
 # Cicero specific stuff.
 CICERO_URL = os.environ.get("CICERO_URL")
 
+# Maximum number of seconds to wait for a response from the external services
+# used for citizen login.
+INTEGRATION_TIMEOUT = float(os.getenv("INTEGRATION_TIMEOUT", "10"))
+
+# After this many failed requests in a row to an external service for a site,
+# requests to it fail right away for CIRCUIT_BREAKER_COOLDOWN seconds.
+CIRCUIT_BREAKER_THRESHOLD = int(os.getenv("CIRCUIT_BREAKER_THRESHOLD", "5"))
+CIRCUIT_BREAKER_COOLDOWN = int(os.getenv("CIRCUIT_BREAKER_COOLDOWN", "30"))
+
+# How many seconds a site's Easy!Appointments appointments are cached before
+# they're fetched again. New bookings aren't seen by logins until then.
+APPOINTMENT_CACHE_TTL = int(os.getenv("APPOINTMENT_CACHE_TTL", "30"))
+
+# How many seconds client check-ins (PC.last_seen) may be buffered in memory
+# before they're written to the database. This is the staleness bound for
+# everything reading last_seen, so keep it well below the five minutes after
+# which a PC is considered offline. 0 writes every check-in immediately.
+HEARTBEAT_FLUSH_INTERVAL = int(os.getenv("HEARTBEAT_FLUSH_INTERVAL", "30"))
+
+# Upper bound in bytes on the script code each process keeps in memory for
+# sending to clients.
+SCRIPT_CACHE_MAX_BYTES = int(os.getenv("SCRIPT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# How many seconds each process may keep using an API key after it has been
+# looked up. A deleted key may keep working in other processes for this long.
+API_KEY_CACHE_TTL = int(os.getenv("API_KEY_CACHE_TTL", "60"))
+
+# Batches on at least this many PCs don't get a job per PC up front. Instead
+# each PC's job is created when it fetches its instructions.
+LAZY_JOBS_MIN_PCS = int(os.getenv("LAZY_JOBS_MIN_PCS", "500"))
+
+# Seconds queued e-mail notifications wait for others to the same recipient
+# with the same subject, so they can be sent together as one e-mail.
+NOTIFICATION_COALESCE_WINDOW = int(os.getenv("NOTIFICATION_COALESCE_WINDOW", "120"))
+
+# Maximum number of seconds a client may wait at /rpc/wait/ for something to
+# change before it must ask again. Waiting clients only check in when they
+# start and stop waiting, so this is capped well below the five minutes after
+# which a PC is considered offline, less the heartbeat staleness bound.
+LONG_POLL_MAX_TIMEOUT = max(
+    min(
+        int(os.getenv("LONG_POLL_MAX_TIMEOUT", "120")), 240 - HEARTBEAT_FLUSH_INTERVAL
+    ),
+    0,
+)
+
 # All Python Markdown's officially supported extensions can be added here without
 # any extra setup.
 # Third-party extensions can also be imported and used, asuming they (and their
@@ -10,6 +10,8 @@ from django.contrib.auth import views as auth_views
 from .api import api
 
 from django_xmlrpc.views import handle_xmlrpc
+from system.compact_rpc import handle_compact_rpc
+from system.push import wait_for_instructions
 from markdownx import urls as markdownx
 from two_factor.urls import urlpatterns as tf_urls
 from two_factor import views as otp_views
@@ -20,6 +22,8 @@ urlpatterns = [
     re_path("accounts/login/", otp_views.LoginView.as_view()),
     re_path(r"^xmlrpc/$", handle_xmlrpc, name="xmlrpc"),
     re_path(r"^admin-xml/$", handle_xmlrpc),
+    re_path(r"^rpc/$", handle_compact_rpc, name="compact_rpc"),
+    re_path(r"^rpc/wait/$", wait_for_instructions, name="wait_for_instructions"),
     re_path(
         "accounts/logout/", auth_views.LogoutView.as_view(template_name="logout.html")
     ),
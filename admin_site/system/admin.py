@@ -117,12 +117,50 @@ class BatchParameterInline(admin.TabularInline):
 
 
 class BatchAdmin(admin.ModelAdmin):
-    list_display = ("id", "site", "name", "script")
-    fields = ("site", "name", "script")
+    list_display = (
+        "id",
+        "site",
+        "name",
+        "script",
+        "jobs_total",
+        "jobs_submitted",
+        "jobs_done",
+        "jobs_failed",
+    )
+    fields = (
+        "site",
+        "name",
+        "script",
+        "wave_size",
+        "wave_interval",
+        "halt_failure_percentage",
+        "created",
+        "jobs_total",
+        "jobs_submitted",
+        "jobs_done",
+        "jobs_failed",
+        "is_halted",
+    )
+    readonly_fields = (
+        "created",
+        "jobs_total",
+        "jobs_submitted",
+        "jobs_done",
+        "jobs_failed",
+        "is_halted",
+    )
     list_filter = ("site",)
     search_fields = ("name", "site__name", "script__name")
     inlines = [JobInline, BatchParameterInline]
 
+    def get_readonly_fields(self, request, obj=None):
+        # The waves are fixed once the batch has been run, and jobs created up
+        # front don't wait for them anyway. The halt threshold stays editable,
+        # so a halted rollout can be resumed.
+        if obj is None:
+            return self.readonly_fields
+        return self.readonly_fields + ("wave_size", "wave_interval")
+
 
 class InputInline(admin.TabularInline):
     model = Input
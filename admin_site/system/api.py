@@ -1,21 +1,36 @@
-from datetime import date, datetime, timedelta
+import csv
+import json
+from datetime import date, timedelta
+from itertools import groupby
+from operator import itemgetter
 from typing import List
-from django.db.models import Q
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q
+from django.db.models.functions import Coalesce
+from django.http import StreamingHttpResponse
 
-from ninja import Router
+from ninja import Query, Router
 from ninja.pagination import paginate
-from ninja.errors import ValidationError
+from ninja.errors import HttpError, ValidationError
+from ninja.responses import NinjaJSONEncoder
 
 
+from .changes import decode_cursor, encode_cursor, get_changes
 from .models import (
-    APIKey,
+    Batch,
+    BatchTarget,
     Configuration,
     ConfigurationEntry,
     Job,
+    LoginCount,
+    LoginLog,
+    MergedConfiguration,
     PC,
     SecurityEvent,
 )
+from .pagination import CursorPagination, PendingRows
 from .api_schemas import (
+    ChangesSchema,
     ConfigurationEntrySchema,
     JobSchema,
     PCSchema,
@@ -25,12 +40,16 @@ from .api_schemas import (
 
 router = Router()
 
+# Number of objects fetched from the database at a time by streaming endpoints.
+STREAM_CHUNK_SIZE = 500
+
 # General notes:
 
 # Endpoints use the names of the model on the english adminsite, whereas function names use the names of the models.
 # TODO: EXCEPT SecurityEvents/Events currently, which we've forgotten to rename to Events in the models.
 # API URLs use dashes as word separators
 
+# Lists that can grow without bounds are paginated with CursorPagination, so deep pages are as fast as the first.
 # We've wanted to combine @pagination with sending status codes in responses, but when used together it didn't work.
 # In those cases we've instead used an empty list, instead of sending a specific HTTP response for "No content"
 
@@ -40,12 +59,76 @@ router = Router()
 
 
 def get_site_from_request(request):
-    """Obtains the site based on the API Key, from the request headers"""
-    key = request.headers["Authorization"].split(" ")[-1]
-    valid_key_check = APIKey.objects.filter(key=key).first()
+    """Obtains the site of the API Key the request was authenticated with"""
+    return request.auth
+
+
+def stream_json_list(queryset, schema):
+    """Respond with the objects of a queryset as a JSON list, serialized with
+    schema. The objects are fetched and sent STREAM_CHUNK_SIZE at a time, so
+    large lists don't have to fit in memory."""
+
+    def generate():
+        separator = "["
+        chunk = []
+        for obj in queryset.iterator(chunk_size=STREAM_CHUNK_SIZE):
+            chunk.append(separator)
+            chunk.append(json.dumps(schema.from_orm(obj).dict(), cls=NinjaJSONEncoder))
+            separator = ", "
+            if len(chunk) >= 2 * STREAM_CHUNK_SIZE:
+                yield "".join(chunk)
+                chunk = []
+        chunk.append("]" if separator == ", " else "[]")
+        yield "".join(chunk)
+
+    return StreamingHttpResponse(
+        generate(), content_type="application/json; charset=utf-8"
+    )
+
+
+class Echo:
+    """A file-like object that returns what's written to it, for streaming
+    the output of csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def stream_export(rows, fields, export_format, name):
+    """Respond with rows (dicts with the given fields) as newline-delimited
+    JSON or CSV, sent STREAM_CHUNK_SIZE rows at a time."""
+    if export_format == "ndjson":
+        content_type = "application/x-ndjson"
+
+        def encode(row):
+            return json.dumps(row, cls=DjangoJSONEncoder) + "\n"
 
-    if valid_key_check:
-        return valid_key_check.site
+        header = ""
+    elif export_format == "csv":
+        content_type = "text/csv; charset=utf-8"
+        writer = csv.writer(Echo())
+
+        def encode(row):
+            return writer.writerow([row[field] for field in fields])
+
+        header = writer.writerow(fields)
+    else:
+        raise ValidationError([{"format": "Must be ndjson or csv"}])
+
+    def generate():
+        chunk = [header]
+        for row in rows.iterator(chunk_size=STREAM_CHUNK_SIZE):
+            chunk.append(encode(row))
+            if len(chunk) >= STREAM_CHUNK_SIZE:
+                yield "".join(chunk)
+                chunk = []
+        yield "".join(chunk)
+
+    response = StreamingHttpResponse(generate(), content_type=content_type)
+    response[
+        "Content-Disposition"
+    ] = f'attachment; filename="{name}-{date.today()}.{export_format}"'
+    return response
 
 
 def validate_sensible_dates(from_date, to_date):
@@ -55,23 +138,22 @@ def validate_sensible_dates(from_date, to_date):
         raise ValidationError("to_date is in the future")
 
 
-def filter_logins(all_logins, from_date, to_date):
-    # Turn the string into a python list of tuples with any spaces removed
-    # In other words it'll look like this:
-    # [('2023-10-10', '4'), ('2023-10-11', '4'), ('2023-10-12', '3'), ('2023-10-16', '0')]
-    all_logins_parsed = [
-        tuple(x.replace(" ", "").split(":")) for x in all_logins.split(",")
-    ]
+def format_login_counts(counts):
+    """Format (date, count) pairs like the login_counts configuration entry
+    the PCs report them in, e.g. "2023-10-10: 4, 2023-10-11: 3"."""
+    return ", ".join(f"{date}: {count}" for date, count in counts)
 
-    # Further turn the above into the format [(date, string)]
-    all_logins_parsed = [
-        (datetime.strptime(login[0], "%Y-%m-%d").date(), login[1])
-        for login in all_logins_parsed
-    ]
-    return ", ".join(
-        f"{date}: {logins}"
-        for date, logins in all_logins_parsed
-        if from_date <= date <= to_date
+
+def get_login_counts(site, from_date, to_date, **filters):
+    """The login counts of the site's PCs matching filters, as
+    (pc_id, pc_name, date, count) tuples ordered by PC and date."""
+    counts = LoginCount.objects.filter(pc__site=site, **filters)
+    # both set or either set: filter, neither set: don't filter
+    if from_date != date(1970, 1, 1) or to_date != date.today():
+        validate_sensible_dates(from_date, to_date)
+        counts = counts.filter(date__range=(from_date, to_date))
+    return counts.order_by("pc__name", "pc_id", "date").values_list(
+        "pc_id", "pc__name", "date", "count"
     )
 
 
@@ -84,9 +166,19 @@ def filter_logins(all_logins, from_date, to_date):
 )
 def list_pcs(request):
     site = get_site_from_request(request)
-    pcs = PC.objects.filter(site=site)
+    # ip_addresses is read from the merged configuration
+    pcs = (
+        PC.objects.filter(site=site)
+        .select_related("merged_configuration")
+        .prefetch_related("pc_groups")
+    )
+    # After a site-wide configuration change, rebuild the stale ones all at
+    # once rather than one PC at a time while streaming.
+    MergedConfiguration.rebuild_stale(
+        pcs.filter(merged_configuration__data__isnull=True).select_related("site")
+    )
 
-    return pcs or []
+    return stream_json_list(pcs, PCSchema)
 
 
 # Events
@@ -96,7 +188,7 @@ def list_pcs(request):
     response=List[SecurityEventSchema],
     url_name="events",
 )
-@paginate
+@paginate(CursorPagination)
 def list_events(
     request,
     from_date: date = date.today() - timedelta(days=90),
@@ -120,9 +212,9 @@ def list_events(
             to_date + timedelta(days=1),
         ],  # +1 to include the full to_date
         status=status.upper(),
-    ).order_by(
+    ).select_related("pc", "problem", "event_rule_server").order_by(
         "-id"
-    )  # or -occurred_time, but ID is probably faster
+    )  # or -occurred_time, but ID is probably faster. Pagination depends on it.
     return events
 
 
@@ -161,17 +253,16 @@ def get_pcs_logins_per_day(
     to_date: date = date.today(),
 ):
     site = get_site_from_request(request)
-    pcs = PC.objects.filter(site=site, is_activated=True)
-    pc_names_with_logins = []
-    for pc in pcs:
-        logins = pc.get_config_value("login_counts")
-        # both set or either set: filter, neither set: don't filter
-        if from_date != date(1970, 1, 1) or to_date != date.today():
-            validate_sensible_dates(from_date, to_date)
-            if logins:
-                logins = filter_logins(logins, from_date, to_date)
-        if logins:
-            pc_names_with_logins.append({"pc_name": pc.name, "logins_per_day": logins})
+    counts = get_login_counts(site, from_date, to_date, pc__is_activated=True)
+    pc_names_with_logins = [
+        {
+            "pc_name": pc_name,
+            "logins_per_day": format_login_counts(
+                (day, count) for _, _, day, count in pc_counts
+            ),
+        }
+        for (_, pc_name), pc_counts in groupby(counts, key=itemgetter(0, 1))
+    ]
 
     if pc_names_with_logins:
         return 200, pc_names_with_logins
@@ -193,20 +284,11 @@ def get_pc_logins_per_day(
     to_date: date = date.today(),
 ):
     site = get_site_from_request(request)
-    try:
-        pc = PC.objects.get(site=site, id=pc_id)
-        logins = pc.get_config_value("login_counts")
-    except PC.DoesNotExist:
-        pc = None
-    if pc and logins:
-        # both set or either set: filter, neither set: don't filter
-        if from_date != date(1970, 1, 1) or to_date != date.today():
-            validate_sensible_dates(from_date, to_date)
-            logins = filter_logins(logins, from_date, to_date)
-
+    pc = PC.objects.filter(site=site, id=pc_id).first()
+    if pc:
+        counts = get_login_counts(site, from_date, to_date, pc=pc)
+        logins = format_login_counts((day, count) for _, _, day, count in counts)
         return 200, {"pc_name": pc.name, "logins_per_day": logins}
-    elif pc:
-        return 200, {"pc_name": pc.name, "logins_per_day": ""}
     else:
         return 204, None
         # OR:
@@ -218,13 +300,18 @@ def get_pc_logins_per_day(
     "/jobs",
     response=List[JobSchema],
     url_name="jobs",
-    description="Fetch a list of all Jobs.",
+    description=(
+        "Fetch a list of all Jobs, newest first. With **pending**, the jobs of large batches that haven't been "
+        "handed out to their Computers yet are listed first, before all other jobs. They have no id, and are "
+        "included by when their batch was run rather than by their own creation date."
+    ),
 )
-@paginate
+@paginate(CursorPagination)
 def get_jobs(
     request,
     from_date: date = date.today() - timedelta(days=90),
     to_date: date = date.today(),
+    pending: bool = False,
 ):
     validate_sensible_dates(from_date, to_date)
     site = get_site_from_request(request)
@@ -234,11 +321,151 @@ def get_jobs(
             from_date,
             to_date + timedelta(days=1),
         ],  # +1 to include the full to_date
-    ).order_by(
+    ).select_related("pc").order_by(
         "-id"
-    )  # or -created, but ID is probably faster
+    )  # or -created, but ID is probably faster. Pagination depends on it.
+
+    if not pending:
+        return jobs
+    # Jobs still to be created from batch targets come first, without an id.
+    pending_jobs = BatchTarget.get_pending_jobs(
+        site,
+        batches=Batch.objects.filter(
+            targets__created__range=[from_date, to_date + timedelta(days=1)]
+        ),
+    )
+    return PendingRows(pending_jobs, jobs)
+
+
+# Changes
+@router.get(
+    "/changes",
+    response=ChangesSchema,
+    url_name="changes",
+)
+def list_changes(request, cursor: str = None, limit: int = Query(1000, ge=1, le=10000)):
+    """
+    Fetches the Computers, Jobs and Events created or changed since the last sync, and the ones deleted since then.
+    - Without a cursor, everything is returned (in several pages when there's more than **limit** of any kind).
+    - Pass the **next_cursor** of the response as **cursor** in the next request to only get what has changed since.
+    - When **has_more** is true, there are more changes to fetch right away.
+
+    Computers count as changed when their groups change, and when their last seen time moves into another 5 minute
+    period, so **last_seen** is at most 5 minutes behind: consider a computer offline when it was last seen more than
+    10 minutes ago. Changes made in transactions that are still running are held back, along with any later ones,
+    until those transactions finish. Deleted objects are only remembered for 30 days, so sync more often than that or
+    start over without a cursor.
+    """
+    site = get_site_from_request(request)
+    since = decode_cursor(cursor) if cursor else (0, 0)
+    changes = get_changes(site, since, limit)
+    changes["next_cursor"] = encode_cursor(changes.pop("position"))
+    return changes
+
+
+# Exports
+# Bulk exports of the full history, streamed straight from the database as
+# newline-delimited JSON (one object per line) or CSV.
+EXPORT_FORMAT = Query(
+    "ndjson", alias="format", description="Export format: ndjson or csv"
+)
 
-    return jobs or []
+
+@router.get(
+    "/export/jobs",
+    url_name="export-jobs",
+    description="Export all Jobs created in a period.",
+)
+def export_jobs(
+    request,
+    from_date: date = date.today() - timedelta(days=365),
+    to_date: date = date.today(),
+    export_format: str = EXPORT_FORMAT,
+):
+    validate_sensible_dates(from_date, to_date)
+    site = get_site_from_request(request)
+    fields = ["id", "status", "created", "started", "finished", "pc", "pc_name"]
+    jobs = (
+        Job.objects.filter(
+            batch__site=site,
+            created__range=[
+                from_date,
+                to_date + timedelta(days=1),
+            ],  # +1 to include the full to_date
+        )
+        .order_by("id")
+        .values("id", "status", "created", "started", "finished", "pc")
+        .annotate(pc_name=F("pc__name"))
+    )
+    return stream_export(jobs, fields, export_format, "jobs")
+
+
+@router.get(
+    "/export/events",
+    url_name="export-events",
+    description="Export all Events that occurred in a period, whatever their status.",
+)
+def export_events(
+    request,
+    from_date: date = date.today() - timedelta(days=365),
+    to_date: date = date.today(),
+    export_format: str = EXPORT_FORMAT,
+):
+    validate_sensible_dates(from_date, to_date)
+    site = get_site_from_request(request)
+    fields = [
+        "id",
+        "occurred_time",
+        "pc",
+        "pc_name",
+        "summary",
+        "status",
+        "assigned_user",
+        "note",
+        "monitoring_rule",
+        "level",
+    ]
+    events = (
+        SecurityEvent.objects.filter(
+            (Q(problem__site=site) | Q(event_rule_server__site=site)),
+            occurred_time__range=[
+                from_date,
+                to_date + timedelta(days=1),
+            ],  # +1 to include the full to_date
+        )
+        .order_by("id")
+        .values(
+            "id", "occurred_time", "pc", "summary", "status", "assigned_user", "note"
+        )
+        .annotate(
+            pc_name=F("pc__name"),
+            monitoring_rule=Coalesce("problem__name", "event_rule_server__name"),
+            level=Coalesce("problem__level", "event_rule_server__level"),
+        )
+    )
+    return stream_export(events, fields, export_format, "events")
+
+
+@router.get(
+    "/export/login-logs",
+    url_name="export-login-logs",
+    description="Export the citizen login log for a period.",
+)
+def export_login_logs(
+    request,
+    from_date: date = date.today() - timedelta(days=365),
+    to_date: date = date.today(),
+    export_format: str = EXPORT_FORMAT,
+):
+    validate_sensible_dates(from_date, to_date)
+    site = get_site_from_request(request)
+    fields = ["id", "identifier", "date", "login_time", "logout_time"]
+    login_logs = (
+        LoginLog.objects.filter(site=site, date__range=[from_date, to_date])
+        .order_by("id")
+        .values(*fields)
+    )
+    return stream_export(login_logs, fields, export_format, "login-logs")
 
 
 # Individual endpoints moved down here for now, as they may not be needed:
@@ -1,4 +1,6 @@
-from .models import ConfigurationEntry, Job, PC, SecurityEvent
+from typing import List
+
+from .models import ConfigurationEntry, Job, PC, SecurityEvent, Tombstone
 from ninja import ModelSchema, Schema
 from ninja.orm import create_schema
 
@@ -93,3 +95,24 @@ class JobSchema(ModelSchema):
 class PCLoginsSchema(Schema):
     pc_name: str
     logins_per_day: str
+
+
+class TombstoneSchema(ModelSchema):
+    type: str
+
+    @staticmethod
+    def resolve_type(obj):
+        return obj.model
+
+    class Config:
+        model = Tombstone
+        model_fields = ["object_id", "deleted"]
+
+
+class ChangesSchema(Schema):
+    computers: List[PCSchema]
+    jobs: List[JobSchema]
+    events: List[SecurityEventSchema]
+    deleted: List[TombstoneSchema]
+    next_cursor: str
+    has_more: bool
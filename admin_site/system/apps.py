@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class SystemConfig(AppConfig):
+    name = "system"
+
+    def ready(self):
+        # Connect signal handlers
+        from system import signals  # noqa: F401
@@ -0,0 +1,125 @@
+"""Process-local caches for data that is served to clients over and over."""
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """Thread safe least-recently-used cache bounded by the total size of
+    its values, as measured by the sizeof function."""
+
+    # Log the statistics once per this many lookups.
+    REPORT_INTERVAL = 1000
+
+    def __init__(self, name, max_size, sizeof=len):
+        self.name = name
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, _ = self._items[key]
+            except KeyError:
+                self.misses += 1
+                value = default
+            else:
+                self._items.move_to_end(key)
+                self.hits += 1
+            lookups = self.hits + self.misses
+        if lookups % self.REPORT_INTERVAL == 0:
+            logger.info("%s cache: %s", self.name, self.stats())
+        return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        # Values that would take up most of the cache aren't worth keeping.
+        if size > self.max_size // 4:
+            return
+        with self._lock:
+            self._discard(key)
+            self._items[key] = (value, size)
+            self._size += size
+            while self._size > self.max_size:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def discard_matching(self, predicate):
+        """Remove every entry whose key satisfies predicate."""
+        with self._lock:
+            for key in [key for key in self._items if predicate(key)]:
+                self._discard(key)
+
+    def _discard(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._size -= item[1]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "items": len(self._items),
+                "size": self._size,
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+# Script bodies keyed by (storage name, sha256 of the content), so a
+# re-uploaded script can never be served from a stale entry - not even in
+# worker processes that never saw the upload.
+script_code_cache = LRUCache("Script code", settings.SCRIPT_CACHE_MAX_BYTES)
+
+# Instruction parameters by batch id. A batch typically has a handful of
+# parameters, so this is bounded by the number of batches.
+batch_parameters_cache = LRUCache("Batch parameters", 10000, sizeof=lambda _: 1)
+
+# (site, expiry time) by sha256 of API key, so keys themselves aren't kept in
+# memory. Entries are discarded when their key is changed or deleted, but
+# other processes only notice once they expire.
+api_key_cache = LRUCache("API key", 10000, sizeof=lambda _: 1)
+
+# The positions of the PCs of batch targets by target id. Targets never
+# change, so entries don't need to be discarded. Bounded by the total number
+# of PCs.
+batch_target_pcs_cache = LRUCache("Batch target PCs", 1000000)
+
+
+def _reset_after_fork():
+    # The lock may have been held by another thread while forking.
+    script_code_cache._reset()
+    batch_parameters_cache._reset()
+    api_key_cache._reset()
+    batch_target_pcs_cache._reset()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,101 @@
+"""Incremental sync of computers, jobs and events for the changes API.
+
+Every computer, job and security event has a sync_version, which database
+triggers set from a single sequence whenever the row is inserted or
+updated, and when a computer joins or leaves a group. Updates that only
+move last_seen within the same period of LAST_SEEN_STEP seconds keep the
+version they had, or the heartbeat flush would change every computer every
+half minute. So a synced last_seen is at most LAST_SEEN_STEP seconds behind.
+Deleted rows leave a Tombstone with a version from the same sequence.
+
+Versions are handed out when a row is written but become visible when its
+transaction commits, which may happen out of order. So the triggers also
+record the ID of the writing transaction as sync_xid, and rows are synced
+in order of (sync_xid, sync_version). A sync only goes up to the oldest
+transaction still running: every transaction with a lower ID has finished,
+and later writes get a higher one, so nothing can turn up behind a cursor.
+"""
+
+import base64
+
+from django.db import connection
+from django.db.models import Q
+from ninja.errors import ValidationError
+
+from system.models import Job, PC, SecurityEvent, Tombstone
+
+# Must match LAST_SEEN_STEP in the migration creating the triggers.
+LAST_SEEN_STEP = 300
+
+
+def encode_cursor(position):
+    return (
+        base64.urlsafe_b64encode("-".join(map(str, position)).encode())
+        .decode()
+        .rstrip("=")
+    )
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        xid, version = base64.urlsafe_b64decode(padded.encode()).decode().split("-")
+        return int(xid), int(version)
+    except ValueError:
+        raise ValidationError([{"cursor": "Invalid cursor"}])
+
+
+def get_oldest_running_xid():
+    """Return the ID of the oldest transaction still running. Every
+    transaction with a lower ID has committed or rolled back."""
+    if connection.vendor != "postgresql":
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint")
+        return cursor.fetchone()[0]
+
+
+def get_changes(site, since, limit):
+    """Return the site's computers, jobs and events changed from position
+    since, along with tombstones for the deleted ones.
+
+    A position is a (sync_xid, sync_version) pair. At most limit rows of
+    each kind are returned. The result includes the position to continue
+    from, and whether there are more changes that can be fetched now."""
+    end = (get_oldest_running_xid(), 0)
+    querysets = {
+        "computers": PC.objects.filter(site=site)
+        .select_related("merged_configuration")
+        .prefetch_related("pc_groups"),
+        "jobs": Job.objects.filter(batch__site=site).select_related("pc"),
+        "events": SecurityEvent.objects.filter(
+            Q(problem__site=site) | Q(event_rule_server__site=site)
+        ).select_related("pc", "problem", "event_rule_server"),
+        "deleted": Tombstone.objects.filter(site=site),
+    }
+
+    def between(queryset, start, end):
+        return queryset.filter(
+            Q(sync_xid__gt=start[0]) | Q(sync_xid=start[0], sync_version__gte=start[1]),
+            Q(sync_xid__lt=end[0]) | Q(sync_xid=end[0], sync_version__lt=end[1]),
+        ).order_by("sync_xid", "sync_version")
+
+    # Find the furthest position up to which every kind of row fits within
+    # the limit.
+    until = end
+    for queryset in querysets.values():
+        positions = list(
+            between(queryset, since, until).values_list("sync_xid", "sync_version")[
+                : limit + 1
+            ]
+        )
+        if len(positions) > limit:
+            until = positions[limit]
+
+    changes = {
+        key: list(between(queryset, since, until))
+        for key, queryset in querysets.items()
+    }
+    changes["position"] = max(until, since)
+    changes["has_more"] = until < end
+    return changes
@@ -0,0 +1,193 @@
+"""A compact alternative to the XML-RPC endpoint for the client.
+
+The methods available through XML-RPC at /xmlrpc/ are also available at
+/rpc/. The request body is {"method": <name>, "params": [...]}, encoded as
+JSON (Content-Type: application/json) or msgpack (application/msgpack) and
+optionally compressed (Content-Encoding: gzip or zstd).
+
+The response is {"result": <result>}, or {"error": {"code": 1, "message":
+<message>}} if the method raised an exception, like an XML-RPC fault. It is
+encoded as the Accept header asks for, defaulting to the encoding of the
+request, and compressed if the Accept-Encoding header allows it.
+
+msgpack and zstd are only supported if the msgpack and zstandard packages
+are installed."""
+
+import datetime
+import decimal
+import gzip
+import io
+import json
+import zlib
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, HttpResponseNotAllowed
+from django.views.decorators.csrf import csrf_exempt
+from django_xmlrpc.dispatcher import xmlrpc_dispatcher
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+# Compressing responses smaller than this costs more than it saves.
+MIN_COMPRESS_SIZE = 1024
+
+
+class UnsupportedEncoding(Exception):
+    pass
+
+
+def get_content_types():
+    content_types = [JSON]
+    if msgpack:
+        content_types.append(MSGPACK)
+    return content_types
+
+
+def get_content_encodings():
+    """Supported compressions, most preferred first."""
+    encodings = ["gzip"]
+    if zstandard:
+        encodings.insert(0, "zstd")
+    return encodings
+
+
+def _to_msgpack(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    raise TypeError(f"Can't encode {type(value).__name__} as msgpack")
+
+
+def encode(data, content_type):
+    if content_type == JSON:
+        return json.dumps(data, cls=DjangoJSONEncoder, separators=(",", ":")).encode(
+            "utf-8"
+        )
+    if content_type == MSGPACK and msgpack:
+        return msgpack.packb(data, default=_to_msgpack)
+    raise UnsupportedEncoding(content_type)
+
+
+def decode(body, content_type):
+    if content_type == JSON:
+        return json.loads(body)
+    if content_type == MSGPACK and msgpack:
+        return msgpack.unpackb(body)
+    raise UnsupportedEncoding(content_type)
+
+
+def compress(body, content_encoding):
+    if content_encoding == "gzip":
+        return gzip.compress(body, compresslevel=6)
+    if content_encoding == "zstd" and zstandard:
+        return zstandard.ZstdCompressor().compress(body)
+    raise UnsupportedEncoding(content_encoding)
+
+
+def decompress(body, content_encoding, max_size):
+    """Decompress body, refusing to produce more than max_size bytes."""
+    if content_encoding == "gzip":
+        result = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(body, max_size + 1)
+    elif content_encoding == "zstd" and zstandard:
+        with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)) as reader:
+            result = reader.read(max_size + 1)
+    else:
+        raise UnsupportedEncoding(content_encoding)
+    if len(result) > max_size:
+        raise ValueError("Decompressed request body too large")
+    return result
+
+
+def _parse_header_values(value):
+    """The values listed in an Accept or Accept-Encoding header, skipping
+    those with q=0."""
+    values = []
+    for part in value.split(","):
+        token, *params = [item.strip().replace(" ", "") for item in part.split(";")]
+        if token and not any(param in ("q=0", "q=0.0") for param in params):
+            values.append(token.lower())
+    return values
+
+
+def negotiate_content_type(request, default):
+    accepted = _parse_header_values(request.headers.get("Accept", ""))
+    for content_type in accepted:
+        if content_type in get_content_types():
+            return content_type
+    return default
+
+
+def negotiate_content_encoding(request):
+    accepted = _parse_header_values(request.headers.get("Accept-Encoding", ""))
+    for content_encoding in get_content_encodings():
+        if content_encoding in accepted:
+            return content_encoding
+    return None
+
+
+def dispatch(method, params):
+    """Call a registered XML-RPC method, returning the response data."""
+    func = xmlrpc_dispatcher.funcs.get(method)
+    if func is None:
+        return {"error": {"code": 1, "message": f'method "{method}" is not supported'}}
+    try:
+        return {"result": func(*params)}
+    except Exception as e:
+        # Same message as the fault of an XML-RPC call.
+        return {"error": {"code": 1, "message": f"{type(e)}:{e}"}}
+
+
+@csrf_exempt
+def handle_compact_rpc(request):
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    content_type = request.content_type or JSON
+    if content_type not in get_content_types():
+        return HttpResponse(status=415)
+
+    body = request.body
+    content_encoding = request.headers.get("Content-Encoding", "").strip().lower()
+    if content_encoding and content_encoding != "identity":
+        max_size = settings.DATA_UPLOAD_MAX_MEMORY_SIZE or 2621440
+        try:
+            body = decompress(body, content_encoding, max_size)
+        except UnsupportedEncoding:
+            return HttpResponse(status=415)
+        except ValueError:
+            return HttpResponse(status=413)
+        except Exception:
+            return HttpResponse(status=400)
+
+    try:
+        call = decode(body, content_type)
+        method = call["method"]
+        params = call.get("params") or []
+        if not isinstance(method, str) or not isinstance(params, list):
+            raise ValueError
+    except Exception:
+        return HttpResponse(status=400)
+
+    response_type = negotiate_content_type(request, content_type)
+    response_body = encode(dispatch(method, params), response_type)
+    response = HttpResponse(response_body, content_type=response_type)
+    response["Vary"] = "Accept, Accept-Encoding"
+
+    response_encoding = negotiate_content_encoding(request)
+    if response_encoding and len(response_body) >= MIN_COMPRESS_SIZE:
+        response.content = compress(response_body, response_encoding)
+        response["Content-Encoding"] = response_encoding
+
+    return response
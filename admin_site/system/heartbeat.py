@@ -0,0 +1,136 @@
+"""Write-behind buffer for PC.last_seen.
+
+Every client poll used to rewrite the entire PC row just to move last_seen.
+Instead, check-ins are collected in memory per process and written back in
+one bulk UPDATE at most HEARTBEAT_FLUSH_INTERVAL seconds after the first
+unflushed check-in, which is therefore the staleness bound for anything
+reading last_seen from the database (PC.online, check_notifications and the
+dashboards)."""
+
+import atexit
+import logging
+import os
+import threading
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+# Number of rows per UPDATE statement when flushing.
+FLUSH_CHUNK_SIZE = 1000
+
+_lock = threading.Lock()
+_pending = {}
+_timer = None
+
+
+def record(pc, when=None):
+    """Register that a PC has checked in. The PC instance is updated right
+    away, the database row no later than HEARTBEAT_FLUSH_INTERVAL seconds
+    from now."""
+    if when is None:
+        when = datetime.now()
+    pc.last_seen = when
+
+    if settings.HEARTBEAT_FLUSH_INTERVAL <= 0:
+        _write({pc.pk: when})
+    else:
+        _buffer(pc.pk, when)
+
+
+def last_seen(pc):
+    """Return the most recent check-in time known to this process, which
+    may be newer than what is stored in the database."""
+    with _lock:
+        pending = _pending.get(pc.pk)
+    if pending is not None and (pc.last_seen is None or pc.last_seen < pending):
+        return pending
+    return pc.last_seen
+
+
+def flush(retry=True):
+    """Write all buffered check-ins to the database. Returns the number of
+    PCs written. If writing fails, the check-ins are kept for the next flush
+    unless retry is False."""
+    global _timer
+    with _lock:
+        pending = _pending.copy()
+        _pending.clear()
+        if _timer is not None:
+            _timer.cancel()
+            _timer = None
+
+    if not pending:
+        return 0
+
+    try:
+        _write(pending)
+    except Exception:
+        logger.exception("Unable to flush %s heartbeats", len(pending))
+        if retry:
+            # Put the check-ins back unless newer ones have arrived meanwhile,
+            # so they are retried with the next flush.
+            for pc_id, when in pending.items():
+                _buffer(pc_id, when)
+        return 0
+
+    return len(pending)
+
+
+def _buffer(pc_id, when):
+    global _timer
+    with _lock:
+        previous = _pending.get(pc_id)
+        if previous is None or previous < when:
+            _pending[pc_id] = when
+        if _timer is None:
+            _timer = threading.Timer(
+                settings.HEARTBEAT_FLUSH_INTERVAL, _flush_from_timer
+            )
+            _timer.daemon = True
+            _timer.start()
+
+
+def _flush_from_timer():
+    try:
+        flush()
+    finally:
+        # The timer thread gets its own database connection, don't leak it.
+        connection.close()
+
+
+def _write(pending):
+    from system.models import PC
+
+    table = connection.ops.quote_name(PC._meta.db_table)
+    items = sorted(pending.items())
+    with connection.cursor() as cursor:
+        for start in range(0, len(items), FLUSH_CHUNK_SIZE):
+            chunk = items[start : start + FLUSH_CHUNK_SIZE]
+            values = ", ".join(["(%s::integer, %s::timestamp)"] * len(chunk))
+            params = [value for item in chunk for value in item]
+            # Never move last_seen backwards - another process may already
+            # have written a newer check-in for the same PC.
+            cursor.execute(
+                f"UPDATE {table} AS pc SET last_seen = v.last_seen "
+                f"FROM (VALUES {values}) AS v (id, last_seen) "
+                "WHERE pc.id = v.id "
+                "AND (pc.last_seen IS NULL OR pc.last_seen < v.last_seen)",
+                params,
+            )
+
+
+def _reset_after_fork():
+    # Timers don't survive a fork, and the parent's check-ins are the
+    # parent's to flush.
+    global _lock, _timer
+    _lock = threading.Lock()
+    _pending.clear()
+    _timer = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+# No retrying on exit, that would only start another timer.
+atexit.register(flush, retry=False)
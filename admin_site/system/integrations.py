@@ -0,0 +1,409 @@
+"""Clients for the external services used for citizen login.
+
+All requests to these services go through pooled HTTP sessions with
+bounded timeouts, so a slow or unreachable service can't hold a worker
+for longer than INTEGRATION_TIMEOUT seconds per request.
+
+Each process also keeps a circuit breaker per service and site. After
+CIRCUIT_BREAKER_THRESHOLD failed requests in a row, requests to the service
+for that site fail right away with ServiceUnavailable for
+CIRCUIT_BREAKER_COOLDOWN seconds, so an outage doesn't tie up every worker
+waiting for timeouts. The time taken by the requests to each service is
+logged as a histogram."""
+
+import bisect
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from urllib.parse import quote
+
+import requests
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a connection to a service to be established.
+CONNECT_TIMEOUT = 3.05
+
+_local = threading.local()
+_lock = threading.Lock()
+_breakers = {}
+_histograms = {}
+
+
+class ServiceUnavailable(requests.RequestException):
+    """Raised instead of making a request to a service that keeps failing."""
+
+
+class CircuitBreaker:
+    """Counts the consecutive failures of a service for a site."""
+
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0.0
+
+    def allow(self, now):
+        if self.failures < settings.CIRCUIT_BREAKER_THRESHOLD:
+            return True
+        if now < self.open_until:
+            return False
+        # Let a single request through to find out if the service is back.
+        self.open_until = now + settings.CIRCUIT_BREAKER_COOLDOWN
+        return True
+
+    def record(self, success, now):
+        """Record the outcome of a request. Returns True if this opened the
+        circuit."""
+        if success:
+            self.failures = 0
+            return False
+        self.failures += 1
+        if self.failures >= settings.CIRCUIT_BREAKER_THRESHOLD:
+            self.open_until = now + settings.CIRCUIT_BREAKER_COOLDOWN
+            return self.failures == settings.CIRCUIT_BREAKER_THRESHOLD
+        return False
+
+
+class LatencyHistogram:
+    """Response times of the requests to a service."""
+
+    # Upper bounds of the buckets in seconds.
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+    # Log the histogram once per this many requests.
+    REPORT_INTERVAL = 100
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.failures = 0
+        self.total = 0.0
+
+    def add(self, seconds, success):
+        """Record a request. Returns True when it's time to log the
+        histogram."""
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if not success:
+            self.failures += 1
+        return self.count % self.REPORT_INTERVAL == 0
+
+    def percentile(self, fraction):
+        """The upper bound of the bucket containing the given percentile."""
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= fraction * self.count:
+                return bound
+        return self.BUCKETS[-1]
+
+    def stats(self):
+        buckets = ", ".join(
+            f"<={bound}s: {count}"
+            for bound, count in zip(self.BUCKETS, self.counts)
+            if count
+        )
+        return (
+            f"{self.count} requests, {self.failures} failed, "
+            f"mean {self.total / max(self.count, 1):.3f}s, "
+            f"p50 <={self.percentile(0.5)}s, p95 <={self.percentile(0.95)}s, "
+            f"p99 <={self.percentile(0.99)}s ({buckets})"
+        )
+
+
+def get_timeout():
+    return (CONNECT_TIMEOUT, settings.INTEGRATION_TIMEOUT)
+
+
+def get_session(provider):
+    """Return this thread's HTTP session for a provider, reusing its
+    connections across requests."""
+    sessions = getattr(_local, "sessions", None)
+    if sessions is None:
+        sessions = _local.sessions = {}
+    session = sessions.get(provider)
+    if session is None:
+        session = sessions[provider] = requests.Session()
+    return session
+
+
+def request(provider, site, method, url, **kwargs):
+    """Make a request to a provider's service on behalf of a site. Raises
+    ServiceUnavailable without making the request if the service has kept
+    failing for the site."""
+    key = (provider, site.pk)
+    start = time.monotonic()
+    with _lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = _breakers[key] = CircuitBreaker()
+        allowed = breaker.allow(start)
+    if not allowed:
+        raise ServiceUnavailable(f"{provider} is unavailable for {site.name}")
+
+    kwargs.setdefault("timeout", get_timeout())
+    success = False
+    try:
+        response = get_session(provider).request(method, url, **kwargs)
+        # Client errors are the site's problem, not the service's.
+        success = response.status_code < 500
+        return response
+    finally:
+        now = time.monotonic()
+        with _lock:
+            opened = breaker.record(success, now)
+            histogram = _histograms.get(provider)
+            if histogram is None:
+                histogram = _histograms[provider] = LatencyHistogram(provider)
+            report = histogram.add(now - start, success)
+            stats = histogram.stats() if report else None
+        if opened:
+            logger.warning(
+                f"{site.name}: {provider} failed {breaker.failures} times in a row, "
+                f"pausing requests for {settings.CIRCUIT_BREAKER_COOLDOWN} seconds"
+            )
+        if stats:
+            logger.info("%s response times: %s", provider, stats)
+
+
+class QuriaClient:
+    """Client for the Quria API of a site."""
+
+    def __init__(self, site):
+        self.site = site
+
+    def lookup_patron(self, loaner_number, pincode):
+        return request(
+            "quria",
+            self.site,
+            "GET",
+            f"https://axiell.io/api/quriaEU/patron-lookup/quria-release/integrations/"
+            f"ncip/{self.site.agency_id}/small",
+            params={"sno": loaner_number, "pwd": pincode},
+            headers={
+                "accept": "application/json",
+                "X-Axiell-Api-Key": self.site.citizen_login_api_key,
+            },
+        )
+
+
+class CiceroClient:
+    """Client for the Cicero API of a site.
+
+    Logging in to Cicero to get a session key is an extra request, so session
+    keys are kept per process and reused until they have been in use for
+    SESSION_KEY_TTL seconds or Cicero rejects them."""
+
+    SESSION_KEY_TTL = 30 * 60
+
+    _session_keys = {}
+    _lock = threading.Lock()
+
+    def __init__(self, site):
+        self.site = site
+        self.base_url = f"{settings.CICERO_URL}/rest/external"
+
+    @property
+    def _cache_key(self):
+        return (
+            self.site.agency_id,
+            self.site.citizen_login_api_user,
+            self.site.citizen_login_api_password,
+        )
+
+    def get_session_key(self, refresh=False):
+        """Return a session key, logging in if there's no usable cached one.
+        Returns None if the site's credentials are rejected."""
+        now = time.monotonic()
+        if not refresh:
+            with self._lock:
+                cached = self._session_keys.get(self._cache_key)
+            if cached and cached[1] > now:
+                return cached[0]
+
+        response = request(
+            "cicero",
+            self.site,
+            "POST",
+            f"{self.base_url}/v1/{self.site.agency_id}/authentication/login/",
+            json={
+                "username": self.site.citizen_login_api_user,
+                "password": self.site.citizen_login_api_password,
+            },
+        )
+        if not response.ok:
+            # Unable to authenticate with system user - log this.
+            try:
+                message = response.json()["message"]
+            except (ValueError, KeyError):
+                message = response.text
+            logger.error(
+                f"{self.site.name} was unable to log in with configured user name and password: {message}"
+            )
+            self.forget_session_key()
+            return None
+
+        session_key = response.json()["sessionKey"]
+        with self._lock:
+            self._session_keys[self._cache_key] = (
+                session_key,
+                now + self.SESSION_KEY_TTL,
+            )
+        return session_key
+
+    def forget_session_key(self):
+        with self._lock:
+            self._session_keys.pop(self._cache_key, None)
+
+    def authenticate_patron(self, loaner_number, pincode):
+        """Check a loaner's credentials. Returns the response from Cicero,
+        or None if the site's credentials were rejected."""
+        session_key = self.get_session_key()
+        for retry in (False, True):
+            if session_key is None:
+                return None
+            response = request(
+                "cicero",
+                self.site,
+                "POST",
+                f"{self.base_url}/{self.site.agency_id}/patrons/authenticate/v6",
+                headers={"X-session": session_key},
+                json={"libraryCardNumber": loaner_number, "pincode": pincode},
+            )
+            if response.status_code != 401 or retry:
+                return response
+            # The session key has expired, get a new one and try again.
+            session_key = self.get_session_key(refresh=True)
+
+
+class EasyAppointmentsClient:
+    """Client for the Easy!Appointments API of a site.
+
+    A site's appointments for a day are cached in the database for
+    APPOINTMENT_CACHE_TTL seconds and shared by all processes, so a busy
+    site doesn't fetch the same appointments for every login."""
+
+    def __init__(self, site):
+        self.site = site
+
+    def get_appointments(self, date):
+        """Return the site's appointments on a date, or None if the site's API
+        key is rejected."""
+        from system.models import AppointmentCache
+
+        cached = AppointmentCache.objects.filter(site=self.site, date=date).first()
+        if cached and cached.is_fresh(datetime.now()):
+            return cached.appointments
+
+        with transaction.atomic():
+            cached, _ = AppointmentCache.objects.get_or_create(
+                site=self.site, date=date
+            )
+            # Concurrent logins wait here while the first of them fetches the
+            # appointments, and then use its result.
+            cached = AppointmentCache.objects.select_for_update().get(pk=cached.pk)
+            if cached.is_fresh(datetime.now()):
+                return cached.appointments
+
+            appointments = self.fetch_appointments(date)
+            if appointments is not None:
+                cached.appointments = appointments
+                cached.fetched = datetime.now()
+                cached.save(update_fields=["appointments", "fetched"])
+            return appointments
+
+    def fetch_appointments(self, date):
+        response = request(
+            "easy_appointments",
+            self.site,
+            "GET",
+            f"https://{self.site.booking_api_url}/index.php/api/v1/appointments"
+            f"?aggregates&fields=start,end,customer,service&sort=+start"
+            f"&q={date.strftime('%Y-%m-%d')}",
+            headers={"Authorization": f"Bearer {self.site.booking_api_key}"},
+        )
+        if not response.ok:
+            # Unable to authenticate with system API key - log this.
+            logger.error(
+                f"{self.site.name} was unable to authorize with configured "
+                f"EasyAppointments API key: {response.text}"
+            )
+            return None
+        # Only keep what the booking validation reads, so no more of the
+        # citizens' customer records than their phone numbers is stored.
+        return [
+            {
+                "start": appointment["start"],
+                "end": appointment["end"],
+                "service": {"name": appointment["service"]["name"]},
+                "customer": {"phone": appointment["customer"]["phone"]},
+            }
+            for appointment in response.json()
+        ]
+
+
+class SMSTeknikClient:
+    """Client for sending text messages through SMSTeknik."""
+
+    def __init__(self, site):
+        self.site = site
+
+    def send(self, phone_number, message):
+        """Send a text message. Returns False if SMSTeknik refused to send it,
+        in which case trying again won't help."""
+        sms_url = (
+            f"https://api.smsteknik.se/send/xml/?id=F%F6reningen+Sambruk"
+            f"&user={quote(self.site.citizen_login_api_user)}"
+            f"&pass={quote(self.site.citizen_login_api_password)}"
+        )
+        translate_table = str.maketrans(
+            {"å": r"&#229;", "ä": r"&#228;", "ö": r"&#246;"}
+        )
+        xml = f"""<?xml version='1.0' encoding='utf-8'?>
+        <sms-teknik>
+        <flash>true</flash> # Make it a flash sms
+        <customid>{self.site.name.translate(translate_table)}</customid>
+        <udmessage><![CDATA[{message.translate(translate_table)}]]></udmessage>
+        <smssender>MedborgarPC</smssender> # This is the listed sender. It is limited to 11 characters
+        <items>
+        <recipient>
+        <nr>{phone_number}</nr>
+        </recipient>
+        </items>
+        </sms-teknik>"""
+
+        response = request("smsteknik", self.site, "POST", sms_url, data=xml)
+        # Let the caller retry if SMSTeknik is having trouble.
+        if response.status_code >= 500:
+            response.raise_for_status()
+        # The SMSTeknik API always returns response.ok = True even
+        # if authentication fails. Instead, status is indicated by
+        # response.text which will be an id for successful requests
+        # and 0: followed by a brief error description for failed
+        # requests
+        if response.text[:2] != "0:":
+            return True
+        if "no valid recipients" not in response.text.lower():
+            # Unable to authenticate with system user - log this.
+            logger.error(
+                f"{self.site.name} was unable to authorize with SMSTeknik "
+                f"with configured user name and password: {response.text}"
+            )
+        return False
+
+
+def _reset_after_fork():
+    # Connections can't be shared with the parent process.
+    global _local, _lock
+    _local = threading.local()
+    _lock = threading.Lock()
+    _breakers.clear()
+    _histograms.clear()
+    CiceroClient._lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
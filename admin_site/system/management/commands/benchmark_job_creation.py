@@ -0,0 +1,73 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from system.models import Batch, Configuration, Job, PC, Script, Site
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the time and number of statements spent running a script on "
+        "many PCs with one INSERT per job, with bulk inserts and with a batch "
+        "target. Everything is created on a made-up site and rolled back "
+        "afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pcs", type=int, default=10000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            site, script, pcs = self.make_site(options["pcs"])
+
+            self.stdout.write(f"{'method':<16}{'statements':>12}{'seconds':>10}")
+            for name, run in (
+                ("one by one", self.run_one_by_one),
+                ("bulk", self.run_bulk),
+                ("batch target", self.run_lazy),
+            ):
+                statements = []
+
+                def count(execute, sql, *args):
+                    statements.append(sql)
+                    return execute(sql, *args)
+
+                with connection.execute_wrapper(count):
+                    start = time.perf_counter()
+                    run(site, script, pcs)
+                    seconds = time.perf_counter() - start
+                self.stdout.write(f"{name:<16}{len(statements):>12}{seconds:>10.3f}")
+
+            transaction.set_rollback(True)
+
+    def make_site(self, pc_count):
+        site = Site.objects.create(name="Benchmark", uid=f"benchmark-{time.time_ns()}")
+        configuration = Configuration.objects.create(name=f"{site.uid}-pcs")
+        pcs = PC.objects.bulk_create(
+            PC(
+                name=f"pc{i}",
+                uid=f"{site.uid}-{i}",
+                mac="",
+                site=site,
+                configuration=configuration,
+                is_activated=True,
+            )
+            for i in range(pc_count)
+        )
+        script = Script.objects.create(name="Benchmark", description="", site=site)
+        return site, script, pcs
+
+    def run_one_by_one(self, site, script, pcs):
+        # How Script.run_on used to create its jobs.
+        batch = Batch.objects.create(site=site, script=script, name="")
+        for pc in pcs:
+            Job(batch=batch, pc=pc, log_output="New job with arguments []").save()
+
+    def run_bulk(self, site, script, pcs):
+        batch = Batch.objects.create(site=site, script=script, name="")
+        batch.add_jobs(pcs, log_output="New job with arguments []", lazy=False)
+
+    def run_lazy(self, site, script, pcs):
+        batch = Batch.objects.create(site=site, script=script, name="")
+        batch.add_jobs(pcs, log_output="New job with arguments []", lazy=True)
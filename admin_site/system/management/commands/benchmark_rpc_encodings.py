@@ -0,0 +1,183 @@
+import random
+import time
+import xmlrpc.client
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from system import compact_rpc, rpc
+from system.models import PC
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the size of a client poll and the CPU time spent encoding and "
+        "decoding it over XML-RPC and the compact RPC encodings"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--pc-uid",
+            help="Benchmark the instructions of this PC. Nothing is changed "
+            "in the database. Defaults to the activated PC seen most recently.",
+        )
+        parser.add_argument(
+            "--made-up",
+            action="store_true",
+            help="Benchmark a made-up poll instead of a real PC's instructions",
+        )
+        parser.add_argument("--jobs", type=int, default=5)
+        parser.add_argument("--script-size", type=int, default=4096)
+        parser.add_argument("--config-keys", type=int, default=40)
+        parser.add_argument("--iterations", type=int, default=200)
+
+    def handle(self, *args, **options):
+        pc_uid = options["pc_uid"]
+        if not pc_uid and not options["made_up"]:
+            pc_uid = (
+                PC.objects.filter(is_activated=True, last_seen__isnull=False)
+                .order_by("-last_seen")
+                .values_list("uid", flat=True)
+                .first()
+            )
+            if not pc_uid:
+                self.stdout.write("No activated PCs, using a made-up poll")
+        if pc_uid and not options["made_up"]:
+            instructions = self.get_pc_instructions(pc_uid)
+        else:
+            instructions = self.make_instructions(
+                options["jobs"], options["script_size"], options["config_keys"]
+            )
+
+        encodings = [("XML-RPC", self.encode_xmlrpc, self.decode_xmlrpc)]
+        for content_type in compact_rpc.get_content_types():
+            encodings.append(
+                (
+                    content_type.split("/")[1],
+                    lambda data, t=content_type: compact_rpc.encode(data, t),
+                    lambda body, t=content_type: compact_rpc.decode(body, t),
+                )
+            )
+
+        iterations = options["iterations"]
+        self.stdout.write(
+            f"{'encoding':<24}{'bytes':>10}{'encode ms':>12}{'decode ms':>12}"
+        )
+        for name, encode, decode in encodings:
+            for compression in [None] + compact_rpc.get_content_encodings():
+                size, encode_ms, decode_ms = self.measure(
+                    instructions, encode, decode, compression, iterations
+                )
+                label = f"{name} + {compression}" if compression else name
+                self.stdout.write(
+                    f"{label:<24}{size:>10}{encode_ms:>12.3f}{decode_ms:>12.3f}"
+                )
+
+    def measure(self, data, encode, decode, compression, iterations):
+        """Return the encoded size and the CPU time per poll in milliseconds
+        spent on encoding respectively decoding."""
+        start = time.process_time()
+        for _ in range(iterations):
+            body = encode(data)
+            if compression:
+                body = compact_rpc.compress(body, compression)
+        encode_time = time.process_time() - start
+
+        start = time.process_time()
+        for _ in range(iterations):
+            raw = body
+            if compression:
+                raw = compact_rpc.decompress(body, compression, len(body) * 1000)
+            decode(raw)
+        decode_time = time.process_time() - start
+
+        return (
+            len(body),
+            encode_time * 1000 / iterations,
+            decode_time * 1000 / iterations,
+        )
+
+    def encode_xmlrpc(self, data):
+        return xmlrpc.client.dumps((data["result"],), methodresponse=True).encode(
+            "utf-8"
+        )
+
+    def decode_xmlrpc(self, body):
+        return xmlrpc.client.loads(body)
+
+    def get_pc_instructions(self, pc_uid):
+        # Getting instructions marks the PC's jobs as submitted, undo that.
+        with transaction.atomic():
+            pc = PC.objects.select_related("merged_configuration").get(uid=pc_uid)
+            instructions = rpc.get_changed_instructions(pc, {})
+            transaction.set_rollback(True)
+        return {"result": instructions}
+
+    def make_instructions(self, jobs, script_size, config_keys):
+        # Every script is different, like real ones, so compression can't
+        # just refer back to the previous script.
+        scripts = [
+            self.make_script(random.Random(i), script_size) for i in range(jobs)
+        ]
+        return {
+            "result": {
+                "jobs": [
+                    {
+                        "id": 100000 + i,
+                        "name": f"Script {i}",
+                        "status": "SUBMITTED",
+                        "parameters": [
+                            {"type": "STRING", "value": "True"},
+                            {"type": "FILE", "value": "/media/parameter_uploads/a"},
+                        ],
+                        "executable_code": scripts[i],
+                    }
+                    for i in range(jobs)
+                ],
+                "configuration": {
+                    f"os2borgerpc_key_{i}": f"value {i}" for i in range(config_keys)
+                },
+                "configuration_digest": "0" * 64,
+                "security_scripts": [
+                    {
+                        "name": "script1_problem1",
+                        "executable_code": self.make_script(
+                            random.Random(jobs), script_size
+                        ),
+                    }
+                ],
+                "security_scripts_digest": "0" * 64,
+                "not_modified": False,
+            }
+        }
+
+    def make_script(self, rng, size):
+        """A made-up bash script of about size bytes."""
+        packages = ["firefox", "chromium", "libreoffice", "cups", "vlc", "gimp"]
+        paths = ["/etc/os2borgerpc", "/home/user/.config", "/usr/share/applications"]
+        lines = ["#!/usr/bin/env bash", "", "set -ex", ""]
+        length = sum(len(line) + 1 for line in lines)
+        while length < size:
+            kind = rng.randrange(5)
+            if kind == 0:
+                line = f"apt-get install -y {rng.choice(packages)}"
+            elif kind == 1:
+                line = (
+                    f'sed -i "s/^{rng.choice(packages).upper()}_{rng.randrange(1000)}='
+                    f'.*/&{rng.getrandbits(32):x}/" {rng.choice(paths)}/settings.conf'
+                )
+            elif kind == 2:
+                line = (
+                    f'if [ -f "{rng.choice(paths)}/{rng.getrandbits(24):x}" ]; '
+                    f"then\n  rm -f \"$_\"\nfi"
+                )
+            elif kind == 3:
+                line = f"# Step {rng.randrange(100)}: configure {rng.choice(packages)}"
+            else:
+                line = (
+                    f"mkdir -p {rng.choice(paths)}/{rng.getrandbits(16):x} && "
+                    f"chmod {rng.choice(['644', '755', '700'])} \"$_\""
+                )
+            lines.append(line)
+            length += len(line) + 1
+        return "\n".join(lines) + "\n"
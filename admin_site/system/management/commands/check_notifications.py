@@ -1,17 +1,18 @@
-import logging
-import traceback
-
 from django.core.management.base import BaseCommand
-from system.models import PC, EventRuleServer, SecurityEvent, User
+from django.db import transaction
+from system.models import PC, EventRuleServer, Notification, SecurityEvent
+from system.utils import get_alert_email_addresses, queue_notifications
 from datetime import datetime
-from django.core.mail import EmailMessage
 
 
 class Command(BaseCommand):
     help = "Check if any notifications need to be sent"
 
+    @transaction.atomic
     def handle(self, *args, **options):
-        """Check if any pcs have been offline too long and send notifications"""
+        """Check if any pcs have been offline too long and send notifications.
+        The security events and their notifications are created together, so
+        there's never an event without its notification."""
 
         all_pcs = PC.objects.only("last_seen").all().order_by("-pk")
         now = datetime.now()
@@ -21,14 +22,11 @@ class Command(BaseCommand):
                 perform_check = True
                 break
 
+        notifications = []
         if perform_check:
-            logger = logging.getLogger(__name__)
-
             rules_to_check = EventRuleServer.objects.prefetch_related("alert_groups")
             for rule in rules_to_check:
                 if rule.monitor_period_start < now.time() < rule.monitor_period_end:
-                    email_dict = {}
-
                     if rule.alert_groups.first():
                         pcs_to_check_pk = list(
                             set(rule.alert_groups.values_list("pcs", flat=True))
@@ -71,48 +69,10 @@ class Command(BaseCommand):
                                     reported_time=now,
                                     summary=summary,
                                 )
-                                supervisor_relations = pc.pc_groups.exclude(
-                                    supervisors=None
+                                notifications += queue_notifications(
+                                    get_alert_email_addresses(pc, rule),
+                                    f"Notification rule: {rule.name}",
+                                    summary,
                                 )
 
-                                if supervisor_relations:
-                                    alert_users_pk = list(
-                                        set(
-                                            supervisor_relations.values_list(
-                                                "supervisors", flat=True
-                                            )
-                                        )
-                                    )
-                                    alert_users = User.objects.only("email").filter(
-                                        pk__in=alert_users_pk
-                                    )
-                                else:
-                                    alert_users = rule.alert_users.only("email").all()
-
-                                for user in alert_users:
-                                    try:
-                                        email_dict[user.email] += ", " + pc.name
-                                    except KeyError:
-                                        email_dict[user.email] = pc.name
-
-                    for pcs in list(set(email_dict.values())):
-                        email_list = []
-                        for key, value in email_dict.items():
-                            if pcs == value:
-                                email_list.append(key)
-
-                        body = "Notification:\n"
-                        body += (
-                            f"The computer(s) {pcs} have been offline for longer than "
-                            f"{rule.maximum_offline_period} minutes"
-                        )
-                        try:
-                            message = EmailMessage(
-                                f"Notification rule: {rule.name}",
-                                body,
-                                to=email_list,
-                            )
-                            message.send(fail_silently=False)
-                        except Exception:  # Likely Exception: SMTPException
-                            logger.warning("Notification e-mail-sending failed:")
-                            logger.warning(traceback.format_exc())
+        Notification.objects.bulk_create(notifications)
@@ -1,5 +1,12 @@
 from django.core.management.base import BaseCommand
-from system.models import SecurityEvent, Citizen
+from system.models import (
+    AppointmentCache,
+    BatchTarget,
+    SecurityEvent,
+    Citizen,
+    SMSMessage,
+    Tombstone,
+)
 from datetime import datetime, timedelta
 
 
@@ -7,8 +14,11 @@ class Command(BaseCommand):
     help = "Remove old unnecessary database objects"
 
     def handle(self, *args, **options):
-        """Remove security events older than a year and citizens whose last successful login
-        was more than two days ago"""
+        """Remove security events older than a year, citizens whose last successful login
+        was more than two days ago, text messages older than two days, cached
+        appointments from before today and tombstones older than 30 days. Recount
+        the jobs pending from batch targets, create those of old targets and
+        delete the targets whose jobs have all been created"""
 
         now = datetime.now()
         a_year_ago = now - timedelta(days=365)
@@ -18,3 +28,11 @@ class Command(BaseCommand):
         SecurityEvent.objects.filter(reported_time__lt=a_year_ago).delete()
         # Delete old citizen objects
         Citizen.objects.filter(last_successful_login__lt=two_days_ago).delete()
+        # Delete cached appointments of past days
+        AppointmentCache.objects.filter(date__lt=now.date()).delete()
+        # Delete old text messages
+        SMSMessage.objects.filter(created__lt=two_days_ago).delete()
+        # Delete tombstones the changes API no longer needs to report
+        Tombstone.objects.filter(deleted__lt=now - timedelta(days=30)).delete()
+        # Recount and expire batch targets, deleting those with no jobs left
+        BatchTarget.clean_up(now)
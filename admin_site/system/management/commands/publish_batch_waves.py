@@ -0,0 +1,15 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+
+from system.models import BatchTarget
+
+
+class Command(BaseCommand):
+    help = "Tell waiting clients about jobs handed out by newly opened waves"
+
+    def handle(self, *args, **options):
+        """Wake the waiting clients of PCs whose batch has rolled out to them
+        in waves, but which haven't fetched their jobs yet. Meant to run every
+        minute, so a wave reaches waiting clients within a minute of opening."""
+        BatchTarget.publish_open_waves(datetime.now())
@@ -13,7 +13,6 @@ from system.models import (
     Site,
     Script,
     Batch,
-    Job,
     PCGroup,
     PC,
 )
@@ -29,6 +28,8 @@ class Command(BaseCommand):
     Only scripts without arguments are supported for now.
     Sites and Groups arguments take UID's while the PC argument takes ID's.
     The script does not validate that a given group, site or PC exists. In case one doesn't match, it's silently ignored.
+    With --wave-size, the jobs on each site are handed out to that many PCs at first and that many more every
+    --wave-interval minutes. With --halt-at, no more are handed out once that percentage of them have failed.
 
     Form:
             $ python manage.py run_maintenance_script <user_username> <script_uid_to_run> {--pcs <target_pc_ids...> | --groups <target_group_uids...>| --sites <target_site_uids...>}
@@ -37,6 +38,7 @@ class Command(BaseCommand):
         $ python manage.py run_maintenance_script shg 1 magenta --pcs 1 4
         $ python manage.py run_maintenance_script jabbi 3 magenta-test --groups group1
         $ python manage.py run_maintenance_script gitte 2 magenta --sites magenta mag test
+        $ python manage.py run_maintenance_script gitte 2 --sites magenta --wave-size 100 --wave-interval 15 --halt-at 10
 
 
     """
@@ -51,6 +53,22 @@ class Command(BaseCommand):
         parser.add_argument("--pcs", nargs="*", type=int, help="a list of pc uids")
         parser.add_argument("--sites", nargs="*", type=str, help="the uid of a site")
         parser.add_argument("--groups", nargs="*", type=str, help="the uid of a group")
+        parser.add_argument(
+            "--wave-size",
+            type=int,
+            help="hand out the jobs to this many pcs per site at a time",
+        )
+        parser.add_argument(
+            "--wave-interval",
+            type=int,
+            default=0,
+            help="minutes between each wave",
+        )
+        parser.add_argument(
+            "--halt-at",
+            type=int,
+            help="stop handing out jobs when this percentage of them have failed",
+        )
 
     @transaction.atomic
     def handle(self, *args, **options):
@@ -77,6 +95,8 @@ class Command(BaseCommand):
             pcs = PC.objects.filter(pc_groups__in=pc_groups)
         else:
             raise CommandError("--pcs, --site or --group needs to be given")
+        if options["wave_size"] and not options["wave_interval"]:
+            raise CommandError("--wave-interval needs to be given with --wave-size")
 
         site_pcs_dict = defaultdict(list)
         for pc in pcs.order_by("site"):
@@ -92,14 +112,25 @@ class Command(BaseCommand):
         confirmation = input()
         if confirmation in ["y", "Y"]:
             for site, pcs_list in site_pcs_dict.items():
-                batch = Batch.objects.create(site=site, script=script, name="")
-                for pc in pcs_list:
-                    Job.objects.create(user=user, batch=batch, pc=pc)
-                    self.stdout.write(
-                        self.style.SUCCESS(
-                            f"Maintenance job was created for pc: {pc}"
-                            f" for site: {site}"
-                        )
+                batch = Batch.objects.create(
+                    site=site,
+                    script=script,
+                    name="",
+                    wave_size=options["wave_size"],
+                    wave_interval=options["wave_interval"],
+                    halt_failure_percentage=options["halt_at"],
+                )
+                batch.add_jobs(pcs_list, user=user)
+                if batch.targets.exists():
+                    message = (
+                        f"Maintenance jobs for {len(pcs_list)} PCs on site: {site}"
+                        f" will be created as the PCs fetch them"
+                    )
+                else:
+                    message = (
+                        f"Maintenance jobs were created for {len(pcs_list)} PCs"
+                        f" on site: {site}"
                     )
+                self.stdout.write(self.style.SUCCESS(message))
         else:
             self.stdout.write(self.style.WARNING("Aborting"))
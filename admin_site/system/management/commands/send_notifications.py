@@ -0,0 +1,82 @@
+import logging
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min
+
+from system.models import Notification
+
+logger = logging.getLogger(__name__)
+
+# Give up on a notification after this many failed attempts at sending it.
+MAX_ATTEMPTS = 10
+
+
+class Command(BaseCommand):
+    help = "Send queued e-mail notifications"
+
+    def handle(self, *args, **options):
+        """Send the queued notifications, one e-mail per recipient and subject.
+        A group of notifications is only sent when the oldest of them has
+        waited NOTIFICATION_COALESCE_WINDOW seconds, so alerts arriving close
+        together end up in the same e-mail."""
+
+        cutoff = datetime.now() - timedelta(
+            seconds=settings.NOTIFICATION_COALESCE_WINDOW
+        )
+        groups = (
+            Notification.objects.values("recipient", "subject")
+            .annotate(first_created=Min("created"))
+            .filter(first_created__lte=cutoff)
+            .order_by("first_created")
+        )
+
+        # Don't connect to the SMTP server when there's nothing to send.
+        if not groups.exists():
+            return
+
+        # Reuse one SMTP connection for all the e-mails.
+        with get_connection() as connection:
+            for group in groups:
+                with transaction.atomic():
+                    # Skip notifications another run is busy sending.
+                    notifications = list(
+                        Notification.objects.select_for_update(skip_locked=True)
+                        .filter(recipient=group["recipient"], subject=group["subject"])
+                        .order_by("created", "pk")
+                    )
+                    if notifications:
+                        self.send(connection, notifications)
+
+    def send(self, connection, notifications):
+        recipient = notifications[0].recipient
+        subject = notifications[0].subject
+        message = EmailMessage(
+            subject,
+            "\n\n".join(notification.body for notification in notifications),
+            to=[recipient],
+            connection=connection,
+        )
+        try:
+            message.send(fail_silently=False)
+        except Exception:  # Likely Exception: SMTPException
+            logger.exception("Notification e-mail-sending failed:")
+            attempts = max(notification.attempts for notification in notifications) + 1
+            pks = [notification.pk for notification in notifications]
+            if attempts < MAX_ATTEMPTS:
+                Notification.objects.filter(pk__in=pks).update(attempts=attempts)
+            else:
+                logger.error(
+                    "Giving up on %s notifications to %s after %s attempts",
+                    len(pks),
+                    recipient,
+                    attempts,
+                )
+                Notification.objects.filter(pk__in=pks).delete()
+        else:
+            Notification.objects.filter(
+                pk__in=[notification.pk for notification in notifications]
+            ).delete()
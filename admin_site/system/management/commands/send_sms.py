@@ -0,0 +1,109 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+import requests
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection, transaction
+
+from system.integrations import SMSTeknikClient
+from system.models import SMSMessage
+
+logger = logging.getLogger(__name__)
+
+# Give up on a message after this many failed attempts at sending it.
+MAX_ATTEMPTS = 5
+# Seconds to wait before the first retry, doubled for every further retry.
+RETRY_DELAY = 5
+# Seconds a worker thread waits before checking an empty queue again.
+POLL_INTERVAL = 1
+
+
+class Command(BaseCommand):
+    help = "Send queued text messages"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--worker",
+            action="store_true",
+            help="Keep running and send messages as they are queued",
+        )
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=4,
+            help="Number of messages to send at the same time with --worker",
+        )
+
+    def handle(self, *args, **options):
+        """Send the queued text messages that are due. Messages that fail
+        because SMSTeknik can't be reached are retried with increasing delays.
+        Several workers may run at once, each message is sent by one of them."""
+
+        if not options["worker"]:
+            while self.send_next():
+                pass
+            return
+
+        threads = [
+            threading.Thread(target=self.work, daemon=True)
+            for _ in range(max(1, options["threads"]))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def work(self):
+        try:
+            while True:
+                close_old_connections()
+                try:
+                    sent = self.send_next()
+                except Exception:
+                    logger.exception("Sending a text message failed:")
+                    sent = False
+                if not sent:
+                    time.sleep(POLL_INTERVAL)
+        finally:
+            connection.close()
+
+    def send_next(self):
+        """Send the next due message. Returns False if there was none."""
+        with transaction.atomic():
+            # Skip messages another worker is busy sending.
+            sms = (
+                SMSMessage.objects.select_for_update(skip_locked=True, of=("self",))
+                .select_related("site")
+                .filter(status=SMSMessage.QUEUED, next_attempt__lte=datetime.now())
+                .order_by("next_attempt", "pk")
+                .first()
+            )
+            if sms is None:
+                return False
+
+            sms.attempts += 1
+            try:
+                sent = SMSTeknikClient(sms.site).send(sms.phone_number, sms.message)
+            # Likely Exceptions: ConnectionError, Timeout, HTTPError, ServiceUnavailable
+            except requests.RequestException:
+                logger.exception("Sending a text message failed:")
+                if sms.attempts < MAX_ATTEMPTS:
+                    sms.next_attempt = datetime.now() + timedelta(
+                        seconds=RETRY_DELAY * 2 ** (sms.attempts - 1)
+                    )
+                    sms.save(update_fields=["attempts", "next_attempt"])
+                    return True
+                logger.error(
+                    "Giving up on a text message to %s after %s attempts",
+                    sms.phone_number,
+                    sms.attempts,
+                )
+                sent = False
+
+            sms.status = SMSMessage.SENT if sent else SMSMessage.FAILED
+            sms.message = ""
+            sms.finished = datetime.now()
+            sms.save(update_fields=["attempts", "status", "message", "finished"])
+        return True
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import connections, models
 
 
 class SecurityEventQuerySet(models.QuerySet):
@@ -20,3 +20,129 @@ class SecurityEventQuerySet(models.QuerySet):
                 .exclude(status=SecurityEvent.RESOLVED)
             )
         )
+
+
+class CitizenQuerySet(models.QuerySet):
+    """The Citizen quarantine system.
+
+    A citizen may be logged in for login_duration after their last successful
+    login, after which they're quarantined for quarantine_duration. Each login
+    updates the citizen's state with a single INSERT ... ON CONFLICT DO UPDATE,
+    which locks the row, so logins on two computers at once are handled one
+    after the other."""
+
+    LOGIN_SQL = """
+        INSERT INTO {table} AS c
+            (citizen_id, last_successful_login, site_id, logged_in)
+        VALUES (%(citizen_id)s, %(now)s, %(site_id)s, %(true)s)
+        ON CONFLICT (citizen_id) DO UPDATE SET
+            last_successful_login = CASE
+                WHEN c.last_successful_login <= %(period_over)s THEN %(now)s
+                ELSE c.last_successful_login
+            END,
+            logged_in = c.logged_in OR %(mark_logged_in)s
+        WHERE {condition}
+        RETURNING id, last_successful_login, logged_in
+    """
+
+    # Still within the login period, and not logged in elsewhere, or the
+    # quarantine is over.
+    STANDARD_CONDITION = (
+        "(c.last_successful_login > %(period_start)s AND NOT c.logged_in)"
+        " OR c.last_successful_login <= %(period_over)s"
+    )
+    # Idle logins have already been allowed by the booking system.
+    IDLE_CONDITION = "TRUE"
+
+    def _upsert(
+        self,
+        condition,
+        citizen_id,
+        site,
+        now,
+        login_duration,
+        quarantine_duration,
+        mark_logged_in=True,
+    ):
+        connection = connections[self.db]
+        adapt = connection.ops.adapt_datetimefield_value
+        sql = self.LOGIN_SQL.format(
+            table=connection.ops.quote_name(self.model._meta.db_table),
+            condition=condition,
+        )
+        period_start = now - login_duration
+        params = {
+            "citizen_id": citizen_id,
+            "site_id": site.pk,
+            "now": adapt(now),
+            "period_start": adapt(period_start),
+            "period_over": adapt(period_start - quarantine_duration),
+            "mark_logged_in": mark_logged_in,
+            "true": True,
+        }
+        return next(iter(self.model.objects.using(self.db).raw(sql, params)), None)
+
+    def log_in(
+        self,
+        citizen_id,
+        site,
+        now,
+        login_duration,
+        quarantine_duration,
+        mark_logged_in=True,
+    ):
+        """Start or continue a citizen's login period if they're not quarantined
+        or logged in elsewhere. Returns a (status, minutes) tuple:
+
+            ("allowed", minutes): The citizen may log in for minutes minutes.
+            ("logged_in", None): The citizen is logged in elsewhere.
+            ("quarantine", -minutes): The citizen is quarantined for another
+                                      minutes minutes.
+
+        If mark_logged_in is false, a citizen seen before isn't marked as logged
+        in, so they aren't kept from logging in elsewhere. A first login always
+        marks them."""
+        citizen = self._upsert(
+            self.STANDARD_CONDITION,
+            citizen_id,
+            site,
+            now,
+            login_duration,
+            quarantine_duration,
+            mark_logged_in,
+        )
+        if citizen is None:
+            # The condition didn't hold, so nothing was changed.
+            citizen = self.get(citizen_id=citizen_id)
+            quarantined_from = citizen.last_successful_login + login_duration
+            if now < quarantined_from:
+                return "logged_in", None
+            return (
+                "quarantine",
+                (
+                    (now - quarantined_from).total_seconds()
+                    - quarantine_duration.total_seconds()
+                )
+                // 60,
+            )
+
+        minutes = login_duration.total_seconds() // 60
+        if citizen.last_successful_login != now:
+            # Continuing the current login period.
+            minutes -= (now - citizen.last_successful_login).total_seconds() // 60
+        return "allowed", minutes
+
+    def log_in_idle(self, citizen_id, site, now, login_duration, quarantine_duration):
+        """Mark a citizen allowed an idle login by the booking system as logged
+        in, starting a new login period if their quarantine is over."""
+        self._upsert(
+            self.IDLE_CONDITION,
+            citizen_id,
+            site,
+            now,
+            login_duration,
+            quarantine_duration,
+        )
+
+    def log_out(self, citizen_id):
+        self.filter(citizen_id=citizen_id).update(logged_in=False)
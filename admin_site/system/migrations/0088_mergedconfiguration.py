@@ -0,0 +1,36 @@
+# Generated by Django 4.2.11 on 2026-10-18 09:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_merged_configurations(apps, schema_editor):
+    # Rows start out stale and are filled in on first use. They must exist up
+    # front, though, so that invalidation can bump their version.
+    PC = apps.get_model("system", "PC")
+    MergedConfiguration = apps.get_model("system", "MergedConfiguration")
+
+    MergedConfiguration.objects.bulk_create(
+        (MergedConfiguration(pc_id=pc_id) for pc_id in PC.objects.values_list("pk", flat=True)),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('system', '0087_alter_script_executable_code'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MergedConfiguration',
+            fields=[
+                ('pc', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='merged_configuration', serialize=False, to='system.pc')),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('data', models.JSONField(blank=True, null=True)),
+                ('digest', models.CharField(blank=True, max_length=64)),
+            ],
+        ),
+        migrations.RunPython(create_merged_configurations, migrations.RunPython.noop),
+    ]
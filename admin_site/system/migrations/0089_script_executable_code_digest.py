@@ -0,0 +1,18 @@
+# Generated by Django 4.2.11 on 2026-10-18 09:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('system', '0088_mergedconfiguration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='script',
+            name='executable_code_digest',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+    ]
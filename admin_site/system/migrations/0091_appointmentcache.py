@@ -0,0 +1,28 @@
+# Generated by Django 4.2.11 on 2026-10-18 09:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('system', '0090_notification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppointmentCache',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('appointments', models.JSONField(null=True)),
+                ('fetched', models.DateTimeField(null=True)),
+                ('site', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='system.site')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='appointmentcache',
+            constraint=models.UniqueConstraint(fields=('site', 'date'), name='unique_appointment_cache_per_day'),
+        ),
+    ]
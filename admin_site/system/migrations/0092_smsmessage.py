@@ -0,0 +1,32 @@
+# Generated by Django 4.2.11 on 2026-10-18 09:54
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('system', '0091_appointmentcache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SMSMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('phone_number', models.CharField(max_length=32)),
+                ('message', models.TextField(blank=True)),
+                ('status', models.CharField(choices=[('QUEUED', 'Queued'), ('SENT', 'Sent'), ('FAILED', 'Failed')], default='QUEUED', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('next_attempt', models.DateTimeField(default=datetime.datetime.now)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('site', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='system.site')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'next_attempt'], name='system_smsm_status_d13ed1_idx'), models.Index(fields=['site', 'phone_number'], name='system_smsm_site_id_6bd263_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 4.2.11 on 2026-10-18 10:00
+
+import datetime
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_login_counts(apps, schema_editor):
+    # Same parsing as LoginCount.parse, which isn't available on the
+    # historical model.
+    PC = apps.get_model("system", "PC")
+    LoginCount = apps.get_model("system", "LoginCount")
+
+    pcs = PC.objects.filter(configuration__entries__key="login_counts").values_list(
+        "pk", "configuration__entries__value"
+    )
+    counts = []
+    for pc_id, value in pcs.iterator():
+        days = {}
+        for item in (value or "").split(","):
+            try:
+                day, count = item.replace(" ", "").split(":")
+                days[datetime.datetime.strptime(day, "%Y-%m-%d").date()] = int(count)
+            except ValueError:
+                continue
+        counts.extend(
+            LoginCount(pc_id=pc_id, date=day, count=count)
+            for day, count in days.items()
+            if count >= 0
+        )
+    LoginCount.objects.bulk_create(counts, batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('system', '0092_smsmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoginCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('count', models.PositiveIntegerField()),
+                ('pc', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='login_counts', to='system.pc')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='logincount',
+            constraint=models.UniqueConstraint(fields=('pc', 'date'), name='unique_login_count_per_day'),
+        ),
+        migrations.RunPython(create_login_counts, migrations.RunPython.noop),
+    ]
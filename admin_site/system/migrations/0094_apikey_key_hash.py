@@ -0,0 +1,35 @@
+# Generated by Django 4.2.11 on 2026-10-18 10:08
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_api_keys(apps, schema_editor):
+    APIKey = apps.get_model("system", "APIKey")
+
+    api_keys = list(APIKey.objects.all())
+    for api_key in api_keys:
+        api_key.key_hash = hashlib.sha256(api_key.key.encode("utf-8")).hexdigest()
+    APIKey.objects.bulk_update(api_keys, ["key_hash"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('system', '0093_logincount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='apikey',
+            name='key_hash',
+            field=models.CharField(editable=False, max_length=64, null=True),
+        ),
+        migrations.RunPython(hash_api_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='apikey',
+            name='key_hash',
+            field=models.CharField(editable=False, max_length=64, unique=True),
+        ),
+    ]
@@ -0,0 +1,162 @@
+# Generated by Django 4.2.11 on 2026-10-18 10:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Must match SYNC_LOCK in system/changes.py.
+SYNC_LOCK = 5318008
+
+
+def create_triggers(apps, schema_editor):
+    # The changes API relies on PostgreSQL, other databases go without.
+    if schema_editor.connection.vendor != "postgresql":
+        return
+
+    def table(model_name):
+        return schema_editor.quote_name(
+            apps.get_model("system", model_name)._meta.db_table
+        )
+
+    pc = table("PC")
+    job = table("Job")
+    event = table("SecurityEvent")
+    batch = table("Batch")
+    problem = table("SecurityProblem")
+    rule = table("EventRuleServer")
+    tombstone = table("Tombstone")
+    pc_groups = schema_editor.quote_name(
+        apps.get_model("system", "PC").pc_groups.through._meta.db_table
+    )
+
+    schema_editor.execute("CREATE SEQUENCE system_sync_version")
+    # Every transaction handing out versions holds SYNC_LOCK shared until it
+    # commits, so the changes API can wait for them to finish.
+    schema_editor.execute(
+        f"""
+        CREATE FUNCTION system_next_sync_version() RETURNS bigint AS $$
+        BEGIN
+            PERFORM pg_advisory_xact_lock_shared({SYNC_LOCK});
+            RETURN nextval('system_sync_version');
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    schema_editor.execute(
+        """
+        CREATE FUNCTION system_set_sync_version() RETURNS trigger AS $$
+        BEGIN
+            NEW.sync_version := system_next_sync_version();
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    for name, tbl in (("pc", pc), ("job", job), ("securityevent", event)):
+        # Give the existing rows a version.
+        schema_editor.execute(
+            f"UPDATE {tbl} SET sync_version = system_next_sync_version()"
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER system_{name}_sync_version "
+            f"BEFORE INSERT OR UPDATE ON {tbl} "
+            f"FOR EACH ROW EXECUTE FUNCTION system_set_sync_version()"
+        )
+
+    # Group membership is part of a computer. Touching the computer is enough,
+    # its trigger sets the new version.
+    schema_editor.execute(
+        f"""
+        CREATE FUNCTION system_pc_groups_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                UPDATE {pc} SET sync_version = 0 WHERE id = OLD.pc_id;
+                RETURN OLD;
+            END IF;
+            UPDATE {pc} SET sync_version = 0 WHERE id = NEW.pc_id;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    schema_editor.execute(
+        f"CREATE TRIGGER system_pc_groups_sync_version "
+        f"AFTER INSERT OR DELETE ON {pc_groups} "
+        f"FOR EACH ROW EXECUTE FUNCTION system_pc_groups_changed()"
+    )
+
+    # Deletions leave a tombstone behind.
+    for name, tbl, model, site in (
+        ("pc", pc, "computer", "OLD.site_id"),
+        ("job", job, "job", f"(SELECT site_id FROM {batch} WHERE id = OLD.batch_id)"),
+        (
+            "securityevent",
+            event,
+            "event",
+            f"COALESCE((SELECT site_id FROM {problem} WHERE id = OLD.problem_id), "
+            f"(SELECT site_id FROM {rule} WHERE id = OLD.event_rule_server_id))",
+        ),
+    ):
+        schema_editor.execute(
+            f"""
+            CREATE FUNCTION system_{name}_tombstone() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO {tombstone} (model, object_id, site_id, sync_version, deleted)
+                VALUES ('{model}', OLD.id, {site}, system_next_sync_version(), LOCALTIMESTAMP);
+                RETURN OLD;
+            END
+            $$ LANGUAGE plpgsql
+            """
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER system_{name}_tombstone "
+            f"AFTER DELETE ON {tbl} "
+            f"FOR EACH ROW EXECUTE FUNCTION system_{name}_tombstone()"
+        )
+
+
+def drop_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for name in ("pc", "job", "securityevent"):
+        schema_editor.execute(f"DROP FUNCTION system_{name}_tombstone() CASCADE")
+    schema_editor.execute("DROP FUNCTION system_pc_groups_changed() CASCADE")
+    schema_editor.execute("DROP FUNCTION system_set_sync_version() CASCADE")
+    schema_editor.execute("DROP FUNCTION system_next_sync_version()")
+    schema_editor.execute("DROP SEQUENCE system_sync_version")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('system', '0094_apikey_key_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='sync_version',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='pc',
+            name='sync_version',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='securityevent',
+            name='sync_version',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(choices=[('computer', 'Computer'), ('job', 'Job'), ('event', 'Event')], max_length=10)),
+                ('object_id', models.IntegerField()),
+                ('sync_version', models.BigIntegerField(db_index=True)),
+                ('deleted', models.DateTimeField(auto_now_add=True)),
+                ('site', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='system.site')),
+            ],
+        ),
+        migrations.RunPython(create_triggers, drop_triggers),
+    ]
@@ -0,0 +1,89 @@
+# Generated by Django 4.2.11 on 2026-10-18 10:15
+
+import django.core.validators
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def count_jobs(apps, schema_editor):
+    Batch = apps.get_model("system", "Batch")
+    Job = apps.get_model("system", "Job")
+    BatchTarget = apps.get_model("system", "BatchTarget")
+
+    def count(condition=Q()):
+        jobs = (
+            Job.objects.filter(condition, batch=OuterRef("pk"))
+            .order_by()
+            .values("batch")
+            .annotate(count=Count("pk"))
+            .values("count")
+        )
+        return Coalesce(Subquery(jobs, output_field=IntegerField()), 0)
+
+    # Jobs still to be created from batch targets count towards the total.
+    pending = (
+        BatchTarget.objects.filter(batch=OuterRef("pk"))
+        .order_by()
+        .values("batch")
+        .annotate(pending=Sum("pending"))
+        .values("pending")
+    )
+    Batch.objects.update(
+        jobs_total=count()
+        + Coalesce(Subquery(pending, output_field=IntegerField()), 0),
+        jobs_submitted=count(~Q(status="NEW")),
+        jobs_done=count(Q(status="DONE")),
+        jobs_failed=count(Q(status="FAILED")),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('system', '0096_batchtarget'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='batch',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, null=True, verbose_name='created'),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='halt_failure_percentage',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, validators=[django.core.validators.MaxValueValidator(100)], verbose_name='halt at failure percentage'),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='jobs_done',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='jobs_failed',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='jobs_submitted',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='jobs_total',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='wave_interval',
+            field=models.PositiveIntegerField(default=0, verbose_name='minutes between waves'),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='wave_size',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='wave size'),
+        ),
+        migrations.RunPython(count_jobs, migrations.RunPython.noop),
+    ]
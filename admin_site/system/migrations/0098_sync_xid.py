@@ -0,0 +1,154 @@
+# Generated by Django 4.2.11 on 2026-10-18 10:40
+
+from django.db import migrations, models
+
+# Only used to restore the functions of 0095_sync_version when migrating back.
+SYNC_LOCK = 5318008
+
+
+def tombstone_sites(table):
+    return (
+        ("pc", "computer", "OLD.site_id"),
+        ("job", "job", f"(SELECT site_id FROM {table('Batch')} WHERE id = OLD.batch_id)"),
+        (
+            "securityevent",
+            "event",
+            f"COALESCE((SELECT site_id FROM {table('SecurityProblem')} "
+            f"WHERE id = OLD.problem_id), (SELECT site_id FROM "
+            f"{table('EventRuleServer')} WHERE id = OLD.event_rule_server_id))",
+        ),
+    )
+
+
+def get_table(apps, schema_editor):
+    def table(model_name):
+        return schema_editor.quote_name(
+            apps.get_model("system", model_name)._meta.db_table
+        )
+
+    return table
+
+
+def replace_functions(apps, schema_editor):
+    # The changes API relies on PostgreSQL, other databases go without.
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    table = get_table(apps, schema_editor)
+
+    # Versions are no longer guarded by a lock, the changes API instead only
+    # goes as far as the oldest transaction still running, see
+    # system/changes.py.
+    schema_editor.execute(
+        """
+        CREATE OR REPLACE FUNCTION system_next_sync_version() RETURNS bigint AS $$
+        BEGIN
+            RETURN nextval('system_sync_version');
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    # Updates that only move last_seen, or change nothing at all, keep the
+    # version they had. Otherwise the heartbeat flush would have every
+    # computer sent again on every sync.
+    schema_editor.execute(
+        """
+        CREATE OR REPLACE FUNCTION system_set_sync_version() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE' AND to_jsonb(NEW) - 'last_seen' - 'sync_xid'
+                    = to_jsonb(OLD) - 'last_seen' - 'sync_xid' THEN
+                NEW.sync_xid := OLD.sync_xid;
+                RETURN NEW;
+            END IF;
+            NEW.sync_version := system_next_sync_version();
+            NEW.sync_xid := pg_current_xact_id()::text::bigint;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    for name, model, site in tombstone_sites(table):
+        schema_editor.execute(
+            f"""
+            CREATE OR REPLACE FUNCTION system_{name}_tombstone() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO {table('Tombstone')}
+                    (model, object_id, site_id, sync_version, sync_xid, deleted)
+                VALUES (
+                    '{model}', OLD.id, {site}, system_next_sync_version(),
+                    pg_current_xact_id()::text::bigint, LOCALTIMESTAMP
+                );
+                RETURN OLD;
+            END
+            $$ LANGUAGE plpgsql
+            """
+        )
+
+
+def restore_functions(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    table = get_table(apps, schema_editor)
+
+    schema_editor.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION system_next_sync_version() RETURNS bigint AS $$
+        BEGIN
+            PERFORM pg_advisory_xact_lock_shared({SYNC_LOCK});
+            RETURN nextval('system_sync_version');
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    schema_editor.execute(
+        """
+        CREATE OR REPLACE FUNCTION system_set_sync_version() RETURNS trigger AS $$
+        BEGIN
+            NEW.sync_version := system_next_sync_version();
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    for name, model, site in tombstone_sites(table):
+        schema_editor.execute(
+            f"""
+            CREATE OR REPLACE FUNCTION system_{name}_tombstone() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO {table('Tombstone')} (model, object_id, site_id, sync_version, deleted)
+                VALUES ('{model}', OLD.id, {site}, system_next_sync_version(), LOCALTIMESTAMP);
+                RETURN OLD;
+            END
+            $$ LANGUAGE plpgsql
+            """
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('system', '0097_batch_rollout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='sync_xid',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='pc',
+            name='sync_xid',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='securityevent',
+            name='sync_xid',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='tombstone',
+            name='sync_xid',
+            field=models.BigIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(replace_functions, restore_functions),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.2.11 on 2026-10-18 10:45
+
+from django.db import migrations
+
+
+def clear_appointment_cache(apps, schema_editor):
+    # The cached appointments used to include the citizens' whole customer
+    # records. They're fetched again on the next login.
+    apps.get_model("system", "AppointmentCache").objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('system', '0098_sync_xid'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_appointment_cache, migrations.RunPython.noop),
+    ]
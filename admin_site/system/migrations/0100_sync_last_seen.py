@@ -0,0 +1,61 @@
+# Generated by Django 4.2.11 on 2026-10-18 10:50
+
+from django.db import migrations
+
+# Seconds, must match LAST_SEEN_STEP in system/changes.py.
+LAST_SEEN_STEP = 300
+
+
+def set_sync_version(keep_version):
+    return f"""
+        CREATE OR REPLACE FUNCTION system_set_sync_version() RETURNS trigger AS $$
+        DECLARE
+            -- Read as JSON, as only computers have a last_seen.
+            old_seen timestamp := (to_jsonb(OLD) ->> 'last_seen')::timestamp;
+            new_seen timestamp := (to_jsonb(NEW) ->> 'last_seen')::timestamp;
+        BEGIN
+            IF TG_OP = 'UPDATE' AND to_jsonb(NEW) - 'last_seen' - 'sync_xid'
+                    = to_jsonb(OLD) - 'last_seen' - 'sync_xid'
+                    AND ({keep_version}) THEN
+                NEW.sync_xid := OLD.sync_xid;
+                RETURN NEW;
+            END IF;
+            NEW.sync_version := system_next_sync_version();
+            NEW.sync_xid := pg_current_xact_id()::text::bigint;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """
+
+
+def step_last_seen(apps, schema_editor):
+    # The changes API relies on PostgreSQL, other databases go without.
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    # Moving last_seen only counts as a change when it moves into another
+    # period of LAST_SEEN_STEP seconds, so the heartbeat flush has a computer
+    # that stays online sent again once per period rather than on every sync.
+    schema_editor.execute(
+        set_sync_version(
+            f"new_seen IS NOT DISTINCT FROM old_seen "
+            f"OR floor(extract(epoch FROM new_seen) / {LAST_SEEN_STEP}) "
+            f"= floor(extract(epoch FROM old_seen) / {LAST_SEEN_STEP})"
+        )
+    )
+
+
+def ignore_last_seen(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute(set_sync_version("TRUE"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('system', '0099_clear_appointment_cache'),
+    ]
+
+    operations = [
+        migrations.RunPython(step_last_seen, ignore_last_seen),
+    ]
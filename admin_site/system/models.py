@@ -1,18 +1,31 @@
+import bisect
 import datetime
+import hashlib
+import json
 import random
 import re
 import string
+import time
 
+from django.conf import settings
 from django.db import models, transaction
-from django.db.models import Q
+from django.db.models import Case, F, Q, Value, When
 from django.utils.translation import gettext_lazy as _
 from django.utils import timezone
 from django.contrib.auth.models import User
 from django.urls import reverse
-from django.core.validators import MinValueValidator, RegexValidator
-
+from django.core.exceptions import ValidationError
+from django.core.validators import MaxValueValidator, MinValueValidator, RegexValidator
+
+from system import heartbeat, push
+from system.caches import (
+    api_key_cache,
+    batch_parameters_cache,
+    batch_target_pcs_cache,
+    script_code_cache,
+)
 from system.mixins import AuditModelMixin
-from system.managers import SecurityEventQuerySet
+from system.managers import CitizenQuerySet, SecurityEventQuerySet
 
 """The following variables define states of objects like jobs or PCs. It is
 used for labeling in the GUI."""
@@ -725,14 +738,18 @@ class PC(models.Model):
     location = models.CharField(
         verbose_name=_("location"), max_length=1024, blank=True, default=""
     )
+    # Set by a database trigger on every change, see system/changes.py.
+    sync_version = models.BigIntegerField(default=0, editable=False, db_index=True)
+    sync_xid = models.BigIntegerField(default=0, editable=False, db_index=True)
 
     @property
     def online(self):
         """A PC being online is defined as last seen less than 5 minutes ago."""
-        if not self.last_seen:
+        last_seen = heartbeat.last_seen(self)
+        if not last_seen:
             return False
         now = timezone.now()
-        return self.last_seen >= now - datetime.timedelta(minutes=5)
+        return last_seen >= now - datetime.timedelta(minutes=5)
 
     class Status:
         """This class represents the status of af PC. We may want to do
@@ -763,25 +780,44 @@ class PC(models.Model):
         return configs
 
     def get_config_value(self, key, default=None):
-        value = default
-        configs = self.get_list_of_configurations()
-        for conf in configs:
-            try:
-                entry = conf.entries.get(key=key)
-                value = entry.value
-            except ConfigurationEntry.DoesNotExist:
-                pass
-        return value
+        return MergedConfiguration.get_for_pc(self).data.get(key, default)
 
     def get_full_config(self):
+        return MergedConfiguration.get_for_pc(self).full_config
+
+    def get_configuration_ids(self):
+        """Return the ids of the site's, the groups' and the PC's own
+        configuration, in that order. Uses prefetched groups if any."""
+        configuration_ids = [self.site.configuration_id]
+        configuration_ids.extend(g.configuration_id for g in self.pc_groups.all())
+        configuration_ids.append(self.configuration_id)
+        return configuration_ids
+
+    @staticmethod
+    def get_entries_by_configuration(configuration_ids):
+        entries_by_configuration = {}
+        for entry in ConfigurationEntry.objects.filter(
+            owner_configuration_id__in=configuration_ids
+        ):
+            entries_by_configuration.setdefault(
+                entry.owner_configuration_id, []
+            ).append(entry)
+        return entries_by_configuration
+
+    def merge_configurations(self, entries_by_configuration=None):
+        """Merge the site's, the groups' and the PC's own configuration
+        entries, in that order, directly from the database. The entries by
+        configuration id may be given when merging for many PCs at once."""
+        configuration_ids = self.get_configuration_ids()
+        if entries_by_configuration is None:
+            entries_by_configuration = self.get_entries_by_configuration(
+                configuration_ids
+            )
+
         result = {}
-        configs = self.get_list_of_configurations()
-        for conf in configs:
-            for entry in conf.entries.all():
+        for configuration_id in configuration_ids:
+            for entry in entries_by_configuration.get(configuration_id, []):
                 result[entry.key] = entry.value
-        if "mac" not in result.keys():
-            result["mac"] = self.mac
-        result["uid"] = self.uid
         return result
 
     def get_merged_config_list(self, key, default=None):
@@ -817,6 +853,182 @@ class PC(models.Model):
         ordering = ["name"]
 
 
+class MergedConfiguration(models.Model):
+    """The effective configuration of a PC, i.e. the entries of its site's,
+    groups' and own configuration merged in that order.
+
+    This is a cache: any change that may affect the result bumps version and
+    clears data, and the next reader rebuilds it. A rebuild is only stored if
+    version hasn't moved in the meantime, so a concurrent change can't be
+    overwritten by a stale result."""
+
+    pc = models.OneToOneField(
+        PC,
+        primary_key=True,
+        related_name="merged_configuration",
+        on_delete=models.CASCADE,
+    )
+    version = models.PositiveIntegerField(default=0)
+    data = models.JSONField(null=True, blank=True)
+    # Digest of full_config, lets clients tell whether anything has changed.
+    digest = models.CharField(max_length=64, blank=True)
+
+    # Number of PCs whose merged configurations are rebuilt per statement.
+    REBUILD_CHUNK_SIZE = 500
+
+    @classmethod
+    def get_for_pc(cls, pc):
+        try:
+            merged = pc.merged_configuration
+        except cls.DoesNotExist:
+            merged, _ = cls.objects.get_or_create(pc=pc)
+            pc.merged_configuration = merged
+        if merged.data is None:
+            merged.rebuild()
+        return merged
+
+    @classmethod
+    def invalidate(cls, pcs=None, configuration_id=None):
+        """Mark the merged configuration of the given PCs as stale, or of all
+        PCs whose merged configuration includes the given configuration."""
+        if configuration_id is not None:
+            pcs = PC.objects.filter(
+                Q(configuration_id=configuration_id)
+                | Q(pc_groups__configuration_id=configuration_id)
+                | Q(site__configuration_id=configuration_id)
+            )
+        pc_ids = set(cls.objects.filter(pc__in=pcs).values_list("pc_id", flat=True))
+        push.publish(pc_ids)
+        return cls.objects.filter(pc__in=pc_ids).update(
+            data=None, version=F("version") + 1
+        )
+
+    def rebuild(self):
+        version = self.version
+        self._set_data(self.pc.merge_configurations())
+        MergedConfiguration.objects.filter(pc_id=self.pc_id, version=version).update(
+            data=self.data, digest=self.digest
+        )
+
+    def _set_data(self, data):
+        self.data = data
+        self.digest = hashlib.sha256(
+            json.dumps(self.full_config, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    @classmethod
+    def rebuild_stale(cls, pcs):
+        """Rebuild the stale merged configurations of the given PCs, which
+        should come with their site, merged configuration and groups. The
+        entries are fetched and the results stored a chunk of PCs at a time
+        rather than one PC at a time."""
+        stale = []
+        for pc in pcs:
+            merged = getattr(pc, "merged_configuration", None)
+            if merged is not None and merged.data is None:
+                stale.append(merged)
+
+        for start in range(0, len(stale), cls.REBUILD_CHUNK_SIZE):
+            chunk = stale[start : start + cls.REBUILD_CHUNK_SIZE]
+            entries_by_configuration = PC.get_entries_by_configuration(
+                {
+                    configuration_id
+                    for merged in chunk
+                    for configuration_id in merged.pc.get_configuration_ids()
+                }
+            )
+            for merged in chunk:
+                merged._set_data(
+                    merged.pc.merge_configurations(entries_by_configuration)
+                )
+            # As in rebuild, only store results whose version hasn't moved.
+            cls.objects.filter(pc_id__in=[merged.pc_id for merged in chunk]).update(
+                data=Case(
+                    *(
+                        When(
+                            pc_id=merged.pc_id,
+                            version=merged.version,
+                            then=Value(merged.data, models.JSONField()),
+                        )
+                        for merged in chunk
+                    ),
+                    default=F("data"),
+                ),
+                digest=Case(
+                    *(
+                        When(
+                            pc_id=merged.pc_id,
+                            version=merged.version,
+                            then=Value(merged.digest),
+                        )
+                        for merged in chunk
+                    ),
+                    default=F("digest"),
+                ),
+            )
+
+    @property
+    def full_config(self):
+        """The configuration as sent to the client."""
+        result = dict(self.data)
+        if "mac" not in result.keys():
+            result["mac"] = self.pc.mac
+        result["uid"] = self.pc.uid
+        return result
+
+    def __str__(self):
+        return f"{self.pc} ({self.version})"
+
+
+class LoginCount(models.Model):
+    """The number of citizen logins on a PC on a day, as reported by the PC
+    in its login_counts configuration entry."""
+
+    pc = models.ForeignKey(PC, related_name="login_counts", on_delete=models.CASCADE)
+    date = models.DateField()
+    count = models.PositiveIntegerField()
+
+    def __str__(self):
+        return f"{self.pc} - {self.date}: {self.count}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["pc", "date"], name="unique_login_count_per_day"
+            ),
+        ]
+
+    @staticmethod
+    def parse(value):
+        """Parse a login_counts value like "2023-10-10: 4, 2023-10-11: 3" into
+        a dict of counts by date, skipping anything malformed."""
+        counts = {}
+        for item in (value or "").split(","):
+            try:
+                day, count = item.replace(" ", "").split(":")
+                counts[datetime.datetime.strptime(day, "%Y-%m-%d").date()] = int(count)
+            except ValueError:
+                continue
+        return counts
+
+    @classmethod
+    def store(cls, pc, value, previous_value=None):
+        """Store the counts in a PC's new login_counts value, writing only
+        those that differ from its previous value."""
+        previous = cls.parse(previous_value)
+        changed = [
+            cls(pc=pc, date=day, count=count)
+            for day, count in cls.parse(value).items()
+            if previous.get(day) != count and count >= 0
+        ]
+        cls.objects.bulk_create(
+            changed,
+            update_conflicts=True,
+            unique_fields=["pc", "date"],
+            update_fields=["count"],
+        )
+
+
 class ScriptTag(models.Model):
     """A tag model for scripts."""
 
@@ -860,6 +1072,9 @@ class Script(AuditModelMixin):
     executable_code = models.FileField(
         verbose_name=_("executable code"), upload_to="script_uploads", max_length=255
     )
+    # SHA-256 of executable_code, set whenever a new file is uploaded. Scripts
+    # uploaded before this was introduced get it the first time they're read.
+    executable_code_digest = models.CharField(max_length=64, blank=True, editable=False)
     is_security_script = models.BooleanField(
         verbose_name=_("security script"), default=False, null=False
     )
@@ -892,35 +1107,84 @@ class Script(AuditModelMixin):
     def __str__(self):
         return self.name
 
-    def run_on(self, site, pc_list, *args, user):
-        batch = Batch(site=site, script=self, name="")
-        batch.save()
-
-        parameter_values = "["
+    def save(self, *args, **kwargs):
+        code = self.executable_code
+        old_name = None
+        if self.pk:
+            old_name = (
+                Script.objects.filter(pk=self.pk)
+                .values_list("executable_code", flat=True)
+                .first()
+            )
+        if code and (
+            not code._committed
+            or code.name != old_name
+            or not self.executable_code_digest
+        ):
+            # A new file has been uploaded - forget the old one and hash the
+            # new one, before it's written to storage if it hasn't been yet.
+            if old_name:
+                script_code_cache.discard_matching(lambda key: key[0] == old_name)
+            self.executable_code_digest = self._hash_executable_code()
+        super().save(*args, **kwargs)
+
+    def _hash_executable_code(self):
+        digest = hashlib.sha256()
+        for chunk in self.executable_code.chunks():
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    def read_executable_code(self):
+        """Return the script's code as text, from the script code cache if
+        possible."""
+        name = self.executable_code.name
+        code = script_code_cache.get((name, self.executable_code_digest))
+        if code is not None:
+            return code
+
+        with self.executable_code.open("rb") as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if digest != self.executable_code_digest:
+            # Either not hashed yet or the file was replaced behind our back.
+            self.executable_code_digest = digest
+            Script.objects.filter(pk=self.pk).update(executable_code_digest=digest)
+
+        code = content.decode("utf8")
+        script_code_cache.set((name, digest), code)
+        return code
 
-        # Add parameters
-        for i, inp in enumerate(self.ordered_inputs):
-            if i < len(args):
-                value = args[i]
-                if inp.value_type == Input.PASSWORD:
-                    parameter_values += "*****, "
-                else:
-                    parameter_values += str(value) + ", "
-                if inp.value_type == Input.FILE:
-                    p = BatchParameter(input=inp, batch=batch, file_value=value)
-                else:
-                    p = BatchParameter(input=inp, batch=batch, string_value=value)
-                p.save()
+    def run_on(self, site, pc_list, *args, user):
+        """Run the script on the PCs, returning the batch."""
+        with transaction.atomic():
+            batch = Batch(site=site, script=self, name="")
+            batch.save()
+
+            parameter_values = "["
+
+            # Add parameters
+            params = []
+            for i, inp in enumerate(self.ordered_inputs):
+                if i < len(args):
+                    value = args[i]
+                    if inp.value_type == Input.PASSWORD:
+                        parameter_values += "*****, "
+                    else:
+                        parameter_values += str(value) + ", "
+                    if inp.value_type == Input.FILE:
+                        p = BatchParameter(input=inp, batch=batch, file_value=value)
+                    else:
+                        p = BatchParameter(input=inp, batch=batch, string_value=value)
+                    params.append(p)
+            BatchParameter.objects.bulk_create(params)
 
-        if len(parameter_values) > 1:
-            parameter_values = parameter_values[:-2]
-        parameter_values += "]"
+            if len(parameter_values) > 1:
+                parameter_values = parameter_values[:-2]
+            parameter_values += "]"
 
-        log_output = f"New job with arguments {parameter_values}"
+            log_output = f"New job with arguments {parameter_values}"
 
-        for pc in pc_list:
-            job = Job(batch=batch, pc=pc, user=user, log_output=log_output)
-            job.save()
+            batch.add_jobs(pc_list, user=user, log_output=log_output)
 
         return batch
 
@@ -954,10 +1218,385 @@ class Batch(models.Model):
     name = models.CharField(verbose_name=_("name"), max_length=255)
     script = models.ForeignKey(Script, on_delete=models.CASCADE)
     site = models.ForeignKey(Site, related_name="batches", on_delete=models.CASCADE)
+    created = models.DateTimeField(
+        verbose_name=_("created"), auto_now_add=True, null=True
+    )
+    # Rollout policy. With a wave size, jobs are only handed out to that many
+    # PCs at first, and to that many more every wave_interval minutes.
+    wave_size = models.PositiveIntegerField(
+        verbose_name=_("wave size"), null=True, blank=True
+    )
+    wave_interval = models.PositiveIntegerField(
+        verbose_name=_("minutes between waves"), default=0
+    )
+    # Stop handing out jobs once this share of those handed out have failed.
+    halt_failure_percentage = models.PositiveSmallIntegerField(
+        verbose_name=_("halt at failure percentage"),
+        null=True,
+        blank=True,
+        validators=[MaxValueValidator(100)],
+    )
+    # Progress, see update_progress.
+    jobs_total = models.PositiveIntegerField(default=0, editable=False)
+    jobs_submitted = models.PositiveIntegerField(default=0, editable=False)
+    jobs_done = models.PositiveIntegerField(default=0, editable=False)
+    jobs_failed = models.PositiveIntegerField(default=0, editable=False)
+
+    # Number of jobs inserted per statement when adding jobs to a batch.
+    JOB_CREATE_CHUNK_SIZE = 1000
 
     def __str__(self):
         return f"{self.name} - {self.script} - {self.site}"
 
+    def add_jobs(self, pcs, user=None, log_output="", group=None, lazy=None):
+        """Create a job in this batch for each of the PCs and tell their
+        clients about it. The jobs are inserted in chunks rather than one
+        by one, so large sites don't take one statement per PC.
+
+        With lazy, or by default when there are at least LAZY_JOBS_MIN_PCS
+        PCs or the batch is rolled out in waves, only a BatchTarget is
+        stored, and each PC's job is created when the PC fetches its
+        instructions. group is the group the PCs were taken from, if any."""
+        pc_ids = [pc.pk for pc in pcs]
+        if lazy is None:
+            lazy = bool(self.wave_size) or len(pc_ids) >= settings.LAZY_JOBS_MIN_PCS
+        with transaction.atomic():
+            Batch.update_progress({self.pk: {"jobs_total": len(pc_ids)}})
+            if lazy:
+                BatchTarget.objects.create(
+                    batch=self,
+                    group=group,
+                    pc_ids=pc_ids,
+                    pending=len(pc_ids),
+                    user=user,
+                    log_output=log_output,
+                )
+                push.publish(pc_ids)
+                return
+            Job.objects.bulk_create(
+                (
+                    Job(batch=self, pc_id=pc_id, user=user, log_output=log_output)
+                    for pc_id in pc_ids
+                ),
+                batch_size=self.JOB_CREATE_CHUNK_SIZE,
+            )
+            push.publish(pc_ids)
+
+    @property
+    def is_halted(self):
+        return (
+            self.halt_failure_percentage is not None
+            and self.jobs_failed > 0
+            and self.jobs_failed * 100
+            >= self.halt_failure_percentage * self.jobs_submitted
+        )
+
+    def clean(self):
+        if self.wave_size and not self.wave_interval:
+            raise ValidationError(
+                {"wave_interval": _("Required when rolling out in waves.")}
+            )
+
+    def get_open_positions(self, now):
+        """Return how many of the batch's PCs, in the order they were added,
+        may be handed their jobs by now, or None if all of them may. Without
+        a wave interval, only the first wave is ever handed out."""
+        if self.is_halted:
+            return 0
+        if not self.wave_size or not self.created:
+            return None
+        if not self.wave_interval:
+            return self.wave_size
+        elapsed = (now - self.created).total_seconds()
+        waves = 1 + int(elapsed // (self.wave_interval * 60))
+        return waves * self.wave_size
+
+    @staticmethod
+    def update_progress(increments):
+        """Add to the progress counters of batches. increments is a dict of
+        counter increments by batch id, e.g. {batch_id: {"jobs_done": 1}}."""
+        # In a consistent order, so concurrent updates can't deadlock.
+        for batch_id in sorted(increments):
+            Batch.objects.filter(pk=batch_id).update(
+                **{
+                    counter: F(counter) + amount
+                    for counter, amount in increments[batch_id].items()
+                }
+            )
+
+    @staticmethod
+    def get_instruction_parameters(batch_ids):
+        """Return the parameters to send to clients for each of the given
+        batches as a dict keyed by batch id. A batch's parameters are created
+        before its jobs and never change afterwards, so they're cached."""
+        result = {}
+        missing = []
+        for batch_id in set(batch_ids):
+            parameters = batch_parameters_cache.get(batch_id)
+            if parameters is None:
+                missing.append(batch_id)
+            else:
+                result[batch_id] = parameters
+
+        if missing:
+            fetched = {batch_id: [] for batch_id in missing}
+            for param in (
+                BatchParameter.objects.filter(batch_id__in=missing)
+                .select_related("input")
+                .order_by("batch_id", "input__position")
+            ):
+                fetched[param.batch_id].append(
+                    {"type": param.input.value_type, "value": param.transfer_value}
+                )
+            for batch_id, parameters in fetched.items():
+                batch_parameters_cache.set(batch_id, parameters)
+            result.update(fetched)
+
+        return result
+
+
+class BatchTarget(models.Model):
+    """The PCs a large batch is to run on. Rather than creating a job for
+    every one of them up front, each PC's job is created when it fetches its
+    instructions, see Batch.add_jobs. Until then it's shown as a pending
+    job."""
+
+    batch = models.ForeignKey(Batch, related_name="targets", on_delete=models.CASCADE)
+    # The group the batch was run on, or None for a selection of the site's PCs.
+    group = models.ForeignKey(
+        PCGroup, null=True, blank=True, on_delete=models.SET_NULL
+    )
+    # The PCs when the batch was created, later members aren't included.
+    pc_ids = models.JSONField()
+    # The number of PCs whose job hasn't been created yet.
+    pending = models.PositiveIntegerField()
+    user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
+    log_output = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    # After this long, the jobs of PCs that haven't fetched them are created
+    # by clean_up, so targets don't have to be checked on every poll forever.
+    CREATE_REMAINING_AFTER = datetime.timedelta(days=1)
+
+    def __str__(self):
+        return f"{self.batch} - {self.group or self.batch.site}"
+
+    def get_positions(self):
+        """Return the position of each of the target's PCs by PC id. Cached,
+        as it never changes."""
+        positions = batch_target_pcs_cache.get(self.pk)
+        if positions is None:
+            positions = {pc_id: i for i, pc_id in enumerate(self.pc_ids)}
+            batch_target_pcs_cache.set(self.pk, positions)
+        return positions
+
+    @classmethod
+    def get_pending_for(cls, pc):
+        """Return the pending targets the PC is part of, whose rollout has
+        reached it and whose job it doesn't have yet."""
+        now = datetime.datetime.now()
+        targets = []
+        for target in (
+            cls.objects.filter(batch__site_id=pc.site_id, pending__gt=0)
+            .select_related("batch")
+            .defer("pc_ids")
+        ):
+            position = target.get_positions().get(pc.pk)
+            if position is None:
+                continue
+            open_positions = target.batch.get_open_positions(now)
+            if open_positions is None or position < open_positions:
+                targets.append(target)
+        if not targets:
+            return targets
+        created = set(
+            pc.jobs.filter(
+                batch_id__in=[target.batch_id for target in targets]
+            ).values_list("batch_id", flat=True)
+        )
+        return [target for target in targets if target.batch_id not in created]
+
+    @classmethod
+    def has_pending_jobs(cls, pc):
+        return bool(cls.get_pending_for(pc))
+
+    @classmethod
+    def create_jobs(cls, pc):
+        """Create the PC's jobs from the pending targets it's part of."""
+        targets = cls.get_pending_for(pc)
+        if not targets:
+            return
+
+        with transaction.atomic():
+            # Concurrent requests from the same PC mustn't both create its jobs.
+            list(PC.objects.select_for_update().filter(pk=pc.pk).values_list("pk"))
+            created = set(
+                pc.jobs.filter(
+                    batch_id__in=[target.batch_id for target in targets]
+                ).values_list("batch_id", flat=True)
+            )
+            targets = [target for target in targets if target.batch_id not in created]
+            cls._create_jobs(
+                Job(
+                    batch_id=target.batch_id,
+                    pc=pc,
+                    user_id=target.user_id,
+                    log_output=target.log_output,
+                )
+                for target in targets
+            )
+            cls.objects.filter(pk__in=[target.pk for target in targets]).update(
+                pending=F("pending") - 1
+            )
+
+    @staticmethod
+    def _create_jobs(jobs):
+        Job.objects.bulk_create(jobs, batch_size=Batch.JOB_CREATE_CHUNK_SIZE)
+
+    def get_remaining_pc_ids(self):
+        """Return the ids of the target's PCs that still exist and don't have
+        their job yet."""
+        return (
+            PC.objects.filter(site_id=self.batch.site_id, pk__in=self.pc_ids)
+            .exclude(pk__in=self.batch.jobs.values_list("pc_id", flat=True))
+            .values_list("pk", flat=True)
+        )
+
+    @classmethod
+    def clean_up(cls, now):
+        """Recount the pending jobs of every target, so deleted PCs and PCs
+        that will never fetch their instructions don't keep a target around.
+
+        Once a target is older than CREATE_REMAINING_AFTER and its rollout
+        has reached every PC, the remaining jobs are created up front as for
+        small batches. Targets with nothing pending are deleted."""
+        for target in cls.objects.filter(pending__gt=0).select_related("batch"):
+            remaining = target.get_remaining_pc_ids()
+            open_positions = target.batch.get_open_positions(now)
+            if target.created >= now - cls.CREATE_REMAINING_AFTER or (
+                open_positions is not None and open_positions < len(target.pc_ids)
+            ):
+                cls.objects.filter(pk=target.pk).update(pending=remaining.count())
+                continue
+            with transaction.atomic():
+                # Lock the PCs as create_jobs does, so none gets its job twice.
+                pc_ids = list(remaining.select_for_update().order_by("pk"))
+                cls._create_jobs(
+                    Job(
+                        batch_id=target.batch_id,
+                        pc_id=pc_id,
+                        user_id=target.user_id,
+                        log_output=target.log_output,
+                    )
+                    for pc_id in pc_ids
+                )
+                cls.objects.filter(pk=target.pk).update(pending=0)
+                push.publish(pc_ids)
+        cls.objects.filter(pending=0).delete()
+
+    @classmethod
+    def publish_open_waves(cls, now):
+        """Tell the clients of PCs reached by an open wave that haven't fetched
+        their job yet about it. Nothing is saved when a wave opens, so
+        waiting clients aren't told otherwise."""
+        for target in cls.objects.filter(
+            pending__gt=0, batch__wave_size__isnull=False
+        ).select_related("batch"):
+            open_positions = target.batch.get_open_positions(now)
+            if open_positions == 0:
+                continue
+            push.publish(
+                PC.objects.filter(pk__in=target.pc_ids[:open_positions])
+                .exclude(pk__in=target.batch.jobs.values_list("pc_id", flat=True))
+                .values_list("pk", flat=True)
+            )
+
+    @classmethod
+    def get_pending_jobs(cls, site, pcs=None, batches=None):
+        """Return the jobs not yet created from the site's targets, newest
+        target first and then by PC id, as PendingJobs. pcs and batches
+        optionally limit them to querysets of PCs respectively batches."""
+        targets = cls.objects.filter(batch__site=site, pending__gt=0)
+        if batches is not None:
+            targets = targets.filter(batch__in=batches)
+        if pcs is None:
+            pcs = PC.objects.all()
+
+        pending = []
+        for target in targets.select_related("batch__script", "user").order_by(
+            "-pk"
+        ):
+            pc_ids = (
+                pcs.filter(site=site, pk__in=list(target.get_positions()))
+                .exclude(pk__in=target.batch.jobs.values_list("pc_id", flat=True))
+                .order_by("pk")
+                .values_list("pk", flat=True)
+            )
+            pending.extend((target, pc_id) for pc_id in pc_ids)
+        return PendingJobs(pending)
+
+
+class PendingJobs:
+    """Unsaved jobs standing in for the jobs not yet created from batch
+    targets. Only the PCs of the jobs actually looked at are fetched, and
+    jobs of PCs found to have been deleted are dropped, shortening the list.
+
+    Each job has a pending_key of (target id, PC id), which stays valid as
+    other PCs fetch their jobs, see position_after."""
+
+    def __init__(self, pending):
+        self._pending = pending
+        self._checked = False
+
+    @property
+    def pending(self):
+        if not self._checked:
+            # The list may be kept a while, e.g. by a paginator.
+            self._drop_deleted({pc_id for _, pc_id in self._pending})
+        return self._pending
+
+    def _drop_deleted(self, pc_ids):
+        deleted = pc_ids - set(
+            PC.objects.filter(pk__in=pc_ids).values_list("pk", flat=True)
+        )
+        self._pending = [row for row in self._pending if row[1] not in deleted]
+        self._checked = True
+
+    def __len__(self):
+        return len(self.pending)
+
+    def position_after(self, key):
+        """Return the position of the first pending job after the one with
+        the given pending_key, whether or not that one is still pending."""
+        target_id, pc_id = key
+        return bisect.bisect_right(
+            [(-target.pk, pending_pc_id) for target, pending_pc_id in self.pending],
+            (-target_id, pc_id),
+        )
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key : key + 1][0]
+        while True:
+            pending = self.pending[key]
+            pcs = PC.objects.in_bulk([pc_id for _, pc_id in pending])
+            if len(pcs) == len({pc_id for _, pc_id in pending}):
+                break
+            # Some were deleted since the list was checked.
+            self._drop_deleted({pc_id for _, pc_id in pending})
+        jobs = []
+        for target, pc_id in pending:
+            job = Job(
+                batch=target.batch,
+                pc=pcs[pc_id],
+                user=target.user,
+                log_output=target.log_output,
+                created=target.created,
+            )
+            job.pending_key = (target.pk, pc_id)
+            jobs.append(job)
+        return jobs
+
 
 class AssociatedScript(models.Model):
     """A script associated with a group. Adding a script to a group causes it
@@ -978,14 +1617,17 @@ class AssociatedScript(models.Model):
         )
 
     def make_parameters(self, batch):
+        parameters = {p.input_id: p for p in self.parameters.select_related("input")}
         params = []
         for i in self.script.ordered_inputs.all():
             try:
-                asp = self.parameters.get(input=i)
-                params.append(asp.make_batch_parameter(batch))
-            except AssociatedScriptParameter.DoesNotExist:
+                asp = parameters[i.pk]
+            except KeyError:
                 # XXX
-                raise
+                raise AssociatedScriptParameter.DoesNotExist(
+                    f"{self} has no parameter for {i}"
+                )
+            params.append(asp.make_batch_parameter(batch))
         return params
 
     @property
@@ -995,30 +1637,29 @@ class AssociatedScript(models.Model):
     def run_on(self, user, pcs):
         """\
 Runs this script on several PCs, returning a batch representing this task."""
-        batch = self.make_batch()
-        batch.save()
-        params = self.make_parameters(batch)
-
-        parameter_values = "["
-
-        for p in params:
-            p.save()
-            if p.file_value:
-                parameter_values += str(p.file_value) + ", "
-            elif p.input.value_type == Input.PASSWORD:
-                parameter_values += "*****, "
-            else:
-                parameter_values += str(p.string_value) + ", "
+        with transaction.atomic():
+            batch = self.make_batch()
+            batch.save()
+            params = self.make_parameters(batch)
+            BatchParameter.objects.bulk_create(params)
+
+            parameter_values = "["
+
+            for p in params:
+                if p.file_value:
+                    parameter_values += str(p.file_value) + ", "
+                elif p.input.value_type == Input.PASSWORD:
+                    parameter_values += "*****, "
+                else:
+                    parameter_values += str(p.string_value) + ", "
 
-        if len(parameter_values) > 1:
-            parameter_values = parameter_values[:-2]
-        parameter_values += "]"
+            if len(parameter_values) > 1:
+                parameter_values = parameter_values[:-2]
+            parameter_values += "]"
 
-        log_output = f"New job with arguments {parameter_values}"
+            log_output = f"New job with arguments {parameter_values}"
 
-        for pc in pcs:
-            job = Job(batch=batch, pc=pc, user=user, log_output=log_output)
-            job.save()
+            batch.add_jobs(pcs, user=user, log_output=log_output, group=self.group)
 
         return batch
 
@@ -1056,6 +1697,16 @@ class Job(models.Model):
         RESOLVED: _("Restarted"),
     }
 
+    # How far along a job is in each status. A job is never moved back to an
+    # earlier step by a status report from a client.
+    STATUS_PROGRESS = {
+        NEW: 0,
+        SUBMITTED: 1,
+        FAILED: 2,
+        DONE: 2,
+        RESOLVED: 3,
+    }
+
     STATUS_CHOICES = (
         (NEW, STATUS_TRANSLATIONS[NEW]),
         (SUBMITTED, STATUS_TRANSLATIONS[SUBMITTED]),
@@ -1087,6 +1738,9 @@ class Job(models.Model):
     user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
     batch = models.ForeignKey(Batch, related_name="jobs", on_delete=models.CASCADE)
     pc = models.ForeignKey(PC, related_name="jobs", on_delete=models.CASCADE)
+    # Set by a database trigger on every change, see system/changes.py.
+    sync_version = models.BigIntegerField(default=0, editable=False, db_index=True)
+    sync_xid = models.BigIntegerField(default=0, editable=False, db_index=True)
 
     def __str__(self):
         return "_".join(map(str, [self.batch, self.id]))
@@ -1115,20 +1769,37 @@ class Job(models.Model):
 
     @property
     def as_instruction(self):
-        parameters = []
-
-        for param in self.batch.parameters.order_by("input__position"):
-            parameters.append(
-                {"type": param.input.value_type, "value": param.transfer_value}
+        return Job.as_instructions([self])[0]
+
+    @staticmethod
+    def as_instructions(jobs):
+        """Build the instructions sent to a client for the given jobs. All
+        but the id and status is shared by the jobs of a batch, and is only
+        built once per batch."""
+        parameters = Batch.get_instruction_parameters(job.batch_id for job in jobs)
+        templates = {}
+        instructions = []
+
+        for job in jobs:
+            template = templates.get(job.batch_id)
+            if template is None:
+                script = job.batch.script
+                template = templates[job.batch_id] = {
+                    "name": script.name,
+                    "parameters": parameters[job.batch_id],
+                    "executable_code": script.read_executable_code(),
+                }
+            instructions.append(
+                {
+                    "id": job.pk,
+                    "name": template["name"],
+                    "status": job.status,
+                    "parameters": template["parameters"],
+                    "executable_code": template["executable_code"],
+                }
             )
 
-        return {
-            "id": self.pk,
-            "name": self.batch.script.name,
-            "status": self.status,
-            "parameters": parameters,
-            "executable_code": self.batch.script.executable_code.read().decode("utf8"),
-        }
+        return instructions
 
     def resolve(self):
         if self.finished:
@@ -1146,7 +1817,7 @@ class Job(models.Model):
             raise Exception(_("Can only restart jobs that are Done or Failed %s") % "")
         # Create a new batch
         script = self.batch.script
-        new_batch = Batch(site=self.batch.site, script=script, name="")
+        new_batch = Batch(site=self.batch.site, script=script, name="", jobs_total=1)
         new_batch.save()
         parameter_values = "["
         for p in self.batch.parameters.all():
@@ -1172,6 +1843,7 @@ class Job(models.Model):
 
         new_job = Job(batch=new_batch, pc=self.pc, user=user, log_output=log_output)
         new_job.save()
+        push.publish([self.pc_id])
         self.resolve()
 
         return new_job
@@ -1404,6 +2076,9 @@ class SecurityEvent(models.Model):
         on_delete=models.SET_NULL,
     )
     note = models.TextField(blank=True)
+    # Set by a database trigger on every change, see system/changes.py.
+    sync_version = models.BigIntegerField(default=0, editable=False, db_index=True)
+    sync_xid = models.BigIntegerField(default=0, editable=False, db_index=True)
 
     @property
     def namestr(self):
@@ -1425,6 +2100,22 @@ class SecurityEvent(models.Model):
         ]
 
 
+class Notification(models.Model):
+    """An e-mail notification waiting to be sent by the send_notifications
+    command. Notifications for the same recipient with the same subject are
+    sent together as one e-mail."""
+
+    recipient = models.EmailField()
+    subject = models.CharField(max_length=512)
+    body = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+    # Number of failed attempts at sending this notification.
+    attempts = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.recipient}: {self.subject}"
+
+
 class ImageVersion(models.Model):
     product = models.ForeignKey(
         Product,
@@ -1459,6 +2150,8 @@ class Citizen(models.Model):
     site = models.ForeignKey(Site, on_delete=models.CASCADE)
     logged_in = models.BooleanField(default=False)
 
+    objects = CitizenQuerySet.as_manager()
+
     def __str__(self):
         return f"{self.site} - {self.citizen_id}"
 
@@ -1470,8 +2163,79 @@ class Citizen(models.Model):
         ]
 
 
+class AppointmentCache(models.Model):
+    """A site's Easy!Appointments appointments for a day, as last fetched.
+    Only the fields the booking validation needs are kept.
+
+    Shared by all processes, so that logins arriving at the same time don't
+    each fetch the same appointments: the first one to find the entry stale
+    locks it while fetching, and the others wait for its result."""
+
+    site = models.ForeignKey(Site, on_delete=models.CASCADE)
+    date = models.DateField()
+    appointments = models.JSONField(null=True)
+    fetched = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return f"{self.site} - {self.date}"
+
+    def is_fresh(self, now):
+        return self.fetched is not None and now - self.fetched < datetime.timedelta(
+            seconds=settings.APPOINTMENT_CACHE_TTL
+        )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["site", "date"], name="unique_appointment_cache_per_day"
+            ),
+        ]
+
+
+class SMSMessage(models.Model):
+    """A text message with a citizen's login password, queued for sending by
+    the send_sms worker so logins don't wait for SMSTeknik."""
+
+    # SMS status choices
+    QUEUED = "QUEUED"
+    SENT = "SENT"
+    FAILED = "FAILED"
+
+    STATUS_CHOICES = (
+        (QUEUED, _("Queued")),
+        (SENT, _("Sent")),
+        (FAILED, _("Failed")),
+    )
+
+    site = models.ForeignKey(Site, on_delete=models.CASCADE)
+    # The PC the citizen logs in at, so only it can follow the message. None
+    # for older clients, which identify themselves by their site's uid.
+    pc = models.ForeignKey(
+        PC, null=True, blank=True, related_name="+", on_delete=models.SET_NULL
+    )
+    phone_number = models.CharField(max_length=32)
+    # Cleared once the message has been sent or given up on.
+    message = models.TextField(blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    next_attempt = models.DateTimeField(default=datetime.datetime.now)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.site} - {self.phone_number} - {self.status}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "next_attempt"]),
+            models.Index(fields=["site", "phone_number"]),
+        ]
+
+
 class APIKey(models.Model):
     key = models.CharField(verbose_name=_("key"), max_length=100, unique=True)
+    # Keys are looked up by hash, see get_site.
+    key_hash = models.CharField(max_length=64, unique=True, editable=False)
     description = models.CharField(
         verbose_name=_("description"), max_length=100, null=True, blank=True
     )
@@ -1482,3 +2246,71 @@ class APIKey(models.Model):
 
     def __str__(self):
         return self.key
+
+    @staticmethod
+    def hash_key(key):
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def save(self, *args, **kwargs):
+        if self.pk:
+            old_hash = (
+                APIKey.objects.filter(pk=self.pk)
+                .values_list("key_hash", flat=True)
+                .first()
+            )
+            if old_hash:
+                api_key_cache.discard(old_hash)
+        self.key_hash = self.hash_key(self.key)
+        super().save(*args, **kwargs)
+        api_key_cache.discard(self.key_hash)
+
+    @classmethod
+    def get_site(cls, key):
+        """Return the site an API key belongs to, or None if the key isn't
+        valid. Valid keys are cached for API_KEY_CACHE_TTL seconds."""
+        key_hash = cls.hash_key(key)
+        cached = api_key_cache.get(key_hash)
+        now = time.monotonic()
+        if cached and cached[1] > now:
+            return cached[0]
+
+        api_key = cls.objects.select_related("site").filter(key_hash=key_hash).first()
+        if api_key is None:
+            api_key_cache.discard(key_hash)
+            return None
+        api_key_cache.set(key_hash, (api_key.site, now + settings.API_KEY_CACHE_TTL))
+        return api_key.site
+
+
+class Tombstone(models.Model):
+    """Records that a computer, job or event has been deleted, so the changes
+    API can tell integrators about it. Created by database triggers, see
+    system/changes.py."""
+
+    COMPUTER = "computer"
+    JOB = "job"
+    EVENT = "event"
+
+    MODEL_CHOICES = (
+        (COMPUTER, _("Computer")),
+        (JOB, _("Job")),
+        (EVENT, _("Event")),
+    )
+
+    model = models.CharField(max_length=10, choices=MODEL_CHOICES)
+    object_id = models.IntegerField()
+    # No foreign key constraint, as tombstones are created while the site's
+    # computers are being deleted along with it.
+    site = models.ForeignKey(
+        Site,
+        null=True,
+        related_name="+",
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+    )
+    sync_version = models.BigIntegerField(db_index=True)
+    sync_xid = models.BigIntegerField(default=0, db_index=True)
+    deleted = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.model} {self.object_id}"
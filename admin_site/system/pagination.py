@@ -0,0 +1,123 @@
+import base64
+from typing import Any, List, Optional
+
+from ninja import Field, Schema
+from ninja.conf import settings
+from ninja.errors import ValidationError
+from ninja.pagination import PaginationBase
+
+
+class PendingRows:
+    """A queryset preceded by rows that aren't in the database yet, such as
+    the jobs not yet created from a BatchTarget. The pending rows have no id.
+
+    Can be paginated by CursorPagination, or by Django's Paginator as a
+    sequence."""
+
+    def __init__(self, pending, queryset):
+        self.pending = pending
+        self.queryset = queryset
+
+    def count(self):
+        return len(self.pending) + self.queryset.count()
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key : key + 1][0]
+        start = key.start or 0
+        rows = list(self.pending[start : key.stop])
+        if key.stop is None or len(rows) < key.stop - start:
+            offset = max(start - len(self.pending), 0)
+            stop = None if key.stop is None else key.stop - len(self.pending)
+            rows += list(self.queryset[offset:stop])
+        return rows
+
+
+class CursorPagination(PaginationBase):
+    """Keyset pagination over a queryset ordered by descending id.
+
+    Each page includes a next_cursor, which is passed as cursor to fetch the
+    following page, or null on the last page. Fetching a page takes the same
+    time however deep into the results it is, and objects created while
+    paging don't shift the later pages.
+
+    For compatibility with the offset pagination these endpoints used to
+    have, an offset may be given instead of a cursor. The total count is only
+    included on the first page and on pages fetched by offset.
+
+    Pending rows of a PendingRows come first. Their cursors hold the
+    pending_key of the last pending row returned, so pending rows being
+    created in the meantime don't shift the later pages."""
+
+    class Input(Schema):
+        limit: int = Field(settings.PAGINATION_PER_PAGE, ge=1)
+        cursor: Optional[str] = None
+        offset: Optional[int] = Field(None, ge=0)
+
+    class Output(Schema):
+        items: List[Any]
+        count: Optional[int]
+        next_cursor: Optional[str]
+
+    @staticmethod
+    def encode_cursor(last_id):
+        """Encode the id of the last row returned, or the pending_key of the
+        last pending row."""
+        if isinstance(last_id, tuple):
+            last_id = ":".join(map(str, last_id))
+        return base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            padded = cursor + "=" * (-len(cursor) % 4)
+            last_id = base64.urlsafe_b64decode(padded.encode()).decode()
+            if ":" in last_id:
+                return tuple(int(part) for part in last_id.split(":", 1))
+            return int(last_id)
+        except ValueError:
+            raise ValidationError([{"cursor": "Invalid cursor"}])
+
+    def paginate_queryset(self, queryset, pagination: Input, **params: Any) -> Any:
+        pending = []
+        if isinstance(queryset, PendingRows):
+            pending, queryset = queryset.pending, queryset.queryset
+        limit = pagination.limit
+        count = None
+        position = len(pending)
+        if pagination.cursor:
+            last_id = self.decode_cursor(pagination.cursor)
+            if isinstance(last_id, tuple):
+                # The pending rows may all have been created since.
+                position = pending.position_after(last_id) if pending else 0
+                page = queryset
+            else:
+                page = queryset.filter(id__lt=last_id)
+        elif pagination.offset:
+            position = pagination.offset
+        else:
+            position = 0
+            page = queryset
+
+        # Fetch one more than needed to find out if there's a next page.
+        items = list(pending[position : position + limit + 1])
+        # Only count the pending rows now, as those of deleted PCs are dropped
+        # when fetched.
+        if pagination.offset and not pagination.cursor:
+            page = queryset[max(pagination.offset - len(pending), 0) :]
+        if not pagination.cursor:
+            count = len(pending) + self._items_count(queryset)
+        if len(items) <= limit:
+            items += list(page[: limit + 1 - len(items)])
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            last_id = items[-1].id
+            if last_id is None:
+                last_id = items[-1].pending_key
+            next_cursor = self.encode_cursor(last_id)
+
+        return {"items": items, "count": count, "next_cursor": next_cursor}
@@ -0,0 +1,210 @@
+"""Wake up clients waiting for new instructions.
+
+Instead of polling get_instructions, a client may wait at /rpc/wait/ until
+something has changed for it - a new job, a configuration change or a
+change to its security scripts - and then fetch its instructions once.
+
+Changes are published with PostgreSQL's NOTIFY on commit, so every process
+serving the endpoint hears about them. Each process keeps a single LISTEN
+connection, shared by all the clients waiting on it. Clients only wait when
+the endpoint is served by an ASGI server, where a waiting client doesn't
+occupy a worker. Under WSGI it answers right away, like get_instructions.
+
+A waiting client counts as checking in when it starts and stops waiting,
+so LONG_POLL_MAX_TIMEOUT is kept well below the five minutes after which a
+PC is considered offline."""
+
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connection
+from django.http import HttpResponseNotAllowed, JsonResponse
+
+from system import heartbeat
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "os2borgerpc_instructions"
+# Keeps a NOTIFY payload well below PostgreSQL's limit of 8000 bytes.
+PUBLISH_CHUNK_SIZE = 800
+# Seconds to wait before reconnecting when the LISTEN connection fails.
+RECONNECT_DELAY = 5
+# Seconds a client waits for the LISTEN connection before checking for
+# changes anyway.
+LISTEN_READY_TIMEOUT = 5
+
+_waiters = {}
+_listener = None
+# Set while the LISTEN connection is up.
+_listening = None
+
+
+def publish(pc_ids):
+    """Tell the clients of the given PCs to fetch new instructions once the
+    current transaction has been committed."""
+    if connection.vendor != "postgresql":
+        return
+    pc_ids = sorted(set(pc_ids))
+    with connection.cursor() as cursor:
+        for start in range(0, len(pc_ids), PUBLISH_CHUNK_SIZE):
+            chunk = pc_ids[start : start + PUBLISH_CHUNK_SIZE]
+            cursor.execute(
+                "SELECT pg_notify(%s, %s)", [CHANNEL, ",".join(map(str, chunk))]
+            )
+
+
+def _wake(pc_ids):
+    for pc_id in pc_ids:
+        for event in _waiters.get(pc_id, ()):
+            event.set()
+
+
+def _wake_all():
+    for events in _waiters.values():
+        for event in events:
+            event.set()
+
+
+async def _listen(listening):
+    import psycopg
+
+    db = settings.DATABASES["default"]
+    params = {
+        "dbname": db["NAME"],
+        "user": db["USER"],
+        "password": db["PASSWORD"],
+        "host": db["HOST"],
+        "port": db["PORT"],
+        **db.get("OPTIONS", {}),
+    }
+    reconnecting = False
+    while True:
+        try:
+            conn = await psycopg.AsyncConnection.connect(autocommit=True, **params)
+            async with conn:
+                await conn.execute(f"LISTEN {CHANNEL}")
+                listening.set()
+                if reconnecting:
+                    # Anything published while we weren't listening is lost,
+                    # so have everyone check for themselves.
+                    _wake_all()
+                async for notify in conn.notifies():
+                    _wake(int(pc_id) for pc_id in notify.payload.split(","))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Lost the connection listening for new instructions")
+        listening.clear()
+        reconnecting = True
+        await asyncio.sleep(RECONNECT_DELAY)
+
+
+def _ensure_listening():
+    """Start listening if this process isn't already. Returns an event that
+    is set while the LISTEN connection is up, or None without PostgreSQL."""
+    global _listener, _listening
+    loop = asyncio.get_running_loop()
+    if _listener is None or _listener.done() or _listener.get_loop() is not loop:
+        if connection.vendor != "postgresql":
+            return None
+        # Under WSGI every request gets its own event loop, so the listener
+        # only lives as long as the request.
+        _listening = asyncio.Event()
+        _listener = loop.create_task(_listen(_listening))
+    return _listening
+
+
+def _has_changed(pc_id, digests):
+    """Check for anything the client hasn't fetched yet, in case it was
+    published before this process was listening."""
+    from system import rpc
+    from system.models import BatchTarget, Job, MergedConfiguration, PC
+
+    pc = PC.objects.select_related("merged_configuration").get(pk=pc_id)
+    # Jobs created since the client last fetched its instructions
+    # won't be published again. Neither will jobs still to be created from
+    # batch targets.
+    if pc.jobs.filter(status=Job.NEW).exists() or BatchTarget.has_pending_jobs(pc):
+        return True
+    configuration = digests.get("configuration")
+    if configuration and configuration != MergedConfiguration.get_for_pc(pc).digest:
+        return True
+    security_scripts = digests.get("security_scripts")
+    if security_scripts and security_scripts != rpc.get_security_scripts_digest(
+        rpc.get_security_problems(pc)
+    ):
+        return True
+    return False
+
+
+async def wait_for_instructions(request):
+    """Wait until there may be new instructions for a PC, or until timeout
+    seconds have passed. Returns {"changed": true} in the former case, in
+    which the client should call get_instructions or sync right away, and
+    {"changed": false} in the latter.
+
+    The client may pass the digests it got with its last instructions as
+    configuration and security_scripts, so changes made before this
+    process started listening aren't missed."""
+    from system.models import PC
+
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+
+    try:
+        timeout = int(request.GET.get("timeout", settings.LONG_POLL_MAX_TIMEOUT))
+    except ValueError:
+        return JsonResponse({"error": "Invalid timeout"}, status=400)
+    timeout = max(0, min(timeout, settings.LONG_POLL_MAX_TIMEOUT))
+
+    pc = await (
+        PC.objects.filter(uid=request.GET.get("uid", ""))
+        .only("pk", "last_seen")
+        .afirst()
+    )
+    if pc is None:
+        return JsonResponse(
+            {
+                "error": "This Computer does not appear to be registered "
+                "with the configured admin portal."
+            },
+            status=404,
+        )
+
+    pc_id = pc.pk
+    await sync_to_async(heartbeat.record)(pc)
+
+    digests = {
+        key: request.GET.get(key, "") for key in ("configuration", "security_scripts")
+    }
+    if not isinstance(request, ASGIRequest):
+        # Waiting would hold up a whole worker.
+        changed = await sync_to_async(_has_changed)(pc_id, digests)
+        return JsonResponse({"changed": changed})
+
+    listening = _ensure_listening()
+    event = asyncio.Event()
+    _waiters.setdefault(pc_id, set()).add(event)
+    try:
+        # Only check once we're listening, so nothing can slip in between.
+        if listening is not None:
+            try:
+                await asyncio.wait_for(listening.wait(), LISTEN_READY_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+        if await sync_to_async(_has_changed)(pc_id, digests):
+            return JsonResponse({"changed": True})
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            changed = True
+        except asyncio.TimeoutError:
+            changed = False
+        await sync_to_async(heartbeat.record)(pc)
+        return JsonResponse({"changed": changed})
+    finally:
+        _waiters[pc_id].discard(event)
+        if not _waiters[pc_id]:
+            del _waiters[pc_id]
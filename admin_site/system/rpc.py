@@ -4,19 +4,23 @@
 import system.utils
 import hashlib
 import logging
+from collections import Counter, defaultdict
 from datetime import datetime, timedelta
 
 from django.conf import settings
+from django.db import transaction
 from django.db.models import Q
 
+from system import heartbeat
 from system.models import PC, Site, Configuration, ConfigurationEntry
-from system.models import Job, SecurityProblem, SecurityEvent
-from system.models import Citizen, LoginLog
+from system.models import MergedConfiguration
+from system.models import Batch, BatchTarget, Job, SecurityProblem, SecurityEvent
+from system.models import Citizen, LoginCount, LoginLog, SMSMessage
 
 from system.utils import (
     get_citizen_login_api_validator,
     easy_appointments_booking_validate,
-    send_password_sms,
+    queue_password_sms,
     quria_login_validate,
 )
 
@@ -110,15 +114,59 @@ def send_status_info_v2(pc_uid, job_data):
         # Fail silently
         return 0
 
-    pc.last_seen = datetime.now()
-    pc.save()
+    heartbeat.record(pc)
 
     # 2. Update jobs with job data
-    if job_data is not None:
-        for jd in job_data:
-            job = Job.objects.filter(pk=jd["id"]).first()
-            if not job:
+    if job_data:
+        update_jobs(pc, job_data)
+
+    return 0
+
+
+def update_jobs(pc, job_data):
+    """Apply the job status reports from a PC in bulk.
+
+    Reports for jobs belonging to other PCs or with unknown statuses are
+    ignored. So are reports that would move a job back to an earlier status,
+    and reports for jobs that have already finished, which makes repeated
+    and out-of-order reports harmless. Returns the number of jobs updated."""
+    reports = {}
+    for jd in job_data:
+        if jd["status"] not in Job.STATUS_PROGRESS:
+            logger.warning(
+                "PC %s reported unknown status %r for job %s",
+                pc.uid,
+                jd["status"],
+                jd["id"],
+            )
+            continue
+        job_id = int(jd["id"])
+        previous = reports.get(job_id)
+        if (
+            previous is None
+            or Job.STATUS_PROGRESS[previous["status"]]
+            <= Job.STATUS_PROGRESS[jd["status"]]
+        ):
+            reports[job_id] = jd
+
+    with transaction.atomic():
+        jobs = list(
+            pc.jobs.select_for_update().filter(pk__in=list(reports)).order_by("pk")
+        )
+        changed = []
+        finished = defaultdict(Counter)
+        for job in jobs:
+            jd = reports[job.pk]
+            current = Job.STATUS_PROGRESS[job.status]
+            reported = Job.STATUS_PROGRESS[jd["status"]]
+            if reported < current or (
+                reported == current and current >= Job.STATUS_PROGRESS[Job.DONE]
+            ):
                 continue
+            if jd["status"] == Job.DONE:
+                finished[job.batch_id]["jobs_done"] += 1
+            elif jd["status"] == Job.FAILED:
+                finished[job.batch_id]["jobs_failed"] += 1
             job.status = jd["status"]
             # Empty strings might be sent in rare cases, which otherwise cause validation errors
             if jd["started"]:
@@ -126,11 +174,59 @@ def send_status_info_v2(pc_uid, job_data):
             if jd["finished"]:
                 job.finished = jd["finished"]
             job.log_output = jd["log_output"]
-            job.save()
+            changed.append(job)
 
-    pc.save()
+        Job.objects.bulk_update(
+            changed, ["status", "started", "finished", "log_output"]
+        )
+        Batch.update_progress(finished)
 
-    return 0
+    if len(jobs) < len(reports):
+        logger.warning(
+            "PC %s reported status for jobs that aren't its own: %s",
+            pc.uid,
+            sorted(set(reports) - {job.pk for job in jobs}),
+        )
+
+    return len(changed)
+
+
+def sync(pc_uid, payload):
+    """Do everything a client does when polling in a single call: report job
+    statuses, push configuration keys and security events, and get new
+    instructions. This saves the client a round trip per step and the
+    server a PC lookup per step, and either all of it is stored or none of
+    it is.
+
+    payload is a dict with the following keys, all optional:
+        "jobs": the job_data of send_status_info_v2.
+        "config": the config_dict of push_config_keys.
+        "security_events": the events_csv of push_security_events.
+        "digests": the digests of get_instructions_v2.
+
+    Returns the same as get_instructions_v2, i.e. an empty dict if the PC
+    isn't activated, in which case nothing from the payload is stored."""
+    payload = payload or {}
+
+    with transaction.atomic():
+        pc = get_activated_pc_for_instructions(pc_uid)
+        if not pc:
+            # Fail silently
+            return {}
+
+        if payload.get("jobs"):
+            update_jobs(pc, payload["jobs"])
+        if payload.get("config"):
+            update_config_keys(pc, payload["config"])
+            # Reload the merged configuration fetched with the PC, in case
+            # the pushed keys have made it stale.
+            pc.merged_configuration = MergedConfiguration.objects.get_or_create(
+                pc=pc
+            )[0]
+        if payload.get("security_events"):
+            store_security_events(pc, payload["security_events"])
+
+        return get_changed_instructions(pc, payload.get("digests"))
 
 
 # TODO: Backwards compatible function. Delete once there are no longer active clients calling it.
@@ -143,33 +239,118 @@ def get_instructions(pc_uid):
     jobs, which will be scheduled for execution and executed upon receipt.
     These jobs will generally take the form of bash scripts."""
 
+    pc = get_activated_pc_for_instructions(pc_uid)
+    if not pc:
+        # Fail silently
+        return {}
+
+    instructions = {
+        "security_scripts": get_security_scripts(get_security_problems(pc)),
+        "jobs": get_jobs(pc),
+        "configuration": pc.get_full_config(),
+    }
+
+    return instructions
+
+
+def get_instructions_v2(pc_uid, digests):
+    """Like get_instructions, except that the configuration and the security
+    scripts are only sent if they have changed since the client last
+    received them.
+
+    digests is a dict with the digests the client got with its previous
+    instructions, under the keys "configuration" and "security_scripts". A
+    missing or empty digest means the section is always sent.
+
+    The result always contains the jobs and the current digests. The
+    "configuration" and "security_scripts" sections are only included if
+    their digest differs from the one the client sent, and "not_modified" is
+    True if neither is included and there are no jobs."""
+
+    pc = get_activated_pc_for_instructions(pc_uid)
+    if not pc:
+        # Fail silently
+        return {}
+    return get_changed_instructions(pc, digests)
+
+
+def get_changed_instructions(pc, digests):
+    """Build the result of get_instructions_v2 for an activated PC."""
+    digests = digests or {}
+
+    jobs = get_jobs(pc)
+    merged_configuration = MergedConfiguration.get_for_pc(pc)
+    security_problems = get_security_problems(pc)
+    security_scripts_digest = get_security_scripts_digest(security_problems)
+
+    instructions = {
+        "jobs": jobs,
+        "configuration_digest": merged_configuration.digest,
+        "security_scripts_digest": security_scripts_digest,
+        "not_modified": not jobs,
+    }
+    if digests.get("configuration") != merged_configuration.digest:
+        instructions["configuration"] = merged_configuration.full_config
+        instructions["not_modified"] = False
+    if digests.get("security_scripts") != security_scripts_digest:
+        instructions["security_scripts"] = get_security_scripts(security_problems)
+        instructions["not_modified"] = False
+
+    return instructions
+
+
+def get_activated_pc_for_instructions(pc_uid):
+    """Look up the PC asking for instructions and register that it has
+    checked in. Returns None if the PC isn't activated."""
     try:
-        pc = PC.objects.get(uid=pc_uid)
+        pc = PC.objects.select_related("merged_configuration").get(uid=pc_uid)
     except PC.DoesNotExist:
         raise Exception(
             "This Computer does not appear to be registered with the configured admin portal."
         )
 
-    pc.last_seen = datetime.now()
-    pc.save()
+    heartbeat.record(pc)
 
     if not pc.is_activated:
-        # Fail silently
-        return {}
-
-    jobs = []
-    for job in pc.jobs.filter(status=Job.NEW).order_by("pk"):
+        return None
+    return pc
+
+
+def get_jobs(pc):
+    """Hand out the PC's new jobs, marking them as submitted."""
+    BatchTarget.create_jobs(pc)
+    jobs = list(
+        pc.jobs.filter(status=Job.NEW).select_related("batch__script").order_by("pk")
+    )
+    if not jobs:
+        return []
+
+    submitted = Counter(job.batch_id for job in jobs)
+    with transaction.atomic():
+        Job.objects.filter(pk__in=[job.pk for job in jobs]).update(
+            status=Job.SUBMITTED
+        )
+        Batch.update_progress(
+            {
+                batch_id: {"jobs_submitted": count}
+                for batch_id, count in submitted.items()
+            }
+        )
+    for job in jobs:
         job.status = Job.SUBMITTED
-        job.save()
-        jobs.append(job.as_instruction)
+    return Job.as_instructions(jobs)
 
+
+def get_security_problems(pc):
     # Check for security scripts covering the site and
     # security scripts covering groups the pc is a member of.
-    security_problems = SecurityProblem.objects.filter(
-        Q(site=pc.site, alert_groups__isnull=True)
+    return SecurityProblem.objects.filter(
+        Q(site_id=pc.site_id, alert_groups__isnull=True)
         | Q(alert_groups__in=pc.pc_groups.all())
     ).select_related("security_script")
 
+
+def get_security_scripts(security_problems):
     scripts = []
 
     for security_problem in security_problems:
@@ -181,19 +362,26 @@ def get_instructions(pc_uid):
         )
         script_dict = {
             "name": identifier,
-            "executable_code": security_problem.security_script.executable_code.read()
-            .decode("utf8")
+            "executable_code": security_problem.security_script.read_executable_code()
             .replace("%SECURITY_PROBLEM_UID%", str(security_problem.id)),
         }
         scripts.append(script_dict)
 
-    instructions = {
-        "security_scripts": scripts,
-        "jobs": jobs,
-        "configuration": pc.get_full_config(),
-    }
+    return scripts
 
-    return instructions
+
+def get_security_scripts_digest(security_problems):
+    """Digest of the security scripts without reading them - a new upload
+    always gets a new file name and bumps the script's modified time."""
+    parts = sorted(
+        set(
+            f"{problem.id}:{problem.security_script.id}:"
+            f"{problem.security_script.executable_code.name}:"
+            f"{problem.security_script.modified}"
+            for problem in security_problems
+        )
+    )
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
 
 
 def push_config_keys(pc_uid, config_dict):
@@ -206,6 +394,13 @@ def push_config_keys(pc_uid, config_dict):
     if not pc.is_activated:
         return 0
 
+    update_config_keys(pc, config_dict)
+    return True
+
+
+def update_config_keys(pc, config_dict):
+    """Store the configuration keys pushed by a PC in its own configuration,
+    unless they're already in effect."""
     # We need two config dicts: one from the PC itself and one from groups
     # and global configuration
     config_lists = pc.get_list_of_configurations()
@@ -227,10 +422,15 @@ def push_config_keys(pc_uid, config_dict):
         if key in others_config and others_config[key] == value:
             if key in pc_config:
                 pc.configuration.remove_entry(key)
-        else:
+        elif pc_config.get(key) != value:
+            # Only write changed keys, any write invalidates the PC's merged
+            # configuration.
             pc.configuration.update_entry(key, value)
 
-    return True
+    if "login_counts" in config_dict:
+        LoginCount.store(
+            pc, config_dict["login_counts"], pc_config.get("login_counts")
+        )
 
 
 # TODO: Log events for SecurityProblems that don't exist
@@ -239,7 +439,15 @@ def push_config_keys(pc_uid, config_dict):
 # stop handling it here completely as it's null=True
 def push_security_events(pc_uid, events_csv):
     pc = PC.objects.get(uid=pc_uid)
+    store_security_events(pc, events_csv)
+    return 0
 
+
+def store_security_events(pc, events_csv):
+    """Store the security events reported by a PC in the CSV format used by
+    push_security_events."""
+    # 1. Parse all the lines
+    parsed = []
     for event in events_csv:
         event_split = event.split(",")
         if len(event_split) == 3 or len(event_split) == 4:
@@ -257,22 +465,33 @@ def push_security_events(pc_uid, events_csv):
             continue
 
         try:
-            security_problem = SecurityProblem.objects.filter(id=rule_id).first()
+            rule_id = int(rule_id)
+            event_occurred_time_object = datetime.strptime(event_date, "%Y%m%d%H%M%S")
         except ValueError:
             if settings.DEBUG or "test" in settings.SERVER_EMAIL:
                 logger.exception(
-                    "Security event log contained invalid rule ID %s, Event: %s, PC UID %s",
-                    rule_id,
+                    "Security event log contained invalid rule ID or date, Event: %s, PC UID %s",
                     str(event),
                     pc.uid,
                 )
             continue
 
+        parsed.append((rule_id, event_occurred_time_object, event_summary, event))
+
+    # 2. Look up the security problems they refer to in one go
+    security_problems = SecurityProblem.objects.in_bulk(
+        {rule_id for rule_id, _, _, _ in parsed}
+    )
+
+    now = datetime.now()
+    security_events = []
+    for rule_id, occurred_time, summary, event in parsed:
+        security_problem = security_problems.get(rule_id)
         if not security_problem:
             # Ignore ID's of SecurityProblems that don't exist
             continue
 
-        if not security_problem.site == pc.site:
+        if not security_problem.site_id == pc.site_id:
             # Ignore SecurityProblems matching a computer on a different site
             logger.error(
                 (
@@ -285,24 +504,20 @@ def push_security_events(pc_uid, events_csv):
             )
             continue
 
-        now = datetime.now()
-        event_occurred_time_object = datetime.strptime(event_date, "%Y%m%d%H%M%S")
-        security_event = SecurityEvent.objects.create(
-            problem=security_problem,
-            pc=pc,
-            occurred_time=event_occurred_time_object,
-            reported_time=now,
-            summary=event_summary,
-        )
-
-        # Notify subscribed users
-        system.utils.notify_users(
-            security_event,
-            security_problem,
-            pc,
+        security_events.append(
+            SecurityEvent(
+                problem=security_problem,
+                pc=pc,
+                occurred_time=occurred_time,
+                reported_time=now,
+                summary=summary,
+            )
         )
 
-    return 0
+    # 3. Store them, and queue notifications for subscribed users
+    with transaction.atomic():
+        SecurityEvent.objects.bulk_create(security_events)
+        system.utils.notify_users(security_events)
 
 
 def general_citizen_login(pc_uid, integration, value_dict):
@@ -431,21 +646,9 @@ def general_citizen_login(pc_uid, integration, value_dict):
             elif (
                 "allow_idle_login" in value_dict
             ):  # Idle logins are allowed, update Citizen object
-                if citizen:  # Existing citizen
-                    quarantined_from = citizen.last_successful_login + login_duration
-                    if quarantined_from + quarantine_duration < now:
-                        # If they are starting a new login period, update their
-                        # last successful login
-                        citizen.last_successful_login = now
-                    citizen.logged_in = True
-                else:  # First time login
-                    citizen = Citizen(
-                        citizen_id=citizen_hash,
-                        last_successful_login=now,
-                        site=site,
-                        logged_in=True,
-                    )
-                citizen.save()
+                Citizen.objects.log_in_idle(
+                    citizen_hash, site, now, login_duration, quarantine_duration
+                )
 
         else:  # Citizen is not allowed to log in
             citizen_hash = note
@@ -462,40 +665,12 @@ def general_citizen_login(pc_uid, integration, value_dict):
             return int(0), citizen_hash, log_id
     # If booking is not required, use the standard quarantine system.
     else:
-        try:
-            citizen = Citizen.objects.get(citizen_id=citizen_hash)
-        except Citizen.DoesNotExist:
-            citizen = None
-        time_allowed = login_duration.total_seconds() // 60
-        if citizen:
-            quarantined_from = citizen.last_successful_login + login_duration
-            if now < quarantined_from and not citizen.logged_in:
-                time_allowed = (
-                    time_allowed
-                    - (now - citizen.last_successful_login).total_seconds() // 60
-                )
-                citizen.logged_in = True
-            elif now < quarantined_from and citizen.logged_in:
-                time_allowed = 0
-                citizen_hash = "logged_in"
-            elif (now - quarantined_from) >= quarantine_duration:
-                citizen.last_successful_login = now
-                citizen.logged_in = True
-            else:
-                # (now - quarantined_from) < quarantine_duration:
-                time_allowed = (
-                    (now - quarantined_from).total_seconds()
-                    - quarantine_duration.total_seconds()
-                ) // 60
-        else:
-            # First-time login, all good.
-            citizen = Citizen(
-                citizen_id=citizen_hash,
-                last_successful_login=now,
-                site=site,
-                logged_in=True,
-            )
-        citizen.save()
+        status, time_allowed = Citizen.objects.log_in(
+            citizen_hash, site, now, login_duration, quarantine_duration
+        )
+        if status == "logged_in":
+            time_allowed = 0
+            citizen_hash = "logged_in"
 
     # Only ever save a log if the citizen was actually allowed to log in
     if "save_log" in value_dict and time_allowed > 0:
@@ -528,12 +703,7 @@ def general_citizen_logout(citizen_hash, log_id):
         except LoginLog.DoesNotExist:
             pass
     if citizen_hash:
-        try:
-            citizen = Citizen.objects.get(citizen_id=citizen_hash)
-            citizen.logged_in = False
-            citizen.save()
-        except Citizen.DoesNotExist:
-            pass
+        Citizen.objects.log_out(citizen_hash)
     return 0
 
 
@@ -550,6 +720,8 @@ def sms_login(
 ):
     """Check if the user is allowed to log in and if so, send a sms with
     the required password to the entered phone number.
+    The sms is sent in the background, use sms_status to find out whether
+    it was sent.
     Whether a user is allowed to log in is determined by checking for a
     matching booking if booking is required or by checking the Citizen
     quarantine logic if booking is not required.
@@ -575,7 +747,6 @@ def sms_login(
         citizen_hash = 'logged_in': The user is already logged in on
                         another machine. This value is only used when
                         booking is NOT required.
-        citizen_hash = 'sms_failed': Failed to authenticate with sms API.
         citizen_hash = 'quarantine' : Idle logins are allowed, but the
                        user is quarantined and does not have an active
                        booking or a future booking that starts before
@@ -597,6 +768,7 @@ def sms_login(
     except PC.DoesNotExist:
         # The function is ultimately supposed to exit here, but for the sake of backwards
         # compatibility, we initially handle the old version
+        pc = None
         site_uid = pc_uid
         try:
             site = Site.objects.get(uid=site_uid)
@@ -707,14 +879,47 @@ def sms_login(
 
     # Only send a sms if they are allowed to log in
     if time_allowed > 0:
-        sms_sent = send_password_sms(phone_number, message, site)
-
-        if not sms_sent:
-            citizen_hash = "sms_failed"
+        queue_password_sms(phone_number, message, site, pc)
 
     return int(time_allowed), citizen_hash
 
 
+def sms_status(phone_number, pc_uid):
+    """Return the status of the latest sms sent by sms_login to the given
+    phone number from the PC. Older clients passing their site's uid only
+    see the messages sent by other such clients.
+
+    Return values:
+        'queued': The sms has not been sent yet.
+        'sent': The sms has been sent.
+        'sms_failed': Failed to send the sms, e.g. because authentication
+                      with the sms API failed.
+        '': No sms has been sent to the phone number."""
+    try:
+        pc = PC.objects.get(uid=pc_uid)
+        site = pc.site
+    except PC.DoesNotExist:
+        # Like sms_login, accept the uid of the site for older clients
+        pc = None
+        try:
+            site = Site.objects.get(uid=pc_uid)
+        except Site.DoesNotExist:
+            logger.error(f"Site {pc_uid} does not exist - unable to proceed.")
+            return ""
+
+    status = (
+        SMSMessage.objects.filter(site=site, pc=pc, phone_number=phone_number)
+        .order_by("-created", "-pk")
+        .values_list("status", flat=True)
+        .first()
+    )
+    return {
+        SMSMessage.QUEUED: "queued",
+        SMSMessage.SENT: "sent",
+        SMSMessage.FAILED: "sms_failed",
+    }.get(status, "")
+
+
 def sms_login_finalize(
     phone_number,
     pc_uid,
@@ -758,10 +963,6 @@ def sms_login_finalize(
     if not require_booking or allow_idle_login:
         citizen_hash = hashlib.sha512(str(phone_number[-8:]).encode()).hexdigest()
         now = datetime.now()
-        try:
-            citizen = Citizen.objects.get(citizen_id=citizen_hash)
-        except Citizen.DoesNotExist:
-            citizen = None
         if login_duration:
             login_duration = timedelta(minutes=login_duration)
         else:
@@ -770,22 +971,9 @@ def sms_login_finalize(
             quarantine_duration = timedelta(minutes=quarantine_duration)
         else:
             quarantine_duration = site.user_quarantine_duration
-        if citizen:
-            quarantined_from = citizen.last_successful_login + login_duration
-            if now < quarantined_from and not citizen.logged_in:
-                citizen.logged_in = True
-            elif (now - quarantined_from) >= quarantine_duration:
-                citizen.last_successful_login = now
-                citizen.logged_in = True
-        else:
-            # First-time login, all good.
-            citizen = Citizen(
-                citizen_id=citizen_hash,
-                last_successful_login=now,
-                site=site,
-                logged_in=True,
-            )
-        citizen.save()
+        Citizen.objects.log_in(
+            citizen_hash, site, now, login_duration, quarantine_duration
+        )
 
     log_id = ""
     if save_log:
@@ -845,45 +1033,20 @@ def citizen_login(username, password, pc_uid, prevent_dual_login=False):
     if citizen_id:
         citizen_hash = hashlib.sha512(str(citizen_id).encode()).hexdigest()
         now = datetime.now()
-        # Time in minutes.
-        time_allowed = site.user_login_duration.total_seconds() // 60
-        # Get previous login, if any.
-        try:
-            citizen = Citizen.objects.get(citizen_id=citizen_hash)
-        except Citizen.DoesNotExist:
-            citizen = None
-
-        if citizen:
-            quarantine_duration = site.user_quarantine_duration
-            quarantined_from = citizen.last_successful_login + site.user_login_duration
-            if now < quarantined_from and not citizen.logged_in:
-                time_allowed = (
-                    time_allowed
-                    - (now - citizen.last_successful_login).total_seconds() // 60
-                )
-                if prevent_dual_login:
-                    citizen.logged_in = True
-            elif now < quarantined_from and citizen.logged_in:
-                citizen_hash = "logged_in"
-            elif (now - quarantined_from) >= quarantine_duration:
-                citizen.last_successful_login = now
-                if prevent_dual_login:
-                    citizen.logged_in = True
-            else:
-                # (now - quarantined_from) < quarantine_duration:
-                time_allowed = (
-                    (now - quarantined_from).total_seconds()
-                    - quarantine_duration.total_seconds()
-                ) // 60
+        status, minutes = Citizen.objects.log_in(
+            citizen_hash,
+            site,
+            now,
+            site.user_login_duration,
+            site.user_quarantine_duration,
+            mark_logged_in=prevent_dual_login,
+        )
+        if status == "logged_in":
+            # Time in minutes.
+            time_allowed = site.user_login_duration.total_seconds() // 60
+            citizen_hash = "logged_in"
         else:
-            # First-time login, all good.
-            citizen = Citizen(
-                citizen_id=citizen_hash,
-                last_successful_login=now,
-                site=site,
-                logged_in=True,
-            )
-        citizen.save()
+            time_allowed = minutes
 
     if prevent_dual_login:
         return int(time_allowed), citizen_hash
@@ -0,0 +1,91 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from system import push
+from system.caches import api_key_cache, script_code_cache
+from system.models import (
+    APIKey,
+    AppointmentCache,
+    ConfigurationEntry,
+    MergedConfiguration,
+    PC,
+    PCGroup,
+    Script,
+    SecurityProblem,
+    Site,
+)
+
+
+# Keep MergedConfiguration in sync with the configurations it's built from.
+@receiver(post_save, sender=ConfigurationEntry)
+@receiver(post_delete, sender=ConfigurationEntry)
+def invalidate_merged_configuration_on_entry_change(sender, instance, **kwargs):
+    MergedConfiguration.invalidate(configuration_id=instance.owner_configuration_id)
+
+
+@receiver(post_save, sender=PC)
+def update_merged_configuration_on_pc_save(sender, instance, created, **kwargs):
+    if created:
+        MergedConfiguration.objects.get_or_create(pc=instance)
+    else:
+        # The PC's MAC and UID are part of the configuration sent to it.
+        MergedConfiguration.invalidate(pcs=[instance.pk])
+
+
+@receiver(m2m_changed, sender=PC.pc_groups.through)
+def invalidate_merged_configuration_on_membership_change(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    if action in ("post_add", "post_remove"):
+        pcs = pk_set if reverse else [instance.pk]
+    elif action == "pre_clear":
+        pcs = instance.pcs.all() if reverse else [instance.pk]
+    else:
+        return
+    MergedConfiguration.invalidate(pcs=pcs)
+
+
+@receiver(pre_delete, sender=PCGroup)
+def invalidate_merged_configuration_on_group_delete(sender, instance, **kwargs):
+    MergedConfiguration.invalidate(pcs=instance.pcs.all())
+
+
+@receiver(post_delete, sender=Script)
+def discard_cached_script_code(sender, instance, **kwargs):
+    name = instance.executable_code.name
+    script_code_cache.discard_matching(lambda key: key[0] == name)
+
+
+@receiver(post_delete, sender=APIKey)
+def discard_cached_api_key(sender, instance, **kwargs):
+    api_key_cache.discard(instance.key_hash)
+
+
+# Forget the appointments looked up for a site when its booking API
+# settings may have changed.
+@receiver(post_save, sender=Site)
+def clear_appointment_cache(sender, instance, **kwargs):
+    AppointmentCache.objects.filter(site=instance).delete()
+
+
+# Wake up waiting clients when their security scripts change. Configuration
+# changes are published by MergedConfiguration.invalidate.
+@receiver(post_save, sender=SecurityProblem)
+@receiver(post_delete, sender=SecurityProblem)
+def publish_security_problem_change(sender, instance, **kwargs):
+    push.publish(PC.objects.filter(site_id=instance.site_id).values_list("pk", flat=True))
+
+
+@receiver(m2m_changed, sender=SecurityProblem.alert_groups.through)
+def publish_security_problem_groups_change(sender, instance, action, reverse, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    pcs = PC.objects.filter(site_id=instance.site_id)
+    push.publish(pcs.values_list("pk", flat=True))
+
+
+@receiver(post_save, sender=Script)
+def publish_security_script_change(sender, instance, created, **kwargs):
+    if instance.is_security_script and not created:
+        pcs = PC.objects.filter(site__securityproblem__security_script=instance)
+        push.publish(pcs.values_list("pk", flat=True))
@@ -6,13 +6,33 @@ Replace this with more appropriate tests for your application.
 """
 
 import os
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
 from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import connection
 from django.test import TestCase
+from ninja.errors import ValidationError
 
 from django.core.mail import EmailMessage
 from django.contrib.auth.models import User
 from account.models import UserProfile
+from system import api, changes, rpc
+from system.caches import batch_target_pcs_cache
+from system.models import (
+    Batch,
+    BatchTarget,
+    Citizen,
+    Configuration,
+    Job,
+    PC,
+    Script,
+    Site,
+    Tombstone,
+)
+from system.pagination import CursorPagination, PendingRows
 
 print("FILE", os.path.dirname(__file__))
 
@@ -53,3 +73,493 @@ class SimpleTest(TestCase):
 
         self.assertEqual(len(email_list), 2)
         self.assertEqual(message.send(), 1)
+
+
+def create_pcs(site, count):
+    return [
+        PC.objects.create(
+            name=f"pc{i}",
+            uid=f"{site.uid}-pc{i}",
+            site=site,
+            configuration=Configuration.objects.create(name=f"{site.uid}-pc{i}"),
+            is_activated=True,
+        )
+        for i in range(count)
+    ]
+
+
+class CitizenLoginTest(TestCase):
+    LOGIN_DURATION = timedelta(hours=1)
+    QUARANTINE_DURATION = timedelta(hours=4)
+
+    def setUp(self):
+        self.site = Site.objects.create(name="Library", uid="library")
+        self.start = datetime(2024, 1, 1, 10, 0)
+
+    def log_in(self, minutes, mark_logged_in=True):
+        return Citizen.objects.log_in(
+            "citizen",
+            self.site,
+            self.start + timedelta(minutes=minutes),
+            self.LOGIN_DURATION,
+            self.QUARANTINE_DURATION,
+            mark_logged_in,
+        )
+
+    def test_first_login(self):
+        self.assertEqual(self.log_in(0), ("allowed", 60))
+        citizen = Citizen.objects.get(citizen_id="citizen")
+        self.assertEqual(citizen.last_successful_login, self.start)
+        self.assertTrue(citizen.logged_in)
+
+    def test_continue_within_login_period(self):
+        self.log_in(0)
+        Citizen.objects.log_out("citizen")
+        self.assertEqual(self.log_in(20), ("allowed", 40))
+        citizen = Citizen.objects.get(citizen_id="citizen")
+        self.assertEqual(citizen.last_successful_login, self.start)
+        self.assertTrue(citizen.logged_in)
+
+    def test_logged_in_elsewhere(self):
+        self.log_in(0)
+        self.assertEqual(self.log_in(20), ("logged_in", None))
+
+    def test_quarantine(self):
+        self.log_in(0)
+        Citizen.objects.log_out("citizen")
+        # The login period ended 30 minutes ago.
+        self.assertEqual(self.log_in(90), ("quarantine", -210))
+        self.assertEqual(
+            Citizen.objects.get(citizen_id="citizen").last_successful_login,
+            self.start,
+        )
+
+    def test_quarantine_over(self):
+        self.log_in(0)
+        Citizen.objects.log_out("citizen")
+        self.assertEqual(self.log_in(300), ("allowed", 60))
+        citizen = Citizen.objects.get(citizen_id="citizen")
+        self.assertEqual(
+            citizen.last_successful_login, self.start + timedelta(minutes=300)
+        )
+        self.assertTrue(citizen.logged_in)
+
+    def test_quarantine_over_without_log_out(self):
+        self.log_in(0)
+        self.assertEqual(self.log_in(300), ("allowed", 60))
+
+    def test_not_marked_logged_in(self):
+        self.log_in(0)
+        Citizen.objects.log_out("citizen")
+        self.assertEqual(self.log_in(10, mark_logged_in=False), ("allowed", 50))
+        self.assertFalse(Citizen.objects.get(citizen_id="citizen").logged_in)
+        # Not kept from logging in elsewhere.
+        self.assertEqual(self.log_in(20, mark_logged_in=False), ("allowed", 40))
+        self.assertEqual(self.log_in(30), ("allowed", 30))
+        self.assertTrue(Citizen.objects.get(citizen_id="citizen").logged_in)
+
+
+class UpdateJobsTest(TestCase):
+    def setUp(self):
+        site = Site.objects.create(name="Library", uid="library")
+        self.pc, self.other_pc = create_pcs(site, 2)
+        script = Script.objects.create(name="Script", site=site)
+        self.batch = Batch.objects.create(name="Batch", script=script, site=site)
+        self.batch.add_jobs([self.pc, self.other_pc], lazy=False)
+        self.job = self.pc.jobs.get()
+        # As handed out by get_jobs.
+        self.pc.jobs.update(status=Job.SUBMITTED)
+        Batch.update_progress({self.batch.pk: {"jobs_submitted": 1}})
+
+    def report(self, status, job=None):
+        return {
+            "id": str((job or self.job).pk),
+            "status": status,
+            "started": "2024-01-01 10:00:00",
+            "finished": "2024-01-01 10:01:00" if status != Job.SUBMITTED else "",
+            "log_output": status,
+        }
+
+    def assertProgress(self, submitted, done, failed):
+        self.batch.refresh_from_db()
+        self.assertEqual(
+            (self.batch.jobs_submitted, self.batch.jobs_done, self.batch.jobs_failed),
+            (submitted, done, failed),
+        )
+
+    def test_update(self):
+        self.assertProgress(1, 0, 0)
+        self.assertEqual(rpc.update_jobs(self.pc, [self.report(Job.DONE)]), 1)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, Job.DONE)
+        self.assertEqual(self.job.finished, datetime(2024, 1, 1, 10, 1))
+        self.assertEqual(self.job.log_output, Job.DONE)
+        self.assertProgress(1, 1, 0)
+
+    def test_repeated_reports(self):
+        rpc.update_jobs(self.pc, [self.report(Job.FAILED)])
+        self.assertEqual(rpc.update_jobs(self.pc, [self.report(Job.FAILED)]), 0)
+        self.assertEqual(
+            rpc.update_jobs(
+                self.pc, [self.report(Job.FAILED), self.report(Job.FAILED)]
+            ),
+            0,
+        )
+        self.assertProgress(1, 0, 1)
+
+    def test_duplicate_reports_in_one_call(self):
+        self.assertEqual(
+            rpc.update_jobs(self.pc, [self.report(Job.DONE), self.report(Job.DONE)]),
+            1,
+        )
+        self.assertProgress(1, 1, 0)
+
+    def test_out_of_order_reports(self):
+        self.assertEqual(
+            rpc.update_jobs(
+                self.pc, [self.report(Job.DONE), self.report(Job.SUBMITTED)]
+            ),
+            1,
+        )
+        self.assertEqual(rpc.update_jobs(self.pc, [self.report(Job.SUBMITTED)]), 0)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, Job.DONE)
+        self.assertProgress(1, 1, 0)
+
+    def test_finished_job_not_changed(self):
+        rpc.update_jobs(self.pc, [self.report(Job.DONE)])
+        self.assertEqual(rpc.update_jobs(self.pc, [self.report(Job.FAILED)]), 0)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, Job.DONE)
+        self.assertProgress(1, 1, 0)
+
+    def test_ignored_reports(self):
+        other_job = self.other_pc.jobs.get()
+        unknown = self.report(Job.DONE)
+        unknown["status"] = "UNKNOWN"
+        self.assertEqual(
+            rpc.update_jobs(self.pc, [self.report(Job.DONE, other_job), unknown]), 0
+        )
+        other_job.refresh_from_db()
+        self.assertEqual(other_job.status, Job.NEW)
+        self.assertProgress(1, 0, 0)
+
+
+class CursorPaginationTest(TestCase):
+    def setUp(self):
+        # Ids are reused once a test's transaction is rolled back.
+        batch_target_pcs_cache.clear()
+        self.site = Site.objects.create(name="Library", uid="library")
+        self.pcs = create_pcs(self.site, 6)
+        self.script = Script.objects.create(name="Script", site=self.site)
+        batch = Batch.objects.create(name="Small", script=self.script, site=self.site)
+        batch.add_jobs(self.pcs[:3], lazy=False)
+        batch = Batch.objects.create(name="Large", script=self.script, site=self.site)
+        batch.add_jobs(self.pcs[3:], lazy=True)
+        self.target = batch.targets.get()
+        self.jobs = Job.objects.filter(batch__site=self.site).order_by("-id")
+        self.job_ids = list(self.jobs.values_list("pk", flat=True))
+
+    def paginate(self, queryset, limit, cursor=None, offset=None):
+        return CursorPagination().paginate_queryset(
+            queryset,
+            CursorPagination.Input(limit=limit, cursor=cursor, offset=offset),
+        )
+
+    def pending_rows(self):
+        return PendingRows(BatchTarget.get_pending_jobs(self.site), self.jobs)
+
+    def test_cursor(self):
+        page = self.paginate(self.jobs, 2)
+        self.assertEqual([job.pk for job in page["items"]], self.job_ids[:2])
+        self.assertEqual(page["count"], 3)
+
+        # Jobs created while paging don't shift the later pages.
+        batch = Batch.objects.create(name="New", script=self.script, site=self.site)
+        batch.add_jobs(self.pcs[:1], lazy=False)
+        page = self.paginate(self.jobs, 2, cursor=page["next_cursor"])
+        self.assertEqual([job.pk for job in page["items"]], self.job_ids[2:])
+        self.assertIsNone(page["count"])
+        self.assertIsNone(page["next_cursor"])
+
+    def test_offset(self):
+        page = self.paginate(self.jobs, 1, offset=1)
+        self.assertEqual([job.pk for job in page["items"]], self.job_ids[1:2])
+        self.assertEqual(page["count"], 3)
+        page = self.paginate(self.jobs, 1, cursor=page["next_cursor"])
+        self.assertEqual([job.pk for job in page["items"]], self.job_ids[2:])
+        self.assertIsNone(page["next_cursor"])
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValidationError):
+            self.paginate(self.jobs, 2, cursor="invalid")
+
+    def test_pending_rows(self):
+        page = self.paginate(self.pending_rows(), 2)
+        self.assertEqual(
+            [job.pending_key for job in page["items"]],
+            [(self.target.pk, pc.pk) for pc in self.pcs[3:5]],
+        )
+        self.assertEqual([job.pk for job in page["items"]], [None, None])
+        self.assertEqual(page["count"], 6)
+
+        # The last PC fetching its job while paging doesn't make it skipped.
+        BatchTarget.create_jobs(self.pcs[5])
+        page = self.paginate(self.pending_rows(), 2, cursor=page["next_cursor"])
+        new_job = self.pcs[5].jobs.get()
+        self.assertEqual(
+            [job.pk for job in page["items"]], [new_job.pk, self.job_ids[0]]
+        )
+        page = self.paginate(self.pending_rows(), 2, cursor=page["next_cursor"])
+        self.assertEqual([job.pk for job in page["items"]], self.job_ids[1:])
+        self.assertIsNone(page["next_cursor"])
+
+    def test_pending_rows_offset(self):
+        page = self.paginate(self.pending_rows(), 2, offset=2)
+        self.assertEqual(
+            page["items"][0].pending_key, (self.target.pk, self.pcs[5].pk)
+        )
+        self.assertEqual(page["items"][1].pk, self.job_ids[0])
+        self.assertEqual(page["count"], 6)
+        page = self.paginate(self.pending_rows(), 2, offset=4)
+        self.assertEqual([job.pk for job in page["items"]], self.job_ids[1:])
+        self.assertIsNone(page["next_cursor"])
+
+    def test_pending_rows_of_deleted_pc(self):
+        self.pcs[4].delete()
+        page = self.paginate(self.pending_rows(), 2, offset=2)
+        self.assertEqual([job.pk for job in page["items"]], self.job_ids[:2])
+        self.assertEqual(page["count"], 5)
+
+
+class ChangesTest(TestCase):
+    def setUp(self):
+        self.site = Site.objects.create(name="Library", uid="library")
+        self.pcs = create_pcs(self.site, 3)
+        other_pc = create_pcs(Site.objects.create(name="Other", uid="other"), 1)[0]
+        script = Script.objects.create(name="Script", site=self.site)
+        batch = Batch.objects.create(name="Batch", script=script, site=self.site)
+        batch.add_jobs(self.pcs[:1], lazy=False)
+        self.job = batch.jobs.get()
+        self.tombstone = Tombstone.objects.create(
+            model=Tombstone.COMPUTER,
+            object_id=0,
+            site=self.site,
+            sync_xid=15,
+            sync_version=5,
+            deleted=datetime.now(),
+        )
+        # Set by database triggers on PostgreSQL, see SyncTriggerTest.
+        for obj, xid, version in (
+            (self.pcs[0], 10, 1),
+            (other_pc, 10, 2),
+            (self.pcs[1], 10, 3),
+            (self.job, 12, 4),
+            (self.pcs[2], 25, 6),
+        ):
+            type(obj).objects.filter(pk=obj.pk).update(
+                sync_xid=xid, sync_version=version
+            )
+
+    def get_changes(self, since, limit, oldest_running_xid):
+        with mock.patch(
+            "system.changes.get_oldest_running_xid", return_value=oldest_running_xid
+        ):
+            return changes.get_changes(self.site, since, limit)
+
+    def test_changes(self):
+        result = self.get_changes((0, 0), 100, 20)
+        self.assertEqual(result["computers"], self.pcs[:2])
+        self.assertEqual(result["jobs"], [self.job])
+        self.assertEqual(result["events"], [])
+        self.assertEqual(result["deleted"], [self.tombstone])
+        self.assertEqual(result["position"], (20, 0))
+        self.assertFalse(result["has_more"])
+
+    def test_held_back_until_transaction_finished(self):
+        # Transaction 25 is still running, and nothing else has changed.
+        result = self.get_changes((20, 0), 100, 20)
+        self.assertEqual(result["computers"], [])
+        self.assertEqual(result["position"], (20, 0))
+
+        result = self.get_changes((20, 0), 100, 30)
+        self.assertEqual(result["computers"], self.pcs[2:])
+        self.assertEqual(result["jobs"], [])
+        self.assertEqual(result["deleted"], [])
+        self.assertEqual(result["position"], (30, 0))
+
+    def test_limit(self):
+        result = self.get_changes((0, 0), 1, 20)
+        # Jobs and tombstones stop at the same position as computers.
+        self.assertEqual(result["computers"], self.pcs[:1])
+        self.assertEqual(result["jobs"], [])
+        self.assertEqual(result["deleted"], [])
+        self.assertEqual(result["position"], (10, 3))
+        self.assertTrue(result["has_more"])
+
+        result = self.get_changes(result["position"], 1, 20)
+        self.assertEqual(result["computers"], self.pcs[1:2])
+        self.assertEqual(result["jobs"], [self.job])
+        self.assertEqual(result["deleted"], [self.tombstone])
+        self.assertEqual(result["position"], (20, 0))
+        self.assertFalse(result["has_more"])
+
+    def test_cursor(self):
+        request = SimpleNamespace(auth=self.site)
+        with mock.patch("system.changes.get_oldest_running_xid", return_value=20):
+            result = api.list_changes(request, limit=100)
+        self.assertEqual(changes.decode_cursor(result["next_cursor"]), (20, 0))
+        with mock.patch("system.changes.get_oldest_running_xid", return_value=30):
+            result = api.list_changes(request, cursor=result["next_cursor"], limit=100)
+        self.assertEqual(result["computers"], self.pcs[2:])
+        with self.assertRaises(ValidationError):
+            api.list_changes(request, cursor="invalid", limit=100)
+
+
+@skipUnless(connection.vendor == "postgresql", "Sync triggers need PostgreSQL")
+class SyncTriggerTest(TestCase):
+    def setUp(self):
+        self.site = Site.objects.create(name="Library", uid="library")
+        (self.pc,) = create_pcs(self.site, 1)
+
+    def get_position(self):
+        self.pc.refresh_from_db()
+        return self.pc.sync_xid, self.pc.sync_version
+
+    def test_changed(self):
+        xid, version = self.get_position()
+        self.assertGreater(version, 0)
+        self.pc.name = "Renamed"
+        self.pc.save()
+        self.assertEqual(self.get_position(), (xid, self.pc.sync_version))
+        self.assertGreater(self.pc.sync_version, version)
+
+    def test_last_seen(self):
+        self.pc.last_seen = datetime(2024, 1, 1, 10, 0)
+        self.pc.save()
+        position = self.get_position()
+        PC.objects.filter(pk=self.pc.pk).update(last_seen=datetime(2024, 1, 1, 10, 4))
+        self.assertEqual(self.get_position(), position)
+        PC.objects.filter(pk=self.pc.pk).update(last_seen=datetime(2024, 1, 1, 10, 5))
+        self.assertGreater(self.get_position()[1], position[1])
+
+    def test_held_back_while_running(self):
+        # The test's own transaction is still running.
+        xid, _ = self.get_position()
+        self.assertGreaterEqual(xid, changes.get_oldest_running_xid())
+        self.assertEqual(changes.get_changes(self.site, (0, 0), 100)["computers"], [])
+
+    def test_tombstone(self):
+        xid, version = self.get_position()
+        pc_id = self.pc.pk
+        self.pc.delete()
+        tombstone = Tombstone.objects.get(site=self.site)
+        self.assertEqual(tombstone.model, Tombstone.COMPUTER)
+        self.assertEqual(tombstone.object_id, pc_id)
+        self.assertEqual(tombstone.sync_xid, xid)
+        self.assertGreater(tombstone.sync_version, version)
+
+
+class BatchWavesTest(TestCase):
+    def setUp(self):
+        batch_target_pcs_cache.clear()
+        site = Site.objects.create(name="Library", uid="library")
+        self.pcs = create_pcs(site, 5)
+        self.batch = Batch.objects.create(
+            name="Batch",
+            script=Script.objects.create(name="Script", site=site),
+            site=site,
+            wave_size=2,
+            wave_interval=10,
+        )
+        self.now = self.batch.created
+
+    def start(self, minutes_ago):
+        Batch.objects.filter(pk=self.batch.pk).update(
+            created=self.now - timedelta(minutes=minutes_ago)
+        )
+        self.batch.refresh_from_db()
+
+    def fetch_jobs(self):
+        for pc in self.pcs:
+            BatchTarget.create_jobs(pc)
+        return [pc for pc in self.pcs if pc.jobs.filter(batch=self.batch).exists()]
+
+    def test_open_positions(self):
+        self.assertEqual(self.batch.get_open_positions(self.now), 2)
+        self.assertEqual(
+            self.batch.get_open_positions(self.now + timedelta(minutes=9)), 2
+        )
+        self.assertEqual(
+            self.batch.get_open_positions(self.now + timedelta(minutes=10)), 4
+        )
+        self.assertEqual(
+            self.batch.get_open_positions(self.now + timedelta(minutes=25)), 6
+        )
+        self.batch.wave_size = None
+        self.assertIsNone(self.batch.get_open_positions(self.now))
+
+    def test_wave_interval_required(self):
+        self.batch.wave_interval = 0
+        with self.assertRaises(DjangoValidationError):
+            self.batch.clean()
+
+    def test_waves(self):
+        self.batch.add_jobs(self.pcs)
+        self.assertEqual(self.fetch_jobs(), self.pcs[:2])
+        self.start(10)
+        with mock.patch("system.push.publish") as publish:
+            BatchTarget.publish_open_waves(datetime.now())
+        self.assertEqual(
+            sorted(publish.call_args[0][0]), [pc.pk for pc in self.pcs[2:4]]
+        )
+        self.assertEqual(self.fetch_jobs(), self.pcs[:4])
+        self.start(20)
+        self.assertEqual(self.fetch_jobs(), self.pcs)
+        self.assertFalse(BatchTarget.objects.filter(pending__gt=0).exists())
+
+    def test_halt(self):
+        self.batch.halt_failure_percentage = 50
+        self.assertFalse(self.batch.is_halted)
+        self.batch.jobs_submitted = 4
+        self.batch.jobs_failed = 1
+        self.assertFalse(self.batch.is_halted)
+        self.assertEqual(self.batch.get_open_positions(self.now), 2)
+        self.batch.jobs_failed = 2
+        self.assertTrue(self.batch.is_halted)
+        self.assertEqual(self.batch.get_open_positions(self.now), 0)
+
+    def test_halt_rollout(self):
+        Batch.objects.filter(pk=self.batch.pk).update(halt_failure_percentage=50)
+        self.batch.add_jobs(self.pcs)
+        pc = self.pcs[0]
+        BatchTarget.create_jobs(pc)
+        job = pc.jobs.get()
+        # As handed out by get_jobs.
+        pc.jobs.update(status=Job.SUBMITTED)
+        Batch.update_progress({self.batch.pk: {"jobs_submitted": 1}})
+        rpc.update_jobs(
+            pc,
+            [
+                {
+                    "id": job.pk,
+                    "status": Job.FAILED,
+                    "started": "",
+                    "finished": "",
+                    "log_output": "",
+                }
+            ],
+        )
+        self.batch.refresh_from_db()
+        self.assertEqual(
+            (
+                self.batch.jobs_total,
+                self.batch.jobs_submitted,
+                self.batch.jobs_done,
+                self.batch.jobs_failed,
+            ),
+            (5, 1, 0, 1),
+        )
+        self.assertTrue(self.batch.is_halted)
+        # Nothing more is handed out, not even to the rest of the first wave.
+        self.assertEqual(self.fetch_jobs(), self.pcs[:1])
@@ -4,7 +4,6 @@ import json
 import logging
 import re
 import requests
-import traceback
 from urllib.parse import quote
 from datetime import datetime
 
@@ -12,19 +11,18 @@ from importlib import import_module
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.mail import EmailMessage
 from django.utils import translation
 from django.utils.translation import gettext_lazy as _
 
+from system.integrations import CiceroClient, EasyAppointmentsClient, QuriaClient
+from system.models import Notification, SMSMessage
 
-def notify_users(security_event, security_problem, pc):
-    """Notify users about security event."""
 
-    logger = logging.getLogger(__name__)
+def get_alert_email_addresses(pc, rule):
+    """Get the e-mail addresses to notify about an event on a PC.
 
-    # Subject = security name,
-    # Body = description + technical summary
-    email_list = []
+    These are the supervisors of the PC's groups if there are any, otherwise
+    the users set to be alerted by the security problem or event rule."""
     supervisor_relations = pc.pc_groups.exclude(supervisors=None)
     if supervisor_relations:
         alert_users_pk = list(
@@ -32,27 +30,46 @@ def notify_users(security_event, security_problem, pc):
         )
         alert_users = User.objects.only("email").filter(pk__in=alert_users_pk)
     else:
-        alert_users = security_problem.alert_users.only("email").all()
-    for user in alert_users:
-        email_list.append(user.email)
-
-    body = f"Beskrivelse af sikkerhedsadvarsel: {security_problem.description}\n"
-    body += f"Kort resume af data fra log filen : {security_event.summary}"
-    try:
-        message = EmailMessage(
-            f"Sikkerhedsadvarsel for PC : {pc.name}."
-            f" Sikkerhedsregel : {security_problem.name}",
+        alert_users = rule.alert_users.only("email").all()
+    return {user.email for user in alert_users if user.email}
+
+
+def queue_notifications(email_addresses, subject, body):
+    """Return unsaved notifications with the given subject and body for each
+    of the e-mail addresses. They're sent by the send_notifications command
+    once saved."""
+    return [
+        Notification(recipient=email, subject=subject, body=body)
+        for email in sorted(email_addresses)
+    ]
+
+
+def notify_users(security_events):
+    """Queue notifications to users about security events. The events must
+    have problem and pc set."""
+    email_addresses = {}
+    notifications = []
+
+    for security_event in security_events:
+        security_problem = security_event.problem
+        pc = security_event.pc
+
+        key = (pc.pk, security_problem.pk)
+        if key not in email_addresses:
+            email_addresses[key] = get_alert_email_addresses(pc, security_problem)
+
+        # Subject = security name,
+        # Body = PC + description + technical summary
+        body = f"PC : {pc.name}\n"
+        body += f"Beskrivelse af sikkerhedsadvarsel: {security_problem.description}\n"
+        body += f"Kort resume af data fra log filen : {security_event.summary}"
+        notifications += queue_notifications(
+            email_addresses[key],
+            f"Sikkerhedsadvarsel. Sikkerhedsregel : {security_problem.name}",
             body,
-            settings.DEFAULT_FROM_EMAIL,
-            email_list,
         )
-        message.send(fail_silently=False)
-    except Exception:  # Likely Exception: SMTPException
-        logger.warning("Security Event e-mail-sending failed:")
-        logger.warning(traceback.format_exc())
-        return False
 
-    return True
+    Notification.objects.bulk_create(notifications)
 
 
 def get_citizen_login_api_validator():
@@ -78,16 +95,13 @@ def quria_login_validate(site, loaner_number, pincode):
         logger.error(f"{site.name}: Agency ID / NCIP MUST be specified.")
         return 0
 
-    headers = {
-        "accept": "application/json",
-        "X-Axiell-Api-Key": site.citizen_login_api_key,
-    }
-    loaner_auth_url = (
-        f"https://axiell.io/api/quriaEU/patron-lookup/quria-release/integrations/"
-        f"ncip/{site.agency_id}/small?sno={loaner_number}&pwd={pincode}"
-    )
-
-    response = requests.get(loaner_auth_url, headers=headers)
+    try:
+        response = QuriaClient(site).lookup_patron(loaner_number, pincode)
+    # Likely Exceptions: Timeout, ConnectionError, ServiceUnavailable.
+    # Only log the kind, as the message may include the request URL.
+    except requests.RequestException as e:
+        logger.error(f"{site.name}: Unable to reach Quria: {type(e).__name__}")
+        return 0
 
     if response.ok:
         status = response.json()["status"]
@@ -136,30 +150,20 @@ def easy_appointments_booking_validate(
 
     logger = logging.getLogger(__name__)
 
-    headers = {"Authorization": f"Bearer {site.booking_api_key}"}
     date_time = now.strftime("%Y-%m-%d %H:%M:%S")
-    date = date_time.split(" ")[0]
     if not site.booking_api_url:
         logger.error(f"{site.name}: Booking API URL MUST be specified.")
         return 0, ""
-    appointment_url = (
-        f"https://{site.booking_api_url}/index.php/api/v1/appointments?aggregates"
-        f"&fields=start,end,customer,service&sort=+start&q={date}"
-    )
     try:
-        response = requests.get(appointment_url, headers=headers)
-    # Likely Exceptions: socket.gaierror, NewConnectionError, MaxRetryError
-    except Exception:
-        return 0, ""
-    if response.ok:
-        appointments = response.json()
-    else:
-        # Unable to authenticate with system API key - log this.
-        message = response.text
+        appointments = EasyAppointmentsClient(site).get_appointments(now.date())
+    # Likely Exceptions: Timeout, ConnectionError, ServiceUnavailable
+    except requests.RequestException as e:
         logger.error(
-            f"{site.name} was unable to authorize with configured EasyAppointments API key: {message}"
+            f"{site.name}: Unable to reach Easy!Appointments: {type(e).__name__}"
         )
         return 0, ""
+    if appointments is None:
+        return 0, ""
     time_allowed = None
     note = ""
     quarantine = False
@@ -266,50 +270,13 @@ def easy_appointments_booking_validate(
     return time_allowed, note
 
 
-def send_password_sms(phone_number, message, site):
-    """Makes a request to the SMSTeknik API in order to send
-    a sms with the required password to the specified number.
-
-    Return values:
-        True: Request was successful.
-        False: Authentication failed."""
-
-    logger = logging.getLogger(__name__)
-
-    sms_url = (
-        f"https://api.smsteknik.se/send/xml/?id=F%F6reningen+Sambruk"
-        f"&user={quote(site.citizen_login_api_user)}&pass={quote(site.citizen_login_api_password)}"
+def queue_password_sms(phone_number, message, site, pc=None):
+    """Queue a sms with the required password to the specified number.
+    It is sent by the send_sms worker, and the client of the PC can follow
+    its progress with the sms_status RPC."""
+    return SMSMessage.objects.create(
+        site=site, pc=pc, phone_number=phone_number, message=message
     )
-    translate_table = str.maketrans({"å": r"&#229;", "ä": r"&#228;", "ö": r"&#246;"})
-    xml = f"""<?xml version='1.0' encoding='utf-8'?>
-        <sms-teknik>
-        <flash>true</flash> # Make it a flash sms
-        <customid>{site.name.translate(translate_table)}</customid>
-        <udmessage><![CDATA[{message.translate(translate_table)}]]></udmessage>
-        <smssender>MedborgarPC</smssender> # This is the listed sender. It is limited to 11 characters
-        <items>
-        <recipient>
-        <nr>{phone_number}</nr>
-        </recipient>
-        </items>
-        </sms-teknik>"""
-
-    response = requests.post(sms_url, data=xml)
-    # The SMSTeknik API always returns response.ok = True even
-    # if authentication fails. Instead, status is indicated by
-    # response.text which will be an id for successful requests
-    # and 0: followed by a brief error description for failed
-    # requests
-    if response.text[:2] != "0:":
-        return True
-    else:
-        if "no valid recipients" not in response.text.lower():
-            # Unable to authenticate with system user - log this.
-            logger.error(
-                f"{site.name} was unable to authorize with SMSTeknik "
-                f"with configured user name and password: {response.text}"
-            )
-        return False
 
 
 def cicero_validate(loaner_number, pincode, site):
@@ -327,37 +294,13 @@ def cicero_validate(loaner_number, pincode, site):
     if not site.agency_id:
         logger.error(f"{site.name}: Agency ID / ISIL MUST be specified.")
         return 0
-    # First, get sessionKey.
-    session_key_url = (
-        f"{settings.CICERO_URL}/rest/external/v1/{site.agency_id}/authentication/login/"
-    )
-    response = requests.post(
-        session_key_url,
-        json={
-            "username": site.citizen_login_api_user,
-            "password": site.citizen_login_api_password,
-        },
-    )
-    if response.ok:
-        session_key = response.json()["sessionKey"]
-        # Just debugging for the moment.
-    else:
-        # Unable to authenticate with system user - log this.
-        message = response.json()["message"]
-        logger.error(
-            f"{site.name} was unable to log in with configured user name and password: {message}"
-        )
+    try:
+        response = CiceroClient(site).authenticate_patron(loaner_number, pincode)
+    # Likely Exceptions: Timeout, ConnectionError, ServiceUnavailable
+    except requests.RequestException as e:
+        logger.error(f"{site.name}: Unable to reach Cicero: {type(e).__name__}")
         return 0
-    # We now have a valid session key.
-    loaner_auth_url = (
-        f"{settings.CICERO_URL}/rest/external/{site.agency_id}/patrons/authenticate/v6"
-    )
-    response = requests.post(
-        loaner_auth_url,
-        headers={"X-session": session_key},
-        json={"libraryCardNumber": loaner_number, "pincode": pincode},
-    )
-    if response.ok:
+    if response is not None and response.ok:
         result = response.json()
         authenticate_status = result["authenticateStatus"]
         if authenticate_status != "VALID":
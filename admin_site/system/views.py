@@ -53,6 +53,8 @@ from account.models import (
 from system.models import (
     APIKey,
     AssociatedScriptParameter,
+    Batch,
+    BatchTarget,
     ConfigurationEntry,
     Customer,
     ImageVersion,
@@ -74,6 +76,8 @@ from system.models import (
     Country,
 )
 
+from system.pagination import PendingRows
+
 from system.forms import (
     ConfigurationEntryForm,
     EventRuleServerForm,
@@ -905,8 +909,14 @@ class JobSearch(SiteMixin, JSONResponseMixin, BaseListView, SuperAdminOrThisSite
                     batch__script__feature_permission__in=site.customer.feature_permission.all()
                 )
             )
+            batches = Batch.objects.filter(
+                Q(script__is_hidden=False)
+                | Q(script__feature_permission__in=site.customer.feature_permission.all())
+            )
         else:
             queryset = Job.objects.all()
+            batches = Batch.objects.all()
+        pcs = PC.objects.all()
         params = self.request.GET
 
         query = {"batch__site": site}
@@ -918,10 +928,15 @@ class JobSearch(SiteMixin, JSONResponseMixin, BaseListView, SuperAdminOrThisSite
             v = params.get(k, "")
             if v != "":
                 query[k] = v
+        if params.get("pc", "") != "":
+            pcs = pcs.filter(pk=params["pc"])
+        if params.get("batch", "") != "":
+            batches = batches.filter(pk=params["batch"])
 
         group = params.get("group", "")
         if group != "":
             query["pc__pc_groups"] = group
+            pcs = pcs.filter(pc_groups=group)
 
         orderby = params.get("orderby", "-pk")
         if orderby not in JobSearch.VALID_ORDER_BY:
@@ -929,6 +944,12 @@ class JobSearch(SiteMixin, JSONResponseMixin, BaseListView, SuperAdminOrThisSite
 
         queryset = queryset.filter(**query).order_by(orderby, "pk")
 
+        # Jobs still to be created from batch targets are listed first.
+        if Job.NEW in params.getlist("status", [Job.NEW]):
+            pending = BatchTarget.get_pending_jobs(site, pcs=pcs, batches=batches)
+            if pending:
+                return PendingRows(pending, queryset)
+
         return queryset
 
     # for admin users the user_url is a redirect to our job docs
@@ -1002,12 +1023,17 @@ class JobSearch(SiteMixin, JSONResponseMixin, BaseListView, SuperAdminOrThisSite
                     "batch_name": job.batch.name,
                     "user": self.get_username(job.user),
                     "user_url": self.get_user_url(job.user, site.uid),
-                    "has_info": job.has_info,
+                    # Pending jobs have yet to be created.
+                    "has_info": job.pk is not None and job.has_info,
                     "script_url": reverse(
                         "script", args=[site.uid, job.batch.script.id]
                     ),
                     "pc_url": reverse("computer", args=[site.uid, job.pc.uid]),
-                    "restart_url": reverse("restart_job", args=[site.uid, job.pk]),
+                    "restart_url": (
+                        reverse("restart_job", args=[site.uid, job.pk])
+                        if job.pk is not None
+                        else ""
+                    ),
                 }
                 for job in page_obj
             ],